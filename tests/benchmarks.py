@@ -0,0 +1,323 @@
+"""
+Benchmarks of the token verification paths, reporting the operations per
+second and the database queries of each path. Run them with::
+
+    DJANGO_SETTINGS_MODULE=tests.settings PYTHONPATH=. \\
+        python -m tests.benchmarks [--number 1000] [name ...]
+"""
+import argparse
+import json
+import os
+import time
+from binascii import unhexlify
+from hashlib import sha256
+from struct import pack
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django_otp.oath import totp
+from django_otp.util import random_hex
+
+from .utils import totp_str
+
+
+class Benchmark:
+    """
+    A token verification path. :meth:`setup` runs once, and :meth:`prepare`
+    before each run of :meth:`run`, which is the only timed part.
+    """
+    name = None
+    settings = {}
+
+    def setup(self):
+        self.user = get_user_model().objects.create_user(
+            username='%s@example.com' % self.name, password='secret')
+
+    def prepare(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError
+
+
+class TOTPDeviceFormBenchmark(Benchmark):
+    name = 'totp_device_form'
+
+    def setup(self):
+        super().setup()
+        from two_factor.forms import TOTPDeviceForm
+        self.form_class = TOTPDeviceForm
+        self.key = random_hex()
+
+    def prepare(self):
+        self.token = totp(unhexlify(self.key))
+
+    def run(self):
+        assert self.form_class(self.key, self.user, data={'token': self.token}).is_valid()
+
+
+class PhoneDeviceBenchmark(Benchmark):
+    """
+    A failed verification followed by a successful one, each writing the
+    throttling state.
+    """
+    name = 'phone_device'
+    settings = {'TWO_FACTOR_PHONE_THROTTLE_FACTOR': 0}
+
+    def setup(self):
+        super().setup()
+        self.device = self.user.phonedevice_set.create(name='default', number='+31101234567', method='sms')
+
+    def prepare(self):
+        self.token = totp(self.device.bin_key)
+
+    def run(self):
+        assert not self.device.verify_token(-1)
+        assert self.device.verify_token(self.token)
+
+
+class AuthenticationTokenFormBenchmark(Benchmark):
+    def setup(self):
+        super().setup()
+        from two_factor.forms import AuthenticationTokenForm
+        self.form_class = AuthenticationTokenForm
+        self.device = self.create_device()
+
+    def run(self):
+        form = self.form_class(self.user, self.device, data={'otp_token': self.token})
+        assert form.is_valid(), form.errors
+
+
+class TOTPAuthenticationBenchmark(AuthenticationTokenFormBenchmark):
+    name = 'authentication_form_totp'
+
+    def create_device(self):
+        return self.user.totpdevice_set.create(name='default')
+
+    def prepare(self):
+        # Tokens can only be used once
+        self.device.last_t = -1
+        self.token = totp_str(self.device.bin_key)
+
+
+class StaticAuthenticationBenchmark(AuthenticationTokenFormBenchmark):
+    name = 'authentication_form_backup'
+
+    def create_device(self):
+        return self.user.staticdevice_set.create(name='backup')
+
+    def setup(self):
+        super().setup()
+        from two_factor.forms import BackupTokenForm
+        self.form_class = BackupTokenForm
+
+    def prepare(self):
+        # Tokens are deleted when used
+        self.token = self.device.token_set.create(token='abcdef12').token
+
+
+class HashedStaticAuthenticationBenchmark(StaticAuthenticationBenchmark):
+    name = 'authentication_form_hashed_backup'
+    settings = {'TWO_FACTOR_HASH_BACKUP_TOKENS': True}
+
+    def create_device(self):
+        from two_factor.models import BackupDevice
+        return BackupDevice.objects.create(user=self.user, name='backup')
+
+    def prepare(self):
+        from two_factor.models import BackupToken
+        self.token = 'abcdef12'
+        BackupToken.from_token(self.device, self.token).save()
+
+
+class YubikeyAuthenticationBenchmark(AuthenticationTokenFormBenchmark):
+    """
+    Uses a locally verified YubiKey device, as the remote one needs the
+    YubiCloud validation service.
+    """
+    name = 'authentication_form_yubikey'
+
+    def setup(self):
+        super().setup()
+        from two_factor.plugins.yubikey.forms import YubiKeyAuthenticationForm
+        self.form_class = YubiKeyAuthenticationForm
+
+    def create_device(self):
+        from otp_yubikey.models import YubikeyDevice
+        return YubikeyDevice.objects.create(user=self.user, name='default')
+
+    def prepare(self):
+        from yubiotp.otp import OTP, encode_otp
+
+        # The usage counter has 8 bits, the session counter is then increased
+        session, counter = self.device.session, self.device.counter + 1
+        if counter > 0xff:
+            session, counter = session + 1, 0
+        otp = OTP(unhexlify(self.device.private_id), session, 0, counter, 0)
+        self.token = encode_otp(otp, self.device.bin_key, self.device.public_id()).decode()
+
+
+class SoftwareAuthenticator:
+    """
+    WebAuthn authenticator holding a P-256 credential in memory.
+    """
+
+    def __init__(self, rp_id, origin):
+        from cryptography.hazmat.primitives.asymmetric import ec
+        self.rp_id = rp_id
+        self.origin = origin
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        self.credential_id = os.urandom(16)
+        self.sign_count = 0
+
+    @property
+    def public_key(self):
+        import cbor2
+        numbers = self.private_key.public_key().public_numbers()
+        # COSE EC2 key with the ES256 algorithm
+        return cbor2.dumps({1: 2, 3: -7, -1: 1, -2: numbers.x.to_bytes(32, 'big'), -3: numbers.y.to_bytes(32, 'big')})
+
+    def get_assertion(self, challenge):
+        """
+        Returns the serialized AuthenticationCredential answering the
+        base64url-encoded `challenge`.
+        """
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from webauthn.helpers import bytes_to_base64url
+
+        self.sign_count += 1
+        # User present and verified
+        authenticator_data = sha256(self.rp_id.encode()).digest() + b'\x05' + pack('>I', self.sign_count)
+        client_data = json.dumps({
+            'type': 'webauthn.get',
+            'challenge': challenge,
+            'origin': self.origin,
+        }).encode()
+        signature = self.private_key.sign(authenticator_data + sha256(client_data).digest(),
+                                          ec.ECDSA(hashes.SHA256()))
+        return json.dumps({
+            'id': bytes_to_base64url(self.credential_id),
+            'rawId': bytes_to_base64url(self.credential_id),
+            'response': {
+                'authenticatorData': bytes_to_base64url(authenticator_data),
+                'clientDataJSON': bytes_to_base64url(client_data),
+                'signature': bytes_to_base64url(signature),
+            },
+            'type': 'public-key',
+            'clientExtensionResults': {},
+        })
+
+
+class WebauthnBenchmark(Benchmark):
+    name = 'webauthn'
+
+    def setup(self):
+        super().setup()
+        from webauthn.helpers import bytes_to_base64url
+
+        from two_factor.plugins.webauthn.forms import (
+            WebauthnAuthenticationTokenForm,
+        )
+        from two_factor.plugins.webauthn.models import WebauthnDevice
+        self.form_class = WebauthnAuthenticationTokenForm
+        self.request = RequestFactory().post('/')
+        self.authenticator = SoftwareAuthenticator('testserver', 'http://testserver')
+        WebauthnDevice.objects.create(
+            user=self.user, name='default', public_key=bytes_to_base64url(self.authenticator.public_key),
+            key_handle=bytes_to_base64url(self.authenticator.credential_id), sign_count=0)
+
+    def prepare(self):
+        from webauthn.helpers import bytes_to_base64url
+        challenge = bytes_to_base64url(os.urandom(32))
+        self.request.session = {'webauthn_request_challenge': challenge, 'webauthn_request_options': '{}'}
+        self.token = self.authenticator.get_assertion(challenge)
+
+    def run(self):
+        form = self.form_class(self.user, None, self.request, data={'otp_token': self.token})
+        device = form._verify_token(self.user, self.token)
+        assert device.sign_count == self.authenticator.sign_count
+
+
+class RememberCookieBenchmark(Benchmark):
+    name = 'remember_cookie'
+    settings = {'TWO_FACTOR_REMEMBER_COOKIE_AGE': 3600}
+
+    def setup(self):
+        super().setup()
+        from two_factor.views.utils import get_remember_device_cookie
+        self.cookie = get_remember_device_cookie(self.user, 'otp_totp.totpdevice/1')
+
+    def run(self):
+        from two_factor.views.utils import validate_remember_device_cookie
+        assert validate_remember_device_cookie(self.cookie, self.user, 'otp_totp.totpdevice/1')
+
+
+def get_benchmarks():
+    """
+    Returns the benchmarks whose optional dependencies are installed.
+    """
+    from django.apps import apps
+    benchmarks = [
+        TOTPDeviceFormBenchmark, PhoneDeviceBenchmark, TOTPAuthenticationBenchmark,
+        StaticAuthenticationBenchmark, HashedStaticAuthenticationBenchmark, RememberCookieBenchmark,
+    ]
+    if apps.is_installed('otp_yubikey'):
+        benchmarks.append(YubikeyAuthenticationBenchmark)
+    if apps.is_installed('two_factor.plugins.webauthn'):
+        benchmarks.append(WebauthnBenchmark)
+    return benchmarks
+
+
+def run_benchmark(benchmark_class, number=1000):
+    """
+    Runs the benchmark `number` times and returns its ``name``, operations
+    per second (``ops``) and the ``queries`` of a single run.
+    """
+    benchmark = benchmark_class()
+    with override_settings(**benchmark.settings):
+        benchmark.setup()
+        benchmark.prepare()
+        with CaptureQueriesContext(connection) as queries:
+            benchmark.run()
+
+        elapsed = 0.0
+        for _ in range(number):
+            benchmark.prepare()
+            start = time.perf_counter()
+            benchmark.run()
+            elapsed += time.perf_counter() - start
+    return {'name': benchmark.name, 'ops': number / elapsed, 'queries': len(queries)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('names', nargs='*', help='Benchmarks to run, all by default')
+    parser.add_argument('--number', type=int, default=1000, help='Runs of each benchmark')
+    args = parser.parse_args()
+
+    import django
+    from django.db import transaction
+    from django.test.runner import DiscoverRunner
+    from django.test.utils import setup_test_environment
+    django.setup()
+    setup_test_environment()
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        print('%-30s %12s %8s' % ('benchmark', 'ops/sec', 'queries'))
+        for benchmark_class in get_benchmarks():
+            if args.names and benchmark_class.name not in args.names:
+                continue
+            with transaction.atomic():
+                result = run_benchmark(benchmark_class, args.number)
+                transaction.set_rollback(True)
+            print('%(name)-30s %(ops)12.1f %(queries)8d' % result)
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == '__main__':
+    main()
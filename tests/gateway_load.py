@@ -0,0 +1,107 @@
+"""
+Load test of the Twilio gateway against a local stand-in of the Twilio API.
+Run it with::
+
+    DJANGO_SETTINGS_MODULE=tests.settings PYTHONPATH=. \\
+        python -m tests.gateway_load --messages 500 --concurrency 20 --latency 0.05
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+from phonenumber_field.phonenumber import PhoneNumber
+
+from .twilio_server import FakeTwilioServer
+
+TWILIO_SETTINGS = {
+    'TWILIO_ACCOUNT_SID': 'AC%s' % ('0' * 32),
+    'TWILIO_AUTH_TOKEN': 'token',
+    'TWILIO_CALLER_ID': '+15005550006',
+    'TWO_FACTOR_CALL_GATEWAY': 'two_factor.gateways.twilio.gateway.Twilio',
+    'TWO_FACTOR_SMS_GATEWAY': 'two_factor.gateways.twilio.gateway.Twilio',
+}
+
+
+def run_load(server, method='send_sms', messages=100, concurrency=10, timeout=None):
+    """
+    Sends `messages` tokens through ``two_factor.gateways.<method>`` from
+    `concurrency` threads, with the Twilio gateway pointed to the stand-in
+    `server`. Returns a dictionary of the results: the number of ``sent`` and
+    ``failed`` messages, the ``connections`` opened to the server, the
+    ``duration`` and ``throughput`` of the run, and the median and 95th
+    percentile ``latency`` of the messages, in seconds.
+
+    Django settings must already be configured with ``TWILIO_SETTINGS``.
+    """
+    from django.test import RequestFactory
+
+    from two_factor import gateways
+    from two_factor.middleware.threadlocals import _thread_locals
+
+    gateways.reset_gateways()
+    server.patch_client(gateways.get_gateway(TWILIO_SETTINGS['TWO_FACTOR_SMS_GATEWAY']).client, timeout=timeout)
+    send = getattr(gateways, method)
+    # make_call builds the absolute URL of the call app from the request
+    request = RequestFactory().get('/')
+
+    def deliver(index):
+        _thread_locals.request = request
+        device = Mock(number=PhoneNumber.from_string('+1555%07d' % index))
+        start = time.monotonic()
+        try:
+            send(device=device, token='%06d' % index)
+        except Exception:
+            return None
+        return time.monotonic() - start
+
+    connections = server.connections
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(deliver, range(messages)))
+    duration = time.monotonic() - start
+
+    succeeded = sorted(latency for latency in latencies if latency is not None)
+    return {
+        'sent': len(succeeded),
+        'failed': messages - len(succeeded),
+        'connections': server.connections - connections,
+        'duration': duration,
+        'throughput': messages / duration,
+        'latency': {
+            'p50': statistics.median(succeeded) if succeeded else None,
+            'p95': succeeded[int(len(succeeded) * 0.95) - 1] if succeeded else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--method', choices=['send_sms', 'make_call'], default='send_sms')
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the server waits before answering')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of requests answered with an error')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Timeout of the Twilio HTTP client, in seconds')
+    args = parser.parse_args()
+
+    import django
+    from django.test.utils import override_settings
+    django.setup()
+
+    with override_settings(ALLOWED_HOSTS=['testserver'], **TWILIO_SETTINGS), \
+            FakeTwilioServer(latency=args.latency, error_rate=args.error_rate) as server:
+        results = run_load(server, args.method, args.messages, args.concurrency, args.timeout)
+
+    print('Sent %(sent)d, failed %(failed)d in %(duration).2fs (%(throughput).1f messages/s) '
+          'over %(connections)d connections' % results)
+    if results['sent']:
+        print('Latency: p50 %(p50).4fs, p95 %(p95).4fs' % results['latency'])
+
+
+if __name__ == '__main__':
+    main()
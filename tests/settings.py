@@ -100,6 +100,7 @@ EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
 DEFAULT_FROM_EMAIL = 'test@test.org'
 
 TWO_FACTOR_PHONE_THROTTLE_FACTOR = 10
+TWO_FACTOR_CHALLENGE_EXECUTOR = 'two_factor.challenges.SynchronousChallengeExecutor'
 OTP_TOTP_THROTTLE_FACTOR = 10
 
 OTP_EMAIL_COOLDOWN_DURATION = 0
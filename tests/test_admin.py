@@ -1,13 +1,16 @@
 from binascii import unhexlify
 
 from django.conf import settings
+from django.contrib.admin import AdminSite, ModelAdmin
 from django.shortcuts import resolve_url
-from django.test import TestCase
+from django.test import RequestFactory, TestCase
 from django.test.utils import override_settings
 from django.urls import reverse
 from django_otp.oath import totp
 
-from two_factor.admin import patch_admin, unpatch_admin
+from two_factor.admin import (
+    TwoFactorUserAdminMixin, patch_admin, unpatch_admin,
+)
 
 from .utils import UserMixin, method_registry
 
@@ -109,3 +112,19 @@ class OTPAdminSiteTest(UserMixin, TestCase):
         )
 
         self.assertRedirects(response, '/otp_admin/')
+
+
+class TwoFactorUserAdminMixinTest(UserMixin, TestCase):
+    def test_changelist_column(self):
+        class UserAdmin(TwoFactorUserAdminMixin, ModelAdmin):
+            list_display = ['pk']
+
+        model_admin = UserAdmin(self.User, AdminSite())
+        request = RequestFactory().get('/')
+        self.enable_otp(self.create_user())
+        self.create_user('other@example.com')
+
+        self.assertEqual(model_admin.get_list_display(request), ['pk', 'two_factor_enabled'])
+        with self.assertNumQueries(1):
+            users = list(model_admin.get_queryset(request).order_by('pk'))
+            self.assertEqual([model_admin.two_factor_enabled(user) for user in users], [True, False])
@@ -0,0 +1,12 @@
+from django.test import TestCase
+
+from .benchmarks import get_benchmarks, run_benchmark
+
+
+class BenchmarkTest(TestCase):
+    def test_benchmarks(self):
+        # Keeps the benchmarks working, their results are not checked
+        for benchmark_class in get_benchmarks():
+            with self.subTest(benchmark=benchmark_class.name):
+                result = run_benchmark(benchmark_class, number=2)
+                self.assertGreater(result['ops'], 0)
@@ -0,0 +1,124 @@
+import re
+from unittest import mock
+
+from django.conf import settings
+from django.core import mail
+from django.db import transaction
+from django.shortcuts import resolve_url
+from django.test import (
+    RequestFactory, TestCase, TransactionTestCase, override_settings,
+)
+from django.urls import reverse
+from django.utils import translation
+from django_otp.plugins.otp_email.models import EmailDevice
+
+from two_factor.challenges import (
+    ChallengeRequest, ThreadPoolChallengeExecutor, dispatch_challenge,
+)
+from two_factor.middleware.threadlocals import get_current_request
+from two_factor.signals import challenge_failed
+
+from .utils import UserMixin
+
+
+class ChallengeDispatchTest(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+
+    def test_synchronous(self):
+        device = mock.Mock()
+        self.assertTrue(dispatch_challenge(device, self.request))
+        device.generate_challenge.assert_called_once_with()
+
+    def test_failure(self):
+        device = mock.Mock()
+        device.generate_challenge.side_effect = ValueError('Gateway down')
+        receiver = mock.Mock()
+        challenge_failed.connect(receiver)
+        self.addCleanup(challenge_failed.disconnect, receiver)
+
+        with self.assertLogs('two_factor.challenges', 'ERROR'):
+            self.assertFalse(dispatch_challenge(device, self.request))
+        receiver.assert_called_once_with(signal=challenge_failed, sender='two_factor.challenges',
+                                         request=self.request, device=device,
+                                         exception=device.generate_challenge.side_effect)
+
+
+@override_settings(TWO_FACTOR_CHALLENGE_EXECUTOR='two_factor.challenges.ThreadPoolChallengeExecutor',
+                   OTP_EMAIL_THROTTLE_FACTOR=0)
+class ThreadPoolChallengeTest(UserMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.device = self.user.emaildevice_set.create(name='default')
+
+    def test_login(self):
+        context = {}
+
+        def generate_challenge(device):
+            context['device'] = device
+            context['request'] = get_current_request()
+            context['language'] = translation.get_language()
+            return original(device)
+
+        original = EmailDevice.generate_challenge
+        with mock.patch.object(EmailDevice, 'generate_challenge', autospec=True,
+                               side_effect=generate_challenge):
+            with translation.override('nl'):
+                response = self.client.post(reverse('two_factor:login'),
+                                            {'auth-username': 'bouke@example.com',
+                                             'auth-password': 'secret',
+                                             'login_view-current_step': 'auth'})
+            self.assertContains(response, 'Token:')
+            ThreadPoolChallengeExecutor.shutdown(wait=True)
+
+        self.assertEqual(len(mail.outbox), 1)
+        token = re.findall(r'[0-9]{6}', mail.outbox[0].body)[0]
+        self.assertEqual(context['device'], self.device)
+        self.assertEqual(context['language'], 'nl')
+        # The worker gets neither the request nor its device instance
+        self.assertIsInstance(context['request'], ChallengeRequest)
+        self.assertEqual(context['request'].build_absolute_uri('/twilio/'), 'http://testserver/twilio/')
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.token, token)
+
+        response = self.client.post(reverse('two_factor:login'),
+                                    {'token-otp_token': token,
+                                     'login_view-current_step': 'token'})
+        self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL))
+
+    def test_on_commit(self):
+        with mock.patch.object(EmailDevice, 'generate_challenge', autospec=True) as generate_challenge:
+            with transaction.atomic():
+                self.assertIsNone(dispatch_challenge(self.device, RequestFactory().get('/')))
+                ThreadPoolChallengeExecutor.shutdown(wait=True)
+                # Generated once the transaction is committed
+                generate_challenge.assert_not_called()
+            ThreadPoolChallengeExecutor.shutdown(wait=True)
+        generate_challenge.assert_called_once_with(self.device)
+
+    def test_unsaved_device(self):
+        device = EmailDevice(user=self.user, name='default')
+        self.assertTrue(dispatch_challenge(device, RequestFactory().get('/')))
+        # Generated during the request, as the worker couldn't load the device
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_deleted_device(self):
+        with mock.patch.object(EmailDevice, 'generate_challenge', autospec=True) as generate_challenge:
+            with transaction.atomic():
+                dispatch_challenge(self.device, RequestFactory().get('/'))
+                EmailDevice.objects.all().delete()
+            with self.assertLogs('two_factor.challenges', 'WARNING'):
+                ThreadPoolChallengeExecutor.shutdown(wait=True)
+        generate_challenge.assert_not_called()
+
+    @override_settings(TWO_FACTOR_CHALLENGE_MAX_WORKERS=1, TWO_FACTOR_CHALLENGE_MAX_PENDING=1)
+    def test_full(self):
+        _, pending = ThreadPoolChallengeExecutor.get_pool()
+        pending.acquire()
+        self.addCleanup(pending.release)
+
+        with mock.patch.object(EmailDevice, 'generate_challenge', autospec=True) as generate_challenge:
+            dispatch_challenge(self.device, RequestFactory().get('/'))
+            # Generated during the request when too many challenges are waiting
+            generate_challenge.assert_called_once_with(self.device)
@@ -2,9 +2,11 @@ import os
 from io import StringIO
 
 from django.core.management import CommandError, call_command
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django_otp import devices_for_user
 
+from two_factor.models import BackupDevice, TwoFactorStatus
+
 from .utils import UserMixin
 
 
@@ -80,3 +82,50 @@ class StatusCommandTest(UserMixin, TestCase):
         call_command('two_factor_status', 'user0@example.com', 'user1@example.com', stdout=stdout)
         self.assertEqual(stdout.getvalue(), 'user0@example.com: enabled\n'
                                             'user1@example.com: disabled\n')
+
+
+@override_settings(TWO_FACTOR_TRACK_STATUS=True)
+class BackfillStatusCommandTest(UserMixin, TestCase):
+    def test_backfill(self):
+        users = [self.create_user(n) for n in ['user0@example.com', 'user1@example.com']]
+        # Devices created before tracking was enabled aren't reflected
+        with self.settings(TWO_FACTOR_TRACK_STATUS=False):
+            self.enable_otp(users[0])
+
+        stdout = StringIO()
+        call_command('two_factor_backfill_status', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Updated the two-factor status of 2 user(s)\n')
+        self.assertTrue(TwoFactorStatus.objects.get(pk=users[0].pk).enabled)
+        self.assertFalse(TwoFactorStatus.objects.get(pk=users[1].pk).enabled)
+
+        stdout = StringIO()
+        call_command('two_factor_backfill_status', 'user1@example.com', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Updated the two-factor status of 1 user(s)\n')
+
+
+class HashBackupTokensCommandTest(UserMixin, TestCase):
+    def test_raises(self):
+        with self.assertRaisesMessage(CommandError, 'TWO_FACTOR_HASH_BACKUP_TOKENS'):
+            call_command('two_factor_hash_backup_tokens')
+
+    @override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True)
+    def test_hash(self):
+        users = [self.create_user(n) for n in ['user0@example.com', 'user1@example.com']]
+        for user in users:
+            device = user.staticdevice_set.create(name='backup')
+            device.token_set.create(token='abcdef12')
+            device.token_set.create(token='ghijkl34')
+
+        stdout = StringIO()
+        call_command('two_factor_hash_backup_tokens', 'user0@example.com', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Hashed 2 backup token(s)\n')
+        device = BackupDevice.objects.get(user=users[0])
+        self.assertFalse(device.token_set.exists())
+        self.assertEqual(device.hashed_token_set.count(), 2)
+        self.assertTrue(device.verify_token('ghijkl34'))
+        self.assertEqual(users[1].staticdevice_set.get().token_set.count(), 2)
+
+        stdout = StringIO()
+        call_command('two_factor_hash_backup_tokens', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Hashed 2 backup token(s)\n')
+        self.assertEqual(users[1].staticdevice_set.get().hashed_token_set.count(), 2)
@@ -1,4 +1,4 @@
-from unittest.mock import Mock, patch
+from unittest.mock import ANY, Mock, patch
 from urllib.parse import urlencode
 from xml.etree import ElementTree
 
@@ -7,10 +7,19 @@ from django.test import TestCase
 from django.test.utils import override_settings
 from django.urls import reverse
 from django.utils import translation
+from freezegun import freeze_time
 from phonenumber_field.phonenumber import PhoneNumber
 
+from two_factor.gateways import (
+    get_gateway, make_call, reset_gateways, send_sms,
+)
 from two_factor.gateways.fake import Fake
-from two_factor.gateways.twilio.gateway import Twilio
+from two_factor.gateways.instrumentation import gateway_stats
+from two_factor.gateways.twilio.gateway import Twilio, get_voice_locale
+from two_factor.signals import gateway_called
+
+from .gateway_load import TWILIO_SETTINGS, run_load
+from .twilio_server import FakeTwilioServer
 
 
 class TwilioGatewayTest(TestCase):
@@ -75,6 +84,25 @@ class TwilioGatewayTest(TestCase):
         response = self.client.get('%s?%s' % (url, urlencode({'locale': 'fy-nl'})))
         self.assertContains(response, '<Say language="en">')
 
+    def test_call_app_cached(self):
+        url = reverse('two_factor_twilio:call_app', args=['123456'])
+        with patch('two_factor.gateways.twilio.gateway.pgettext', return_value='en') as pgettext:
+            get_voice_locale.cache_clear()
+            self.assertContains(self.client.get('%s?locale=nl' % url), 'Hi, this is testserver calling.')
+            self.assertContains(self.client.get('%s?locale=nl' % url), 'Hi, this is testserver calling.')
+            self.assertContains(self.client.post('%s?locale=nl' % url), '<Say language="en">6</Say>')
+            self.assertContains(self.client.get('%s?locale=en-gb' % url), 'Hi, this is testserver calling.')
+        # The voice locale is translated once per locale
+        self.assertEqual(pgettext.call_count, 2)
+        get_voice_locale.cache_clear()
+
+    def test_call_app_context_processors(self):
+        url = reverse('two_factor_twilio:call_app', args=['123456'])
+        response = self.client.get(url)
+        # The templates are rendered with the request context
+        self.assertIn('user', response.context)
+        self.assertIn('LANGUAGE_CODE', response.context)
+
     @override_settings(
         TWILIO_ACCOUNT_SID='SID',
         TWILIO_AUTH_TOKEN='TOKEN',
@@ -199,3 +227,268 @@ class FakeGatewayTest(TestCase):
             logger.info.assert_called_with(
                 'Fake SMS to %s: "Your token is: %s"', '+123', code)
 
+
+class GatewayPoolTest(TestCase):
+    def setUp(self):
+        reset_gateways()
+
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+    def test_gateway_reused(self):
+        gateway = get_gateway('two_factor.gateways.fake.Fake')
+        self.assertIsInstance(gateway, Fake)
+        self.assertIs(get_gateway('two_factor.gateways.fake.Fake'), gateway)
+
+        with patch('two_factor.gateways.fake.Fake') as fake:
+            device = Mock(number=PhoneNumber.from_string('+123'))
+            send_sms(device=device, token='123456')
+            send_sms(device=device, token='654321')
+            fake.assert_called_once_with()
+            self.assertEqual(fake.return_value.send_sms.call_count, 2)
+
+    @patch('two_factor.gateways.twilio.gateway.Client')
+    @override_settings(TWILIO_ACCOUNT_SID='SID', TWILIO_AUTH_TOKEN='TOKEN')
+    def test_reset_on_setting_changed(self, client):
+        gateway = get_gateway('two_factor.gateways.twilio.gateway.Twilio')
+        self.assertIs(get_gateway('two_factor.gateways.twilio.gateway.Twilio'), gateway)
+        with self.settings(TWILIO_AUTH_TOKEN='OTHER'):
+            self.assertIsNot(get_gateway('two_factor.gateways.twilio.gateway.Twilio'), gateway)
+        client.assert_called_with('SID', 'OTHER')
+
+
+class StandIn:
+    """
+    Local stand-in for a provider, taking `latency` seconds of the frozen
+    clock and raising for its first `failures` messages.
+    """
+    clock = None
+    latency = 0
+    failures = 0
+    messages = None
+
+    def send_sms(self, device, token):
+        cls = type(self)
+        cls.clock.tick(cls.latency)
+        if cls.failures:
+            cls.failures -= 1
+            raise ConnectionError('%s is down' % cls.__name__)
+        cls.messages.append(token)
+
+
+class Primary(StandIn):
+    pass
+
+
+class Secondary(StandIn):
+    def make_call(self, device, token):
+        self.send_sms(device, token)
+
+
+@override_settings(
+    TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.router.Router',
+    TWO_FACTOR_GATEWAY_ROUTER_PROVIDERS=['tests.test_gateways.Primary', 'tests.test_gateways.Secondary'],
+    TWO_FACTOR_GATEWAY_ROUTER_FAILURE_THRESHOLD=2,
+    TWO_FACTOR_GATEWAY_ROUTER_RECOVERY_TIMEOUT=30,
+)
+class RouterGatewayTest(TestCase):
+    def setUp(self):
+        reset_gateways()
+        self.device = Mock(number=PhoneNumber.from_string('+123'))
+        for stand_in in (Primary, Secondary):
+            stand_in.latency, stand_in.failures, stand_in.messages = 1, 0, []
+        freezer = freeze_time('2023-01-01')
+        clock = freezer.start()
+        self.addCleanup(freezer.stop)
+        Primary.clock = Secondary.clock = clock
+
+    def test_preference_order(self):
+        send_sms(device=self.device, token='123456')
+        self.assertEqual(Primary.messages, ['123456'])
+        self.assertEqual(Secondary.messages, [])
+
+    def test_failover(self):
+        Primary.failures = 1
+        with self.assertLogs('two_factor.gateways.router', 'WARNING'):
+            send_sms(device=self.device, token='123456')
+        self.assertEqual(Primary.messages, [])
+        self.assertEqual(Secondary.messages, ['123456'])
+
+    def test_all_failing(self):
+        Primary.failures = Secondary.failures = 1
+        with self.assertLogs('two_factor.gateways.router', 'WARNING'):
+            with self.assertRaisesMessage(ConnectionError, 'Secondary is down'):
+                send_sms(device=self.device, token='123456')
+
+    def test_latency(self):
+        Primary.latency = 5
+        send_sms(device=self.device, token='123456')
+        Primary.failures = 1
+        with self.assertLogs('two_factor.gateways.router', 'WARNING'):
+            send_sms(device=self.device, token='654321')
+        self.assertEqual(Primary.messages, ['123456'])
+        self.assertEqual(Secondary.messages, ['654321'])
+
+        # Secondary is faster than the slow and failing primary
+        send_sms(device=self.device, token='111111')
+        self.assertEqual(Secondary.messages, ['654321', '111111'])
+
+    def test_circuit_breaker(self):
+        Primary.failures = 3
+        Secondary.latency = 5
+        with self.assertLogs('two_factor.gateways.router', 'WARNING') as logs:
+            send_sms(device=self.device, token='123456')
+            send_sms(device=self.device, token='654321')
+        self.assertIn('Opening the circuit breaker of gateway tests.test_gateways.Primary.', logs.output[-2])
+        self.assertEqual(Primary.failures, 1)
+
+        # Primary is skipped while its circuit breaker is open
+        send_sms(device=self.device, token='111111')
+        self.assertEqual(Primary.failures, 1)
+        self.assertEqual(Secondary.messages, ['123456', '654321', '111111'])
+
+        # A single message probes it after the recovery timeout
+        Primary.clock.tick(30)
+        with self.assertLogs('two_factor.gateways.router', 'WARNING'):
+            send_sms(device=self.device, token='222222')
+        self.assertEqual(Secondary.messages[-1], '222222')
+        Primary.clock.tick(30)
+        send_sms(device=self.device, token='333333')
+        self.assertEqual(Primary.messages, ['333333'])
+
+    def test_unsupported_method(self):
+        with self.settings(TWO_FACTOR_CALL_GATEWAY='two_factor.gateways.router.Router'):
+            make_call(device=self.device, token='123456')
+        self.assertEqual(Secondary.messages, ['123456'])
+        with self.assertRaises(NotImplementedError):
+            get_gateway('two_factor.gateways.router.Router').send_whatsapp(device=self.device, token='123456')
+
+    def test_gateways_resolved_outside_lock(self):
+        router = get_gateway('two_factor.gateways.router.Router')
+        reset_gateways()
+
+        def resolve(path):
+            self.assertFalse(router.lock.locked())
+            return get_gateway(path)
+
+        with patch.object(router, 'get_gateway', side_effect=resolve) as resolver:
+            router.send_sms(device=self.device, token='123456')
+        self.assertTrue(resolver.called)
+        self.assertEqual(Primary.messages, ['123456'])
+
+
+@override_settings(TWO_FACTOR_SMS_GATEWAY='tests.test_gateways.Primary')
+class GatewayInstrumentationTest(TestCase):
+    def setUp(self):
+        reset_gateways()
+        gateway_stats.reset()
+        self.device = Mock(number=PhoneNumber.from_string('+31101234567'))
+        Primary.latency, Primary.failures, Primary.messages = 0.2, 0, []
+        freezer = freeze_time('2023-01-01')
+        Primary.clock = freezer.start()
+        self.addCleanup(freezer.stop)
+        self.receiver = Mock()
+        gateway_called.connect(self.receiver)
+        self.addCleanup(gateway_called.disconnect, self.receiver)
+
+    def test_success(self):
+        send_sms(device=self.device, token='123456')
+        self.receiver.assert_called_once_with(
+            signal=gateway_called, sender='two_factor.gateways.instrumentation',
+            channel='sms', gateway='tests.test_gateways.Primary', country_code=31,
+            duration=ANY, exception=None)
+        self.assertAlmostEqual(self.receiver.call_args.kwargs['duration'], 0.2, places=3)
+
+        stats = gateway_stats.snapshot()[('sms', 'tests.test_gateways.Primary')]
+        self.assertEqual(stats['calls'], 1)
+        self.assertEqual(stats['failures'], 0)
+        self.assertAlmostEqual(stats['duration'], 0.2, places=3)
+        self.assertEqual(stats['buckets'][0.25], 1)
+        self.assertEqual(sum(stats['buckets'].values()), 1)
+
+    def test_failure(self):
+        Primary.failures = 1
+        with self.assertRaises(ConnectionError) as cm:
+            send_sms(device=self.device, token='123456')
+        self.assertIs(self.receiver.call_args.kwargs['exception'], cm.exception)
+
+        send_sms(device=self.device, token='123456')
+        stats = gateway_stats.snapshot()[('sms', 'tests.test_gateways.Primary')]
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['failures'], 1)
+
+    def failing_receiver(self, **kwargs):
+        raise ValueError('Metrics backend down')
+
+    def test_receiver_error(self):
+        gateway_called.connect(self.failing_receiver)
+        self.addCleanup(gateway_called.disconnect, self.failing_receiver)
+        with self.assertLogs('two_factor.gateways.instrumentation', 'ERROR'):
+            send_sms(device=self.device, token='123456')
+        self.assertEqual(len(Primary.messages), 1)
+
+        # The exception of the gateway is raised, not the receiver's
+        Primary.failures = 1
+        with self.assertLogs('two_factor.gateways.instrumentation', 'ERROR'):
+            with self.assertRaises(ConnectionError):
+                send_sms(device=self.device, token='123456')
+
+    @override_settings(
+        TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.router.Router',
+        TWO_FACTOR_GATEWAY_ROUTER_PROVIDERS=['tests.test_gateways.Primary', 'tests.test_gateways.Secondary'],
+    )
+    def test_router_receiver_error(self):
+        Secondary.latency, Secondary.failures, Secondary.messages = 0.2, 0, []
+        Secondary.clock = Primary.clock
+        gateway_called.connect(self.failing_receiver)
+        self.addCleanup(gateway_called.disconnect, self.failing_receiver)
+        with self.assertLogs('two_factor.gateways.instrumentation', 'ERROR'):
+            send_sms(device=self.device, token='123456')
+        # The router doesn't fail over, the message is sent once
+        self.assertEqual(len(Primary.messages), 1)
+        self.assertEqual(Secondary.messages, [])
+
+    @override_settings(
+        TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.router.Router',
+        TWO_FACTOR_GATEWAY_ROUTER_PROVIDERS=['tests.test_gateways.Primary'],
+    )
+    def test_router(self):
+        send_sms(device=self.device, token='123456')
+        # Both the router and the provider it picked are recorded
+        self.assertEqual(set(gateway_stats.snapshot()), {
+            ('sms', 'two_factor.gateways.router.Router'),
+            ('sms', 'tests.test_gateways.Primary'),
+        })
+
+
+@override_settings(**TWILIO_SETTINGS)
+class TwilioServerTest(TestCase):
+    def setUp(self):
+        reset_gateways()
+        self.server = FakeTwilioServer(seed=1).start()
+        self.addCleanup(self.server.stop)
+
+    def test_gateway(self):
+        gateway = get_gateway('two_factor.gateways.twilio.gateway.Twilio')
+        self.server.patch_client(gateway.client)
+        send_sms(device=Mock(number=PhoneNumber.from_string('+31101234567')), token='123456')
+        self.assertEqual(self.server.requests, [('Messages', {
+            'To': '+31101234567',
+            'Body': '\nYour OTP token is 123456\n\n',
+            'From': '+15005550006',
+        })])
+
+    def test_load(self):
+        results = run_load(self.server, 'send_sms', messages=20, concurrency=4)
+        self.assertEqual(results['sent'], 20)
+        # Connections are reused between messages
+        self.assertLessEqual(results['connections'], 4)
+
+        self.server.error_rate = 0.5
+        results = run_load(self.server, 'make_call', messages=20, concurrency=4)
+        self.assertEqual(results['sent'] + results['failed'], 20)
+        self.assertGreater(results['failed'], 0)
+        self.assertEqual(self.server.requests[-1][0], 'Calls')
+
+    def test_timeout(self):
+        self.server.latency = 0.2
+        results = run_load(self.server, 'send_sms', messages=2, concurrency=2, timeout=0.05)
+        self.assertEqual(results['failed'], 2)
@@ -0,0 +1,156 @@
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django_otp.util import random_hex
+from freezegun import freeze_time
+
+from two_factor.ratelimit import (
+    SlidingWindowRateLimiter, TokenBucket, take_tokens,
+)
+
+from .utils import UserMixin
+
+
+class SlidingWindowRateLimiterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_hit(self):
+        limiter = SlidingWindowRateLimiter(limit=2, window=60)
+        with freeze_time('2023-01-01 10:00:00') as frozen_time:
+            self.assertFalse(limiter.hit('key'))
+            self.assertFalse(limiter.hit('key'))
+            self.assertTrue(limiter.hit('key'))
+            self.assertFalse(limiter.hit('other'))
+
+            # Half of the previous window still counts
+            frozen_time.tick(90)
+            self.assertTrue(limiter.hit('key'))
+
+            frozen_time.tick(60)
+            self.assertFalse(limiter.hit('key'))
+
+
+class SlowCache:
+    """
+    Cache proxy yielding to the other threads before each operation.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __getattr__(self, name):
+        method = getattr(self.cache, name)
+
+        def slow(*args, **kwargs):
+            time.sleep(0.001)
+            return method(*args, **kwargs)
+        return slow
+
+
+class TokenBucketTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_take_tokens(self):
+        bucket = TokenBucket(capacity=2, period=60)
+        other = TokenBucket(capacity=1, period=60)
+        with freeze_time('2023-01-01 10:00:00') as frozen_time:
+            self.assertTrue(take_tokens([(bucket, 'key')]))
+            self.assertTrue(take_tokens([(bucket, 'key'), (other, 'key')]))
+            self.assertFalse(take_tokens([(bucket, 'key')]))
+            self.assertTrue(take_tokens([(bucket, 'other')]))
+
+            # No token is taken when one of the buckets is empty
+            frozen_time.tick(30)
+            self.assertFalse(take_tokens([(bucket, 'key'), (other, 'key')]))
+            self.assertTrue(take_tokens([(bucket, 'key')]))
+            self.assertFalse(take_tokens([(bucket, 'key')]))
+
+            frozen_time.tick(60)
+            self.assertTrue(take_tokens([(bucket, 'key'), (other, 'key')]))
+
+    def test_refill_capacity(self):
+        bucket = TokenBucket(capacity=2, period=60)
+        with freeze_time('2023-01-01 10:00:00') as frozen_time:
+            self.assertTrue(take_tokens([(bucket, 'key')]))
+
+            # Unused tokens don't accumulate beyond the capacity
+            frozen_time.tick(50)
+            self.assertTrue(take_tokens([(bucket, 'key')]))
+            self.assertTrue(take_tokens([(bucket, 'key')]))
+            self.assertFalse(take_tokens([(bucket, 'key')]))
+
+    def test_concurrent_takes(self):
+        bucket = TokenBucket(capacity=10, period=3600)
+        barrier = threading.Barrier(8)
+        results = []
+
+        def take():
+            barrier.wait()
+            for _ in range(5):
+                results.append(take_tokens([(bucket, 'key')]))
+
+        threads = [threading.Thread(target=take) for _ in range(8)]
+        with mock.patch('two_factor.ratelimit.get_cache', return_value=SlowCache(cache)):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results.count(True), 10)
+
+
+@override_settings(TWO_FACTOR_LOGIN_RATE_LIMITS=[
+    ('two_factor.ratelimit.client_ip_key', 3, 60),
+    ('two_factor.ratelimit.user_key', 2, 60),
+])
+class LoginRateLimitTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = self.create_user()
+        self.enable_otp()
+
+    def _post(self, data=None):
+        return self.client.post(reverse('two_factor:login'), data=data)
+
+    def _post_token(self):
+        return self._post({'token-otp_token': '123456',
+                           'login_view-current_step': 'token'})
+
+    def test_token_step(self):
+        for _ in range(4):
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+            self.assertContains(response, 'Token:')
+
+        self.assertContains(self._post_token(), 'Token:')
+        self.assertContains(self._post_token(), 'Token:')
+        with mock.patch('two_factor.views.core.LoginView.get_device') as get_device:
+            response = self._post_token()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+        get_device.assert_not_called()
+
+    def test_client_ip(self):
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        self.assertContains(self._post_token(), 'Token:')
+
+        # Another account, from the same IP address
+        self.client = self.client_class()
+        other = self.create_user(username='other@example.com')
+        other.totpdevice_set.create(name='default', key=random_hex())
+        self._post({'auth-username': 'other@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        self._post({'backup-otp_token': 'abcdef',
+                    'login_view-current_step': 'backup'})
+        self._post_token()
+        self.assertEqual(self._post_token().status_code, 429)
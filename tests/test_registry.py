@@ -1,9 +1,15 @@
 from django.test import TestCase
+from django.urls import reverse
+from django_otp.plugins.otp_totp.models import TOTPDevice
 
+from two_factor.plugins.phonenumber.method import PhoneCallMethod, SMSMethod
+from two_factor.plugins.phonenumber.models import PhoneDevice
 from two_factor.plugins.registry import (
     GeneratorMethod, MethodBase, MethodNotFoundError, registry,
 )
 
+from .utils import UserMixin
+
 
 class FakeMethod(MethodBase):
     code = 'fake-method'
@@ -49,3 +55,93 @@ class RegistryTest(TestCase):
     def test_unknown_method(self):
         with self.assertRaises(MethodNotFoundError):
             registry.get_method("not-existing-method")
+
+    def test_get_method_follows_registrations(self):
+        method = FakeMethod()
+        registry.register(method)
+        self.assertIs(registry.get_method('fake-method'), method)
+
+        registry.unregister('fake-method')
+        with self.assertRaises(MethodNotFoundError):
+            registry.get_method('fake-method')
+
+    def test_get_methods_is_read_only(self):
+        methods = registry.get_methods()
+        with self.assertRaises(AttributeError):
+            methods.append(FakeMethod())
+        registry.register(FakeMethod())
+        self.assertNotIn('fake-method', [m.code for m in methods])
+        self.assertIs(registry.get_methods()[-1], registry.get_method('fake-method'))
+
+    def test_method_from_device(self):
+        device = TOTPDevice(name='default')
+        method = registry.method_from_device(device)
+        self.assertIs(method, registry.get_method('generator'))
+        self.assertIs(registry.method_from_device(device), method)
+
+        phone_methods = [PhoneCallMethod(), SMSMethod()]
+        registry._methods = [GeneratorMethod()] + phone_methods
+        for phone_method in phone_methods:
+            with self.subTest(code=phone_method.code):
+                device = PhoneDevice(method=phone_method.code)
+                self.assertIs(registry.method_from_device(device), phone_method)
+
+        registry.unregister('sms')
+        self.assertIsInstance(registry.method_from_device(PhoneDevice(method='sms')), GeneratorMethod)
+
+
+class GetAllDevicesTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.old_methods = list(registry._methods)
+        registry._methods = [GeneratorMethod(), PhoneCallMethod(), SMSMethod()]
+
+    def tearDown(self):
+        registry._methods = self.old_methods
+        super().tearDown()
+
+    def test_get_all_devices(self):
+        user = self.create_user()
+        totp = user.totpdevice_set.create(name='default')
+        call = user.phonedevice_set.create(name='backup', number='+12024561111', method='call')
+        sms = user.phonedevice_set.create(name='backup', number='+12024561111', method='sms')
+        user.phonedevice_set.create(name='backup', number='+12024561111', method='whatsapp')
+
+        # One query per device model, not one per method.
+        with self.assertNumQueries(2):
+            all_devices = registry.get_all_devices(user)
+
+        self.assertEqual(list(all_devices), ['generator', 'call', 'sms'])
+        self.assertEqual(all_devices['generator'], [totp])
+        self.assertEqual(all_devices['call'], [call])
+        self.assertEqual(all_devices['sms'], [sms])
+
+    def test_get_devices_override(self):
+        class ConfirmedGeneratorMethod(GeneratorMethod):
+            code = 'confirmed-generator'
+
+            def get_devices(self, user):
+                return user.totpdevice_set.filter(confirmed=True)
+
+        registry._methods = [ConfirmedGeneratorMethod()]
+        user = self.create_user()
+        confirmed = user.totpdevice_set.create(name='default')
+        user.totpdevice_set.create(name='backup', confirmed=False)
+        self.assertEqual(registry.get_all_devices(user), {'confirmed-generator': [confirmed]})
+
+    def test_other_authentication_devices_override(self):
+        # Methods overriding the method with its original signature
+        class OtherGeneratorMethod(GeneratorMethod):
+            def get_other_authentication_devices(self, user, main_device):
+                return list(super().get_other_authentication_devices(user, main_device))
+
+        registry._methods = [OtherGeneratorMethod()]
+        user = self.create_user()
+        user.totpdevice_set.create(name='default')
+        backup = user.totpdevice_set.create(name='backup')
+        response = self.client.post(reverse('two_factor:login'), {
+            'auth-username': 'bouke@example.com',
+            'auth-password': 'secret',
+            'login_view-current_step': 'auth',
+        })
+        self.assertEqual(response.context_data['other_devices'], [backup])
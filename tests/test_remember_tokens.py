@@ -0,0 +1,155 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django_otp.util import random_hex
+from freezegun import freeze_time
+
+from two_factor.models import RememberedDevice
+from two_factor.views.utils import validate_remember_device_cookie
+
+from .utils import UserMixin, totp_str
+
+
+@override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60, TWO_FACTOR_REMEMBER_TOKEN_STORE=True)
+class RememberedDeviceTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = self.create_user()
+        self.device = self.user.totpdevice_set.create(name='default', key=random_hex())
+
+    def test_lookup_is_cached(self):
+        token = RememberedDevice.objects.issue(self.user, self.device)
+        cache.clear()
+        with self.assertNumQueries(1):
+            entry = RememberedDevice.objects.lookup(token)
+        with self.assertNumQueries(0):
+            self.assertEqual(RememberedDevice.objects.lookup(token), entry)
+        self.assertEqual(entry['user_id'], self.user.pk)
+        self.assertEqual(entry['device_id'], self.device.persistent_id)
+        self.assertIsNone(RememberedDevice.objects.lookup('unknown'))
+
+    def test_revoke(self):
+        token = RememberedDevice.objects.issue(self.user, self.device)
+        self.assertIsNotNone(RememberedDevice.objects.lookup(token))
+        self.assertEqual(self.user.remembered_devices.all().revoke(), 1)
+        self.assertIsNone(RememberedDevice.objects.lookup(token))
+
+    def test_expired(self):
+        token = RememberedDevice.objects.issue(self.user, self.device)
+        with freeze_time(timezone.now() + timedelta(hours=2)):
+            self.assertIsNone(RememberedDevice.objects.lookup(token))
+
+    @override_settings(TWO_FACTOR_REMEMBER_TOKEN_MAX_PER_USER=2)
+    def test_max_per_user(self):
+        tokens = []
+        for minutes in range(3):
+            with freeze_time(timezone.now() + timedelta(minutes=minutes)):
+                tokens.append(RememberedDevice.objects.issue(self.user, self.device))
+        self.assertEqual(self.user.remembered_devices.count(), 2)
+        self.assertIsNone(RememberedDevice.objects.lookup(tokens[0]))
+        self.assertIsNotNone(RememberedDevice.objects.lookup(tokens[2]))
+
+    def test_device_deleted(self):
+        token = RememberedDevice.objects.issue(self.user, self.device)
+        self.device.delete()
+        self.assertIsNone(RememberedDevice.objects.lookup(token))
+
+    def test_touch(self):
+        token = RememberedDevice.objects.issue(self.user, self.device)
+        entry = RememberedDevice.objects.lookup(token)
+        with self.assertNumQueries(0):
+            RememberedDevice.objects.touch(token, entry)
+        with freeze_time(timezone.now() + timedelta(minutes=10)):
+            with self.assertNumQueries(1):
+                RememberedDevice.objects.touch(token, entry)
+            self.assertEqual(RememberedDevice.objects.lookup(token)['last_seen'], timezone.now().timestamp())
+
+
+@override_settings(ROOT_URLCONF='tests.urls_admin', TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60,
+                   TWO_FACTOR_REMEMBER_TOKEN_STORE=True)
+class RememberTokenLoginTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = self.create_user()
+        self.device = self.user.totpdevice_set.create(name='default', key=random_hex())
+
+    def _post(self, data=None):
+        return self.client.post(reverse('two_factor:login'), data=data)
+
+    def _login(self):
+        return self._post({'auth-username': 'bouke@example.com',
+                           'auth-password': 'secret',
+                           'login_view-current_step': 'auth'})
+
+    def _remember(self):
+        self._login()
+        self._post({'token-otp_token': totp_str(self.device.bin_key),
+                    'login_view-current_step': 'token',
+                    'token-remember': 'on'})
+        self.client.post(reverse('logout'))
+
+    def test_remembered_login(self):
+        self._remember()
+        self.assertEqual(self.user.remembered_devices.count(), 1)
+
+        with mock.patch('two_factor.views.core.validate_remember_device_cookie',
+                        wraps=validate_remember_device_cookie) as validate_mock:
+            response = self._login()
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        validate_mock.assert_not_called()
+
+    def test_forget_browsers(self):
+        self._remember()
+        response = self._login()
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        self.assertContains(self.client.get(reverse('two_factor:profile')), 'Remembered Browsers')
+
+        response = self.client.post(reverse('two_factor:forget_browsers'))
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        self.assertFalse(self.user.remembered_devices.exists())
+
+        self.client.post(reverse('logout'))
+        response = self._login()
+        self.assertContains(response, 'Token:')
+
+    def test_password_change(self):
+        self._remember()
+        self.user.set_password('secret')
+        self.user.save()
+
+        response = self._login()
+        self.assertContains(response, 'Token:')
+
+    def test_revoked_token_does_not_throttle(self):
+        self._remember()
+        self.user.remembered_devices.all().revoke()
+
+        response = self._login()
+        self.assertContains(response, 'Token:')
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.throttling_failure_count, 0)
+
+    def test_signed_cookie_rejected(self):
+        with self.settings(TWO_FACTOR_REMEMBER_TOKEN_STORE=False):
+            self._remember()
+            self.assertFalse(self.user.remembered_devices.exists())
+
+        # Signed cookies can't be forgotten, so they aren't accepted
+        response = self._login()
+        self.assertContains(response, 'Token:')
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.throttling_failure_count, 0)
+
+    def test_token_after_disabling_store(self):
+        self._remember()
+        with self.settings(TWO_FACTOR_REMEMBER_TOKEN_STORE=False):
+            response = self._login()
+        self.assertContains(response, 'Token:')
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.throttling_failure_count, 0)
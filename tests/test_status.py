@@ -0,0 +1,72 @@
+from django.test import TestCase, override_settings
+
+from two_factor.models import TwoFactorStatus
+from two_factor.utils import default_device, two_factor_enabled
+
+from .utils import UserMixin
+
+
+@override_settings(TWO_FACTOR_TRACK_STATUS=True)
+class TwoFactorStatusTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+
+    def get_status(self):
+        return TwoFactorStatus.objects.get(pk=self.user.pk)
+
+    def test_tracks_default_device(self):
+        self.assertFalse(TwoFactorStatus.objects.filter(pk=self.user.pk).exists())
+
+        backup = self.user.phonedevice_set.create(name='backup', number='+12024561111', method='call')
+        self.assertFalse(self.get_status().enabled)
+
+        device = self.enable_otp()
+        status = self.get_status()
+        self.assertTrue(status.enabled)
+        self.assertEqual(status.get_device(), device)
+        self.assertEqual(status.method, 'generator')
+
+        backup.delete()
+        self.assertTrue(self.get_status().enabled)
+
+        device.confirmed = False
+        device.save()
+        self.assertFalse(self.get_status().enabled)
+
+        device.confirmed = True
+        device.save()
+        self.assertTrue(self.get_status().enabled)
+
+        device.delete()
+        self.assertFalse(self.get_status().enabled)
+
+    def test_throttle_writes_skip_status(self):
+        device = self.enable_otp()
+        with self.assertNumQueries(1):
+            device.save(update_fields=['throttling_failure_count'])
+
+    def test_two_factor_enabled(self):
+        self.assertFalse(two_factor_enabled(self.user))
+        device = self.enable_otp()
+        user = self.User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(two_factor_enabled(user))
+        with self.assertNumQueries(2):
+            self.assertEqual(default_device(user), device)
+
+    def test_missing_status_not_stored(self):
+        with self.settings(TWO_FACTOR_TRACK_STATUS=False):
+            device = self.enable_otp()
+        self.assertTrue(two_factor_enabled(self.user))
+        self.assertEqual(default_device(self.user), device)
+        # Reading the status doesn't write it, the signals do
+        self.assertFalse(TwoFactorStatus.objects.filter(pk=self.user.pk).exists())
+        device.save()
+        self.assertEqual(self.get_status().device_id, str(device.pk))
+
+    def test_user_deletion(self):
+        self.enable_otp()
+        self.get_status()
+        self.user.delete()
+        self.assertFalse(TwoFactorStatus.objects.exists())
@@ -0,0 +1,110 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django_otp.oath import totp
+from freezegun import freeze_time
+
+from two_factor.plugins.phonenumber.models import PhoneDevice
+from two_factor.throttling import (
+    CacheThrottleBackend, ModelThrottleBackend, get_throttle_backend,
+)
+
+from .utils import UserMixin
+
+
+class ThrottleBackendTest(TestCase):
+    def test_default_backend(self):
+        self.assertIsInstance(get_throttle_backend(), ModelThrottleBackend)
+        with self.settings(TWO_FACTOR_THROTTLE_BACKEND='two_factor.throttling.CacheThrottleBackend'):
+            self.assertIsInstance(get_throttle_backend(), CacheThrottleBackend)
+
+    def test_backend_reused(self):
+        backend = get_throttle_backend()
+        with mock.patch('two_factor.throttling.import_string') as import_string:
+            self.assertIs(get_throttle_backend(), backend)
+        import_string.assert_not_called()
+        with self.settings(TWO_FACTOR_THROTTLE_BACKEND='two_factor.throttling.ModelThrottleBackend'):
+            self.assertIsNot(get_throttle_backend(), backend)
+
+
+@override_settings(TWO_FACTOR_THROTTLE_BACKEND='two_factor.throttling.CacheThrottleBackend')
+class CacheThrottleBackendTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = self.create_user()
+        self.device = self.user.phonedevice_set.create(name='default', number='+12024561111', method='sms')
+
+    def test_failures_are_cached(self):
+        with freeze_time("2023-01-01") as frozen_time:
+            with self.assertNumQueries(0):
+                self.assertFalse(self.device.verify_token(-1))
+                frozen_time.tick(10)
+                self.assertFalse(self.device.verify_token(-1))
+
+            # The row is untouched, other instances share the cached state
+            device = PhoneDevice.objects.get(pk=self.device.pk)
+            self.assertEqual(device.throttling_failure_count, 0)
+            verify_allowed, data = device.verify_is_allowed()
+            self.assertFalse(verify_allowed)
+            self.assertEqual(data['failure_count'], 2)
+
+            # TWO_FACTOR_PHONE_THROTTLE_FACTOR is 10, the second failure
+            # requires a delay of 20 seconds
+            frozen_time.tick(20)
+            self.assertEqual(device.verify_is_allowed(), (True, None))
+            self.assertTrue(device.verify_token(totp(device.bin_key)))
+            self.assertEqual(PhoneDevice.objects.get(pk=self.device.pk).verify_is_allowed(), (True, None))
+
+            # A clean throttle state is neither cached nor written
+            with self.assertNumQueries(0):
+                self.assertTrue(device.verify_token(totp(device.bin_key)))
+
+    @override_settings(TWO_FACTOR_THROTTLE_PERSIST_INTERVAL=60)
+    def test_persist_interval(self):
+        with freeze_time("2023-01-01") as frozen_time:
+            with self.assertNumQueries(1):
+                self.assertFalse(self.device.verify_token(-1))
+            frozen_time.tick(10)
+            with self.assertNumQueries(0):
+                self.assertFalse(self.device.verify_token(-1))
+            self.device.refresh_from_db()
+            self.assertEqual(self.device.throttling_failure_count, 1)
+
+            # The persisted state is used when the cache is lost
+            cache.clear()
+            device = PhoneDevice.objects.get(pk=self.device.pk)
+            self.assertEqual(device.verify_is_allowed(), (True, None))
+            self.assertFalse(device.verify_token(-1))
+            self.device.refresh_from_db()
+            self.assertEqual(self.device.throttling_failure_count, 2)
+
+            frozen_time.tick(20)
+            self.assertTrue(device.verify_token(totp(device.bin_key)))
+            self.device.refresh_from_db()
+            self.assertEqual(self.device.throttling_failure_count, 0)
+            self.assertIsNone(self.device.throttling_failure_timestamp)
+
+    def test_state_outlives_delay(self):
+        with freeze_time("2023-01-01") as frozen_time:
+            for _ in range(15):
+                self.device.throttle_increment()
+            # TWO_FACTOR_PHONE_THROTTLE_FACTOR is 10, 15 failures require a
+            # delay of 10 * 2 ** 14 seconds, almost two days
+            frozen_time.tick(10 * 2 ** 14 + 60 * 60)
+            device = PhoneDevice.objects.get(pk=self.device.pk)
+            self.assertEqual(device.verify_is_allowed(), (True, None))
+            self.assertEqual(device.throttling_failure_count, 15)
+
+        backend = CacheThrottleBackend()
+        self.assertEqual(backend.get_timeout(self.device, 0), backend.timeout)
+        self.assertEqual(backend.get_timeout(self.device, 15), 2 * 10 * 2 ** 14)
+        self.assertIsNone(backend.get_timeout(self.device, 40))
+
+    def test_reset_without_commit(self):
+        self.device.throttle_increment()
+        with self.assertNumQueries(0):
+            self.device.throttle_reset(commit=False)
+        self.assertEqual(self.device.throttling_failure_count, 0)
+        self.assertEqual(PhoneDevice.objects.get(pk=self.device.pk).throttling_failure_count, 0)
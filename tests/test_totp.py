@@ -0,0 +1,31 @@
+from django.test import SimpleTestCase
+from django_otp import oath
+from freezegun import freeze_time
+
+from two_factor.totp import hotp, match_totp, totp
+
+KEY = b'12345678901234567890'
+
+
+class TOTPTest(SimpleTestCase):
+    def test_hotp(self):
+        for counter in range(10):
+            for digits in (6, 8):
+                self.assertEqual(hotp(KEY, counter, digits), oath.hotp(KEY, counter, digits))
+
+    def test_totp(self):
+        for now in (0, 59, 1111111109, 2000000000):
+            self.assertEqual(totp(KEY, digits=8, now=now), oath.hotp(KEY, now // 30, 8))
+
+    @freeze_time('2023-01-01 10:00:10')
+    def test_totp_current_time(self):
+        self.assertEqual(totp(KEY), oath.totp(KEY))
+
+    def test_match_totp(self):
+        now = 1641194517
+        token = oath.hotp(KEY, now // 30 - 2)
+        self.assertEqual(match_totp(KEY, token, range(0, -6, -1), now=now), -2)
+        self.assertEqual(match_totp(KEY, str(token), range(0, -6, -1), now=now), -2)
+        self.assertEqual(match_totp(KEY, token, range(-1, 2), drift=-1, now=now), -1)
+        self.assertIsNone(match_totp(KEY, token, range(-1, 2), now=now))
+        self.assertIsNone(match_totp(KEY, 'foobar', range(-1, 2), now=now))
@@ -1,12 +1,17 @@
 import string
+from io import StringIO
 from unittest import mock
 from urllib.parse import parse_qsl, urlparse
 
 from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase, override_settings
 from django_otp.util import random_hex
+from freezegun import freeze_time
 from phonenumber_field.phonenumber import PhoneNumber
 
+from two_factor.models import BackupDevice
 from two_factor.plugins.email.utils import mask_email
 from two_factor.plugins.phonenumber.method import PhoneCallMethod, SMSMethod
 from two_factor.plugins.phonenumber.models import PhoneDevice
@@ -16,14 +21,18 @@ from two_factor.plugins.phonenumber.utils import (
 )
 from two_factor.plugins.registry import GeneratorMethod, MethodRegistry
 from two_factor.utils import (
-    USER_DEFAULT_DEVICE_ATTR_NAME, default_device, get_otpauth_url,
-    totp_digits,
+    USER_DEFAULT_DEVICE_ATTR_NAME, backup_tokens_remaining, default_device,
+    default_devices_for_users, device_snapshot, get_otpauth_url,
+    invalidate_device_snapshot, regenerate_backup_tokens, totp_digits,
+    with_two_factor_status,
 )
 from two_factor.views.utils import (
-    get_remember_device_cookie, validate_remember_device_cookie,
+    compile_remember_device_cookies, get_remember_device_cookie,
+    get_remember_device_cookie_key, hash_remember_device_cookie_key,
+    parse_remember_device_cookies, validate_remember_device_cookie,
 )
 
-from .utils import UserMixin
+from .utils import UserMixin, totp_str
 
 
 class UtilsTest(UserMixin, TestCase):
@@ -43,6 +52,27 @@ class UtilsTest(UserMixin, TestCase):
         self.assertEqual(default_device(user).pk, default.pk)
         self.assertEqual(getattr(user, USER_DEFAULT_DEVICE_ATTR_NAME).pk, default.pk)
 
+    def test_device_snapshot(self):
+        user = self.create_user()
+        backup = user.phonedevice_set.create(name='backup', number='+12024561111')
+        snapshot = device_snapshot(user)
+        self.assertIs(device_snapshot(user), snapshot)
+
+        snapshot.get_devices()
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot.get_devices(), [backup])
+            self.assertIsNone(default_device(user))
+
+        default = user.totpdevice_set.create(name='default')
+        # Still served from memory until invalidated
+        self.assertIsNone(default_device(user))
+        invalidate_device_snapshot(user)
+        self.assertEqual(default_device(user), default)
+
+        invalidate_device_snapshot(user)
+        default.delete()
+        self.assertIsNone(default_device(user))
+
     def test_get_otpauth_url(self):
         for num_digits in (6, 8):
             self.assertEqualUrl(
@@ -139,6 +169,18 @@ class UtilsTest(UserMixin, TestCase):
         )
         self.assertFalse(validation_result)
 
+    def test_remember_cookie_key(self):
+        user = mock.Mock()
+        user.pk = 123
+        user.password = make_password("xx")
+
+        cookie_value = get_remember_device_cookie(
+            user=user, otp_device_id="SomeModel/33"
+        )
+        self.assertEqual(get_remember_device_cookie_key(cookie_value),
+                         hash_remember_device_cookie_key("SomeModel/33"))
+        self.assertIsNone(get_remember_device_cookie_key("malformed"))
+
     def test_cookie_valid_characters(self):
         user = mock.Mock()
         user.pk = 123
@@ -150,6 +192,173 @@ class UtilsTest(UserMixin, TestCase):
         )
         self.assertTrue(all(c in allowed_characters for c in cookie_value))
 
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60)
+    def test_compile_remember_device_cookies(self):
+        user = mock.Mock()
+        user.pk = 123
+        user.password = make_password("xx")
+
+        with freeze_time("2024-01-01 10:00:00"):
+            expired = get_remember_device_cookie(user=user, otp_device_id="SomeModel/1")
+        with freeze_time("2024-01-01 11:30:00"):
+            old = get_remember_device_cookie(user=user, otp_device_id="SomeModel/2")
+            first = get_remember_device_cookie(user=user, otp_device_id="SomeModel/3")
+        with freeze_time("2024-01-01 11:40:00"):
+            second = get_remember_device_cookie(user=user, otp_device_id="SomeModel/4")
+            renewed = get_remember_device_cookie(user=user, otp_device_id="SomeModel/2")
+            compiled = compile_remember_device_cookies(
+                [expired, old, first, "garbage", second, renewed], max_entries=10)
+            self.assertEqual(parse_remember_device_cookies(compiled), [first, second, renewed])
+
+            # The least recently used cookies are evicted first
+            compiled = compile_remember_device_cookies([old, first, second], max_entries=2)
+            self.assertEqual(parse_remember_device_cookies(compiled), [first, second])
+
+        self.assertEqual(parse_remember_device_cookies(""), [])
+
+
+@override_settings(TWO_FACTOR_DEFAULT_DEVICE_CACHE_AGE=60)
+class DefaultDeviceCacheTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = self.create_user()
+
+    def fresh_user(self):
+        return self.User.objects.get(pk=self.user.pk)
+
+    def test_cached_across_requests(self):
+        self.assertIsNone(default_device(self.fresh_user()))
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertIsNone(default_device(user))
+
+        device = self.enable_otp()
+        user = self.fresh_user()
+        self.assertEqual(default_device(user), device)
+
+        # Only the device itself is fetched from the database
+        user = self.fresh_user()
+        with self.assertNumQueries(1):
+            self.assertEqual(default_device(user), device)
+
+    def test_invalidated_on_device_changes(self):
+        device = self.enable_otp()
+        self.assertEqual(default_device(self.fresh_user()), device)
+
+        device.name = 'backup'
+        device.save()
+        self.assertIsNone(default_device(self.fresh_user()))
+
+        device.name = 'default'
+        device.save()
+        self.assertEqual(default_device(self.fresh_user()), device)
+
+        device.delete()
+        self.assertIsNone(default_device(self.fresh_user()))
+
+    def test_kept_on_verification(self):
+        device = self.enable_otp()
+        self.assertEqual(default_device(self.fresh_user()), device)
+
+        # Verifying a token saves the device without update_fields
+        self.assertTrue(device.verify_token(totp_str(device.bin_key)))
+        user = self.fresh_user()
+        with self.assertNumQueries(1):
+            self.assertEqual(default_device(user), device)
+
+        # Other devices don't change the default device either
+        self.user.totpdevice_set.create(name='backup')
+        user = self.fresh_user()
+        with self.assertNumQueries(1):
+            self.assertEqual(default_device(user), device)
+
+
+@override_settings(TWO_FACTOR_BACKUP_TOKENS_CACHE_AGE=60)
+class BackupTokensRemainingTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = self.create_user()
+
+    def test_cached_across_requests(self):
+        self.assertEqual(backup_tokens_remaining(self.user), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(backup_tokens_remaining(self.user), 0)
+
+        regenerate_backup_tokens(self.user, 3)
+        self.assertEqual(backup_tokens_remaining(self.user), 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(backup_tokens_remaining(self.user), 3)
+
+    def test_invalidated_when_used(self):
+        device, tokens = regenerate_backup_tokens(self.user, 3)
+        self.assertEqual(backup_tokens_remaining(self.user), 3)
+        self.assertTrue(device.verify_token(tokens[0]))
+        self.assertEqual(backup_tokens_remaining(self.user), 2)
+
+        device.delete()
+        self.assertEqual(backup_tokens_remaining(self.user), 0)
+
+    @override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True)
+    def test_hashed_tokens(self):
+        device, tokens = regenerate_backup_tokens(self.user, 3)
+        self.assertEqual(backup_tokens_remaining(self.user), 3)
+        # Plaintext tokens added outside of regenerate_backup_tokens() aren't
+        # counted until the device is saved
+        device.token_set.create(token='abcdef12')
+        self.assertEqual(backup_tokens_remaining(self.user), 3)
+        device = BackupDevice.objects.get(pk=device.pk)
+        self.assertTrue(device.verify_token(tokens[0]))
+        self.assertEqual(backup_tokens_remaining(self.user), 3)
+
+    @override_settings(TWO_FACTOR_BACKUP_TOKENS_CACHE_AGE=None)
+    def test_not_cached(self):
+        regenerate_backup_tokens(self.user, 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(backup_tokens_remaining(self.user), 3)
+        self.user.staticdevice_set.get().token_set.all()[0].delete()
+        self.assertEqual(backup_tokens_remaining(self.user), 2)
+
+    @override_settings(TWO_FACTOR_BACKUP_TOKENS_CACHE_AGE=None, TWO_FACTOR_HASH_BACKUP_TOKENS=True)
+    def test_not_cached_hashed(self):
+        device, _ = regenerate_backup_tokens(self.user, 3)
+        device.token_set.create(token='abcdef12')
+        with self.assertNumQueries(1) as queries:
+            self.assertEqual(backup_tokens_remaining(self.user), 4)
+        # Tokens are counted in subqueries, not by joining both token tables
+        self.assertNotIn('JOIN', queries.captured_queries[0]['sql'])
+
+
+class BulkDefaultDeviceTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [self.create_user('user%d@example.com' % i) for i in range(4)]
+        self.totp = self.enable_otp(self.users[0])
+        self.phone = self.users[1].phonedevice_set.create(name='default', number='+12024561111')
+        self.users[2].phonedevice_set.create(name='backup', number='+12024561111')
+        self.users[3].totpdevice_set.create(name='default', confirmed=False)
+
+    def test_default_devices_for_users(self):
+        user_ids = [user.pk for user in self.users]
+        expected = {self.users[0].pk: self.totp, self.users[1].pk: self.phone}
+        self.assertEqual(default_devices_for_users(user_ids), expected)
+        self.assertEqual(default_devices_for_users(user_ids, chunk_size=1), expected)
+        self.assertEqual(set(default_devices_for_users(user_ids, confirmed=None)),
+                         {self.users[0].pk, self.users[1].pk, self.users[3].pk})
+
+    def test_with_two_factor_status(self):
+        queryset = with_two_factor_status(self.User.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            self.assertEqual([user.two_factor_enabled for user in queryset], [True, True, False, False])
+
+    @override_settings(TWO_FACTOR_TRACK_STATUS=True)
+    def test_with_two_factor_status_tracked(self):
+        call_command('two_factor_backfill_status', stdout=StringIO())
+        queryset = with_two_factor_status(self.User.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            self.assertEqual([user.two_factor_enabled for user in queryset], [True, True, False, False])
+
 
 class PhoneUtilsTests(UserMixin, TestCase):
     def test_get_available_phone_methods(self):
@@ -1,13 +1,20 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
 
+from two_factor.models import BackupDevice
+from two_factor.utils import regenerate_backup_tokens
+
 from .utils import UserMixin
 
 
 class BackupTokensTest(UserMixin, TestCase):
     def setUp(self):
         super().setUp()
-        self.create_user()
+        self.user = self.create_user()
         self.enable_otp()
         self.login_user()
 
@@ -34,3 +41,130 @@ class BackupTokensTest(UserMixin, TestCase):
         second_set = set([token.token for token in
                          response.context_data['device'].token_set.all()])
         self.assertNotEqual(first_set, second_set)
+
+    def test_get_is_read_only(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('two_factor:backup_tokens'))
+        self.assertIsNone(response.context_data['device'])
+        self.assertContains(response, 'You don\'t have any backup codes yet.')
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'otp_static' in query['sql'] and not query['sql'].startswith('SELECT')])
+        self.assertFalse(self.user.staticdevice_set.exists())
+
+    @override_settings(TWO_FACTOR_BACKUP_TOKENS_COUNT=4, TWO_FACTOR_BACKUP_TOKENS_ALPHABET='ab',
+                       TWO_FACTOR_BACKUP_TOKENS_LENGTH=12)
+    def test_generate_settings(self):
+        url = reverse('two_factor:backup_tokens')
+        self.client.post(url)
+        device = self.user.staticdevice_set.get()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url)
+        tokens = [token.token for token in device.token_set.all()]
+        self.assertEqual(len(tokens), 4)
+        for token in tokens:
+            self.assertRegex(token, '^[ab]{12}$')
+        # One DELETE per token table and one INSERT for the tokens
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual(statements.count('INSERT'), 1)
+        self.assertEqual(statements.count('DELETE'), 2)
+
+    @override_settings(TWO_FACTOR_BACKUP_TOKENS_ALPHABET='ab', TWO_FACTOR_BACKUP_TOKENS_LENGTH=17)
+    def test_generate_too_long(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, 'between 1 and 16'):
+            regenerate_backup_tokens(self.user)
+        self.assertFalse(self.user.staticdevice_set.exists())
+
+    def test_generate_several_static_devices(self):
+        device = self.user.staticdevice_set.create(name='backup')
+        self.user.staticdevice_set.create(name='other')
+        self.client.post(reverse('two_factor:backup_tokens'))
+        self.assertEqual(device.token_set.count(), 10)
+        self.assertEqual(self.user.staticdevice_set.count(), 2)
+
+
+@override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True)
+class HashedBackupTokensTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        self.enable_otp()
+        self.login_user()
+
+    def test_generate(self):
+        url = reverse('two_factor:backup_tokens')
+
+        # The tokens are shown once, in the response generating them, and
+        # only their hashes are stored
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-store', response['Cache-Control'])
+        tokens = response.context_data['tokens']
+        self.assertEqual(len(set(tokens)), 10)
+        for token in tokens:
+            self.assertContains(response, '<li>%s</li>' % token)
+        device = self.user.staticdevice_set.get()
+        self.assertFalse(device.token_set.exists())
+        self.assertEqual(device.hashed_token_set.count(), 10)
+        self.assertNotIn(tokens[0], device.hashed_token_set.values_list('token_hash', flat=True))
+        self.assertNotIn(tokens[0], str(dict(self.client.session)))
+
+        response = self.client.get(url)
+        self.assertEqual(response.context_data['tokens'], [])
+        self.assertContains(response, 'You have 10 backup tokens left.')
+
+        # Generating the tokens replaces all of them
+        response = self.client.post(url)
+        self.assertFalse(set(tokens) & set(response.context_data['tokens']))
+        self.assertEqual(device.hashed_token_set.count(), 10)
+
+    def test_generate_after_disabling(self):
+        url = reverse('two_factor:backup_tokens')
+        self.client.post(url)
+        device = self.user.staticdevice_set.get()
+        with self.settings(TWO_FACTOR_HASH_BACKUP_TOKENS=False):
+            self.client.post(url)
+        # The hashed tokens are replaced too
+        self.assertFalse(device.hashed_token_set.exists())
+        self.assertEqual(device.token_set.count(), 10)
+
+
+@override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True)
+class BackupDeviceTest(UserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user()
+        static_device, self.tokens = regenerate_backup_tokens(self.user, 3)
+        self.device = BackupDevice.objects.get(pk=static_device.pk)
+
+    def test_verify_token(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.device.verify_token(self.tokens[0]))
+        # The token is deleted (after a lookup when post_delete receivers
+        # are connected), and the device is saved
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual(statements.count('DELETE'), 1)
+        self.assertEqual(statements[-2:], ['DELETE', 'UPDATE'])
+        self.assertEqual(self.device.hashed_token_set.count(), 2)
+
+        self.device.throttle_reset()
+        self.assertFalse(self.device.verify_token(self.tokens[0]))
+        self.assertEqual(self.device.throttling_failure_count, 1)
+
+    def test_plaintext_token(self):
+        self.device.token_set.create(token='abcdef12')
+        self.assertTrue(self.device.verify_token('abcdef12'))
+        self.assertFalse(self.device.token_set.exists())
+        self.assertEqual(self.device.hashed_token_set.count(), 3)
+
+    def test_secret_key_fallbacks(self):
+        with self.settings(SECRET_KEY='new-secret-key', SECRET_KEY_FALLBACKS=[settings.SECRET_KEY]):
+            self.assertTrue(self.device.verify_token(self.tokens[0]))
+        with self.settings(SECRET_KEY='new-secret-key'):
+            self.device.throttle_reset()
+            self.assertFalse(self.device.verify_token(self.tokens[1]))
+
+    def test_throttling(self):
+        self.assertFalse(self.device.verify_token('wrong'))
+        # Valid tokens are refused while throttled, and are not consumed
+        self.assertFalse(self.device.verify_token(self.tokens[0]))
+        self.assertEqual(self.device.hashed_token_set.count(), 3)
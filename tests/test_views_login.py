@@ -4,17 +4,25 @@ from time import sleep
 from unittest import mock, skipUnless
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.signing import BadSignature
+from django.db import connection
 from django.shortcuts import resolve_url
 from django.test import RequestFactory, TestCase
-from django.test.utils import modify_settings, override_settings
+from django.test.utils import (
+    CaptureQueriesContext, modify_settings, override_settings,
+)
 from django.urls import reverse
 from django_otp import DEVICE_ID_SESSION_KEY
 from django_otp.oath import totp
 from django_otp.util import random_hex
 from freezegun import freeze_time
 
+from two_factor.utils import regenerate_backup_tokens
 from two_factor.views.core import LoginView
+from two_factor.views.utils import (
+    parse_remember_device_cookies, validate_remember_device_cookie,
+)
 
 from .utils import UserMixin, totp_str
 
@@ -324,6 +332,78 @@ class LoginTest(UserMixin, TestCase):
                                    'login_view-current_step': 'token'})
             self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL))
 
+    @mock.patch('two_factor.gateways.fake.Fake')
+    @override_settings(TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake')
+    def test_challenge_resend_window(self, fake):
+        user = self.create_user()
+        user.phonedevice_set.create(name='default', number='+31101234567', method='sms')
+
+        with freeze_time('2023-01-01') as frozen_time:
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+            self.assertContains(response, 'We sent you a text message')
+            self.assertNotContains(response, 'Send a New Token')
+            self.assertEqual(fake.return_value.send_sms.call_count, 1)
+
+            # Rendering the token step again (e.g. going back from the backup
+            # step) does not send another message
+            response = self._post({'wizard_goto_step': 'token',
+                                   'login_view-current_step': 'backup'})
+            self.assertContains(response, 'Send a New Token')
+            self.assertEqual(fake.return_value.send_sms.call_count, 1)
+
+            # Unless explicitly asked
+            response = self._post({'resend_challenge': '1',
+                                   'login_view-current_step': 'token'})
+            self.assertContains(response, 'We sent you a text message')
+            self.assertEqual(fake.return_value.send_sms.call_count, 2)
+
+            frozen_time.tick(60)
+            self._post({'wizard_goto_step': 'token',
+                        'login_view-current_step': 'backup'})
+            self.assertEqual(fake.return_value.send_sms.call_count, 3)
+
+    @mock.patch('two_factor.gateways.fake.Fake')
+    @override_settings(
+        TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake',
+        TWO_FACTOR_PHONE_QUOTAS={'sms': {'number': (2, 60)}},
+    )
+    def test_challenge_quota_not_recorded(self, fake):
+        cache.clear()
+        user = self.create_user()
+        device = user.phonedevice_set.create(name='default', number='+31101234567', method='sms')
+
+        with freeze_time('2023-01-01') as frozen_time:
+            device.generate_challenge()
+            device.generate_challenge()
+            with self.assertLogs('two_factor.plugins.phonenumber.models', 'WARNING'):
+                response = self._post({'auth-username': 'bouke@example.com',
+                                       'auth-password': 'secret',
+                                       'login_view-current_step': 'auth'})
+            self.assertNotContains(response, 'Send a New Token')
+            self.assertEqual(fake.return_value.send_sms.call_count, 2)
+            self.assertNotIn('challenges', self.client.session['wizard_login_view']['extra_data'])
+
+            # The skipped challenge doesn't suppress the next one
+            frozen_time.tick(30)
+            self._post({'wizard_goto_step': 'token',
+                        'login_view-current_step': 'backup'})
+            self.assertEqual(fake.return_value.send_sms.call_count, 3)
+
+    def test_generator_challenge_not_recorded(self):
+        user = self.create_user()
+        user.totpdevice_set.create(name='default', key=random_hex())
+
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        response = self._post({'wizard_goto_step': 'token',
+                               'login_view-current_step': 'backup'})
+        self.assertNotContains(response, 'Send a New Token')
+        self.assertNotIn('challenges', self.client.session['wizard_login_view']['extra_data'])
+
     @mock.patch('two_factor.gateways.fake.Fake')
     @mock.patch('two_factor.views.core.signals.user_verified.send')
     @override_settings(
@@ -422,6 +502,42 @@ class LoginTest(UserMixin, TestCase):
         # Check that the signal was fired.
         mock_signal.assert_called_with(sender=mock.ANY, request=mock.ANY, user=user, device=device)
 
+    def test_backup_tokens_count(self):
+        user = self.create_user()
+        user.totpdevice_set.create(name='default', key=random_hex())
+        device = user.staticdevice_set.create(name='backup')
+
+        # The backup step is only offered when tokens are left
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertEqual(response.context_data['backup_tokens'], 0)
+        self.assertNotContains(response, 'Backup Token')
+
+        device.token_set.create(token='abcdef123')
+        device.token_set.create(token='ghijkl456')
+        response = self._post({'wizard_goto_step': 'token', 'login_view-current_step': 'backup'})
+        self.assertEqual(response.context_data['backup_tokens'], 2)
+        self.assertContains(response, 'Backup Token')
+
+    @override_settings(TWO_FACTOR_HASH_BACKUP_TOKENS=True)
+    def test_with_hashed_backup_token(self):
+        user = self.create_user()
+        user.totpdevice_set.create(name='default', key=random_hex())
+        device, tokens = regenerate_backup_tokens(user, 2)
+
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        response = self._post({'wizard_goto_step': 'backup'})
+        self.assertContains(response, 'backup tokens')
+
+        response = self._post({'backup-otp_token': tokens[0],
+                               'login_view-current_step': 'backup'})
+        self.assertRedirects(response, resolve_url(settings.LOGIN_REDIRECT_URL))
+        self.assertEqual(self.client.session[DEVICE_ID_SESSION_KEY], 'two_factor.backupdevice/%s' % device.pk)
+        self.assertEqual(device.hashed_token_set.count(), 1)
+
     @mock.patch('two_factor.views.core.signals.user_verified.send')
     def test_with_alter_backup_token(self, mock_signal):
         user = self.create_user()
@@ -719,6 +835,93 @@ class RememberLoginTest(UserMixin, TestCase):
     def restore_remember_cookie(self):
         self.client.cookies[self._restore_remember_cookie_data['name']] = self._restore_remember_cookie_data['value']
 
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60)
+    def test_remember_cookie_matched_to_device(self):
+        self.user.phonedevice_set.create(name='backup', number='+12024561111', method='call')
+        self.user.totpdevice_set.create(name='backup', key=random_hex())
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        self._post({'token-otp_token': totp_str(self.device.bin_key),
+                    'login_view-current_step': 'token',
+                    'token-remember': 'on'})
+        self.client.post(reverse('logout'))
+        # Cookies of another browser user, or garbage
+        self.client.cookies['remember-cookie_other'] = 'AAAA:0123456789abcdef:0123456789abcdef'
+        self.client.cookies['remember-cookie_garbage'] = 'garbage'
+
+        with mock.patch('two_factor.views.core.validate_remember_device_cookie',
+                        wraps=validate_remember_device_cookie) as validate_mock:
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        self.assertEqual(validate_mock.call_count, 1)
+        self.assertEqual(validate_mock.call_args.kwargs['otp_device_id'], self.device.persistent_id)
+
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60)
+    def test_remember_cookie_without_throttle_write(self):
+        self._post({'auth-username': 'bouke@example.com',
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        self._post({'token-otp_token': totp_str(self.device.bin_key),
+                    'login_view-current_step': 'token',
+                    'token-remember': 'on'})
+        self.client.post(reverse('logout'))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self._post({'auth-username': 'bouke@example.com',
+                                   'auth-password': 'secret',
+                                   'login_view-current_step': 'auth'})
+        self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE "otp_totp')])
+
+    def _login(self, username, device, remember=True):
+        self._post({'auth-username': username,
+                    'auth-password': 'secret',
+                    'login_view-current_step': 'auth'})
+        data = {'token-otp_token': totp_str(device.bin_key),
+                'login_view-current_step': 'token'}
+        if remember:
+            data['token-remember'] = 'on'
+        response = self._post(data)
+        self.client.post(reverse('logout'))
+        return response
+
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60)
+    def test_consolidated_remember_cookie(self):
+        other_user = self.create_user(username='other@example.com')
+        other_device = other_user.totpdevice_set.create(name='default', key=random_hex())
+        # A legacy cookie set before enabling the consolidated cookie
+        self._login('other@example.com', other_device)
+
+        with self.settings(TWO_FACTOR_REMEMBER_COOKIE_CONSOLIDATED=True):
+            response = self._login('bouke@example.com', self.device)
+            self.assertEqual(len(parse_remember_device_cookies(response.cookies['remember-cookies'].value)), 2)
+            legacy_cookies = [cookie for cookie in response.cookies if cookie.startswith('remember-cookie_')]
+            self.assertEqual(len(legacy_cookies), 1)
+            self.assertEqual(response.cookies[legacy_cookies[0]].value, '')
+
+            # Both users are remembered from the consolidated cookie
+            for username in ('bouke@example.com', 'other@example.com'):
+                response = self._post({'auth-username': username,
+                                       'auth-password': 'secret',
+                                       'login_view-current_step': 'auth'})
+                self.assertRedirects(response, reverse('two_factor:profile'), fetch_redirect_response=False)
+                self.client.post(reverse('logout'))
+
+    @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60, TWO_FACTOR_REMEMBER_COOKIE_CONSOLIDATED=True)
+    def test_consolidated_remember_cookie_invalid_entry(self):
+        response = self._login('bouke@example.com', self.device)
+        entry = response.cookies['remember-cookies'].value
+        self.client.cookies['remember-cookies'] = entry[:-5] + '0' * 5
+
+        response = self._post({'auth-username': 'bouke@example.com',
+                               'auth-password': 'secret',
+                               'login_view-current_step': 'auth'})
+        self.assertContains(response, 'Token:')
+        self.assertEqual(response.cookies['remember-cookies'].value, '')
+
     @override_settings(TWO_FACTOR_REMEMBER_COOKIE_AGE=60 * 60)
     def test_with_remember(self):
         # Login
@@ -947,13 +1150,13 @@ class RememberLoginTest(UserMixin, TestCase):
                                'token-remember': 'on'})
         self.client.post(reverse('logout'))
 
-        # mock device_for_user
-        with mock.patch("two_factor.views.core.devices_for_user") as devices_for_user_mock, \
+        # mock device_snapshot
+        with mock.patch("two_factor.views.core.device_snapshot") as device_snapshot_mock, \
                 mock.patch("two_factor.views.core.validate_remember_device_cookie") as validate_mock:
             device_mock = mock.Mock(spec=["verify_is_allowed", "persistent_id", "user_id"])
-            device_mock.persistent_id = 1
+            device_mock.persistent_id = self.device.persistent_id
             device_mock.verify_is_allowed.return_value = [True, {}]
-            devices_for_user_mock.return_value = [device_mock]
+            device_snapshot_mock.return_value.get_devices.return_value = [device_mock]
             validate_mock.return_value = True
             response = self._post({'auth-username': 'bouke@example.com',
                                    'auth-password': 'secret',
@@ -1,6 +1,7 @@
 from unittest import mock
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.shortcuts import resolve_url
 from django.template import Context, Template
@@ -223,6 +224,54 @@ class PhoneDeviceTest(UserMixin, TestCase):
                     frozen_time.tick(10)
                     self.assertTrue(device.verify_token(totp(device.bin_key, digits=no_digits)))
 
+    def test_verify_throttle_writes(self):
+        device = self.user.phonedevice_set.create(name='default', number='+12024561111', method='sms')
+        with freeze_time("2023-01-01") as frozen_time:
+            # A clean throttle state is not written again on success
+            with self.assertNumQueries(0):
+                self.assertTrue(device.verify_token(totp(device.bin_key)))
+
+            with self.assertNumQueries(1):
+                self.assertFalse(device.verify_token(-1))
+            frozen_time.tick(10)
+            self.assertFalse(device.verify_token(-1))
+            device.refresh_from_db()
+            self.assertEqual(device.throttling_failure_count, 2)
+
+            frozen_time.tick(20)
+            with self.assertNumQueries(1):
+                self.assertTrue(device.verify_token(totp(device.bin_key)))
+            device.refresh_from_db()
+            self.assertEqual(device.throttling_failure_count, 0)
+            self.assertIsNone(device.throttling_failure_timestamp)
+
+    @mock.patch('two_factor.gateways.fake.Fake')
+    @override_settings(
+        TWO_FACTOR_SMS_GATEWAY='two_factor.gateways.fake.Fake',
+        TWO_FACTOR_PHONE_QUOTAS={'sms': {'number': (2, 3600), 'country': (3, 3600)}},
+    )
+    def test_generate_challenge_quota(self, fake):
+        cache.clear()
+        device = self.user.phonedevice_set.create(name='default', number='+12024561111', method='sms')
+        other = self.user.phonedevice_set.create(name='other', number='+12024561112', method='sms')
+        with freeze_time("2023-01-01") as frozen_time:
+            device.generate_challenge()
+            device.generate_challenge()
+            with self.assertLogs('two_factor.plugins.phonenumber.models', 'WARNING'):
+                device.generate_challenge()
+            self.assertEqual(fake.return_value.send_sms.call_count, 2)
+
+            # The country quota is shared by all numbers
+            other.generate_challenge()
+            with self.assertLogs('two_factor.plugins.phonenumber.models', 'WARNING'):
+                other.generate_challenge()
+            self.assertEqual(fake.return_value.send_sms.call_count, 3)
+
+            # Buckets refill over time
+            frozen_time.tick(1800)
+            device.generate_challenge()
+            self.assertEqual(fake.return_value.send_sms.call_count, 4)
+
     def test_verify_token_as_string(self):
         """
         The field used to read the token may be a CharField,
@@ -0,0 +1,119 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class TwilioRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so that connection reuse by the client can be measured
+    protocol_version = 'HTTP/1.1'
+    path_pattern = re.compile(r'^/2010-04-01/Accounts/(?P<account>\w+)/(?P<resource>Messages|Calls)\.json$')
+
+    def setup(self):
+        super().setup()
+        self.server.twilio.connection_opened()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        match = self.path_pattern.match(self.path)
+        if not match:
+            return self.respond(404, {'code': 20404, 'message': 'The requested resource was not found'})
+
+        params = {key: values[0] for key, values in parse_qs(body).items()}
+        status = self.server.twilio.handle(match['resource'], params)
+        if status != 201:
+            return self.respond(status, {'code': 20500, 'message': 'Injected error', 'status': status})
+        sid = '%s%032x' % ('SM' if match['resource'] == 'Messages' else 'CA', random.getrandbits(128))
+        self.respond(201, {
+            'sid': sid,
+            'account_sid': match['account'],
+            'to': params.get('To'),
+            'from': params.get('From'),
+            'status': 'queued',
+        })
+
+    def respond(self, status, payload):
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTwilioServer:
+    """
+    Local HTTP server implementing the Messages and Calls endpoints of the
+    Twilio REST API used by :class:`~two_factor.gateways.twilio.gateway.Twilio`.
+    Each request waits `latency` seconds, and fails with `error_status` with a
+    probability of `error_rate`. The received requests are kept in
+    `requests` as ``(resource, params)`` tuples.
+
+    Use it as a context manager, and point a Twilio client to it with
+    :meth:`patch_client`::
+
+        with FakeTwilioServer(latency=0.05) as server:
+            server.patch_client(get_gateway('two_factor.gateways.twilio.gateway.Twilio').client)
+    """
+
+    def __init__(self, latency=0, error_rate=0, error_status=500, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.connections = 0
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), TwilioRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.twilio = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def patch_client(self, client, timeout=None):
+        """
+        Sends the API requests of the Twilio `client` to this server.
+        """
+        client.api.base_url = self.url
+        if timeout is not None:
+            client.http_client.timeout = timeout
+        return client
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def handle(self, resource, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests.append((resource, params))
+            failed = self.error_rate and self.random.random() < self.error_rate
+        return self.error_status if failed else 201
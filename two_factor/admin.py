@@ -1,11 +1,13 @@
 from django.conf import settings
-from django.contrib.admin import AdminSite
+from django.contrib.admin import AdminSite, ModelAdmin, action, display
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.contrib.auth.views import redirect_to_login
 from django.shortcuts import resolve_url
 from django.utils.http import url_has_allowed_host_and_scheme
+from django.utils.translation import gettext_lazy as _
 
-from .utils import monkeypatch_method
+from .models import RememberedDevice
+from .utils import monkeypatch_method, with_two_factor_status
 
 
 class AdminSiteOTPRequiredMixin:
@@ -44,6 +46,50 @@ class AdminSiteOTPRequired(AdminSiteOTPRequiredMixin, AdminSite):
     pass
 
 
+class TwoFactorUserAdminMixin:
+    """
+    Mixin for the user ``ModelAdmin``, adding a two-factor status column to
+    the changelist. The status is computed in the changelist query, without
+    an additional query per user.
+    """
+
+    def get_queryset(self, request):
+        return with_two_factor_status(super().get_queryset(request))
+
+    def get_list_display(self, request):
+        return [*super().get_list_display(request), 'two_factor_enabled']
+
+    @display(boolean=True, description=_('Two-factor'), ordering='two_factor_enabled')
+    def two_factor_enabled(self, obj):
+        return obj.two_factor_enabled
+
+
+class RememberedDeviceAdmin(ModelAdmin):
+    """
+    :class:`~django.contrib.admin.ModelAdmin` for
+    :class:`~two_factor.models.RememberedDevice`, deleting remembered browsers
+    revokes them immediately. Projects enabling
+    ``TWO_FACTOR_REMEMBER_TOKEN_STORE`` can register it on their admin site::
+
+        admin.site.register(RememberedDevice, RememberedDeviceAdmin)
+    """
+    list_display = ['user', 'device_id', 'user_agent', 'created_at', 'last_seen', 'expires_at']
+    list_select_related = ['user']
+    raw_id_fields = ['user']
+    readonly_fields = ['token_hash', 'password_fingerprint']
+    actions = ['revoke']
+
+    def delete_model(self, request, obj):
+        RememberedDevice.objects.filter(pk=obj.pk).revoke()
+
+    def delete_queryset(self, request, queryset):
+        queryset.revoke()
+
+    @action(description=_('Revoke selected remembered browsers'))
+    def revoke(self, request, queryset):
+        queryset.revoke()
+
+
 def patch_admin():
     @monkeypatch_method(AdminSite)
     def login(self, request, extra_context=None):
@@ -1,12 +1,27 @@
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
 from django.conf import settings
+from django.db.models.signals import post_delete, post_save
 
 
 class TwoFactorConfig(AppConfig):
     name = 'two_factor'
     verbose_name = "Django Two Factor Authentication"
+    default_auto_field = 'django.db.models.AutoField'
 
     def ready(self):
         if getattr(settings, 'TWO_FACTOR_PATCH_ADMIN', True):
             from .admin import patch_admin
             patch_admin()
+
+        # Only device models (including proxies) are watched, so that saving
+        # other models doesn't call the receivers
+        from django_otp.models import Device
+
+        from .models import device_deleted, device_saved
+        for model in apps.get_models():
+            if issubclass(model, Device):
+                label = model._meta.label_lower
+                post_save.connect(device_saved, sender=model,
+                                  dispatch_uid='two_factor.models.device_saved.%s' % label)
+                post_delete.connect(device_deleted, sender=model,
+                                    dispatch_uid='two_factor.models.device_deleted.%s' % label)
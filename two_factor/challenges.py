@@ -0,0 +1,179 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.dispatch import receiver
+from django.utils import translation
+from django.utils.module_loading import import_string
+from django_otp.models import Device
+
+from . import signals
+from .middleware.threadlocals import _thread_locals
+
+logger = logging.getLogger(__name__)
+
+
+def get_challenge_executor():
+    """
+    Returns the executor generating challenges, as configured by the
+    TWO_FACTOR_CHALLENGE_EXECUTOR setting. Defaults to
+    :class:`ThreadPoolChallengeExecutor`.
+    """
+    import_path = getattr(settings, 'TWO_FACTOR_CHALLENGE_EXECUTOR',
+                          'two_factor.challenges.ThreadPoolChallengeExecutor')
+    return import_string(import_path)()
+
+
+def dispatch_challenge(device, request=None):
+    """
+    Asks the device to generate a challenge (e.g. sending a text message)
+    through the configured executor.
+
+    Returns whether the challenge was generated, or None when it is generated
+    in the background. Failures are logged and reported with the
+    :data:`~two_factor.signals.challenge_failed` signal.
+    """
+    return get_challenge_executor().submit(device, request)
+
+
+def generate_challenge(device, request=None, language=None):
+    """
+    Generates the challenge of the device in the request's context, and
+    returns whether it succeeded. Devices return False from
+    ``generate_challenge()`` when they did not send a challenge (e.g. when
+    throttled).
+    """
+    previous_request = getattr(_thread_locals, 'request', None)
+    _thread_locals.request = request
+    try:
+        with translation.override(language) if language else nullcontext():
+            generated = device.generate_challenge() is not False
+    except Exception as exc:
+        logger.exception("Could not generate challenge")
+        signals.challenge_failed.send(sender=__name__, request=request, device=device, exception=exc)
+        return False
+    finally:
+        _thread_locals.request = previous_request
+    return generated
+
+
+class ChallengeRequest:
+    """
+    The parts of a request available to gateways while a challenge is
+    generated in the background, after the response was sent: its scheme and
+    host, to build absolute URLs.
+    """
+
+    def __init__(self, request):
+        self.scheme = request.scheme
+        self.host = request.get_host()
+
+    def get_host(self):
+        return self.host
+
+    def is_secure(self):
+        return self.scheme == 'https'
+
+    def build_absolute_uri(self, location='/'):
+        return urljoin('%s://%s/' % (self.scheme, self.host), location)
+
+
+class ChallengeExecutor:
+    """
+    Base class of the challenge executors. Executors relying on an external
+    task queue should implement :meth:`submit` to enqueue a task loading the
+    device back, e.g. with
+    :meth:`~django_otp.models.Device.from_persistent_id`, and calling
+    :func:`generate_challenge` with a :class:`ChallengeRequest`.
+    """
+
+    def submit(self, device, request=None):
+        raise NotImplementedError
+
+
+class SynchronousChallengeExecutor(ChallengeExecutor):
+    """
+    Generates challenges during the request, as in tests.
+    """
+
+    def submit(self, device, request=None):
+        return generate_challenge(device, request, translation.get_language())
+
+
+class ThreadPoolChallengeExecutor(ChallengeExecutor):
+    """
+    Generates challenges in a process-wide pool of
+    TWO_FACTOR_CHALLENGE_MAX_WORKERS threads, once the current transaction is
+    committed. When TWO_FACTOR_CHALLENGE_MAX_PENDING challenges are already
+    waiting, the challenge is generated during the request instead.
+
+    The threads load the device back from the database and get a
+    :class:`ChallengeRequest` instead of the request, so that nothing is
+    shared with the request once its response was sent. Unsaved devices (as
+    in the setup wizard) have their challenge generated during the request.
+    """
+    _pool = None
+    _pending = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        with cls._lock:
+            if cls._pool is None:
+                cls._pool = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'TWO_FACTOR_CHALLENGE_MAX_WORKERS', 4),
+                    thread_name_prefix='two_factor_challenge',
+                )
+                cls._pending = threading.BoundedSemaphore(
+                    getattr(settings, 'TWO_FACTOR_CHALLENGE_MAX_PENDING', 100))
+            return cls._pool, cls._pending
+
+    @classmethod
+    def shutdown(cls, wait=True):
+        with cls._lock:
+            pool, cls._pool = cls._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+    def submit(self, device, request=None):
+        language = translation.get_language()
+        if device.pk is None:
+            return generate_challenge(device, request, language)
+        challenge_request = ChallengeRequest(request) if request is not None else None
+        transaction.on_commit(partial(self.enqueue, device.persistent_id, challenge_request, language))
+
+    def enqueue(self, persistent_id, request, language):
+        pool, pending = self.get_pool()
+        if not pending.acquire(blocking=False):
+            self.generate(persistent_id, request, language)
+            return
+        pool.submit(self.run, pending, persistent_id, request, language)
+
+    @classmethod
+    def run(cls, pending, persistent_id, request, language):
+        close_old_connections()
+        try:
+            cls.generate(persistent_id, request, language)
+        finally:
+            pending.release()
+            close_old_connections()
+
+    @staticmethod
+    def generate(persistent_id, request, language):
+        device = Device.from_persistent_id(persistent_id)
+        if device is None:
+            logger.warning("Could not generate challenge, device %s no longer exists", persistent_id)
+            return
+        generate_challenge(device, request, language)
+
+
+@receiver(setting_changed)
+def reset_challenge_executor(setting, **kwargs):
+    if setting in ('TWO_FACTOR_CHALLENGE_MAX_WORKERS', 'TWO_FACTOR_CHALLENGE_MAX_PENDING'):
+        ThreadPoolChallengeExecutor.shutdown(wait=False)
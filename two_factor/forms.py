@@ -5,12 +5,13 @@ from django import forms
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from django_otp.forms import OTPAuthenticationFormMixin
-from django_otp.oath import totp
 from django_otp.plugins.otp_totp.models import TOTPDevice
 
 from .plugins.registry import registry
+from .totp import match_totp
 from .utils import totp_digits
 
+
 class MethodForm(forms.Form):
     method = forms.ChoiceField(label=_("Method"),
                                widget=forms.RadioSelect)
@@ -76,20 +77,19 @@ class TOTPDeviceForm(forms.Form):
 
     def clean_token(self):
         token = self.cleaned_data.get('token')
-        validated = False
         t0s = [self.t0]
         key = self.bin_key
         if 'valid_t0' in self.metadata:
             t0s.append(int(time()) - self.metadata['valid_t0'])
-        for t0 in t0s:
-            for offset in range(-self.tolerance, self.tolerance + 1):
-                if totp(key, self.step, t0, self.digits, self.drift + offset) == token:
-                    self.drift = offset
-                    self.metadata['valid_t0'] = int(time()) - t0
-                    validated = True
-        if not validated:
-            raise forms.ValidationError(self.error_messages['invalid_token'])
-        return token
+        # The closest steps first
+        offsets = sorted(range(-self.tolerance, self.tolerance + 1), key=abs)
+        for t0 in reversed(t0s):
+            offset = match_totp(key, token, offsets, self.step, t0, self.digits, self.drift)
+            if offset is not None:
+                self.drift = offset
+                self.metadata['valid_t0'] = int(time()) - t0
+                return token
+        raise forms.ValidationError(self.error_messages['invalid_token'])
 
     def save(self):
         return TOTPDevice.objects.create(user=self.user, key=self.key,
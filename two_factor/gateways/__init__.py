@@ -1,21 +1,65 @@
+import threading
+
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils.module_loading import import_string
 
+from .instrumentation import instrument
+
+# Gateway instances are shared by the whole process, so that gateways holding
+# a HTTP client (like Twilio) keep their connections alive between messages.
+_gateways = {}
+_gateways_lock = threading.Lock()
+
 
 def get_gateway_class(import_path):
     return import_string(import_path)
 
 
+def get_gateway(import_path):
+    """
+    Returns the process-wide instance of the gateway class at `import_path`,
+    instantiating it on first use.
+    """
+    gateway_class = get_gateway_class(import_path)
+    gateway = _gateways.get(gateway_class)
+    if gateway is None:
+        with _gateways_lock:
+            gateway = _gateways.get(gateway_class)
+            if gateway is None:
+                gateway = _gateways[gateway_class] = gateway_class()
+    return gateway
+
+
+def reset_gateways():
+    """
+    Drops the gateway instances, which are instantiated again on next use.
+    """
+    with _gateways_lock:
+        _gateways.clear()
+
+
+@receiver(setting_changed)
+def reset_gateways_on_setting_changed(setting, **kwargs):
+    # Gateways read their settings when instantiated
+    if setting.startswith(('TWO_FACTOR_', 'TWILIO_')):
+        reset_gateways()
+
+
 def make_call(device, token):
-    gateway = get_gateway_class(getattr(settings, 'TWO_FACTOR_CALL_GATEWAY'))()
-    gateway.make_call(device=device, token=token)
+    gateway = get_gateway(getattr(settings, 'TWO_FACTOR_CALL_GATEWAY'))
+    with instrument('call', gateway, device):
+        gateway.make_call(device=device, token=token)
 
 
 def send_sms(device, token):
-    gateway = get_gateway_class(getattr(settings, 'TWO_FACTOR_SMS_GATEWAY'))()
-    gateway.send_sms(device=device, token=token)
+    gateway = get_gateway(getattr(settings, 'TWO_FACTOR_SMS_GATEWAY'))
+    with instrument('sms', gateway, device):
+        gateway.send_sms(device=device, token=token)
 
 
 def send_whatsapp(device, token):
-    gateway = get_gateway_class(getattr(settings, "TWO_FACTOR_WHATSAPP_GATEWAY"))()
-    gateway.send_whatsapp(device=device, token=token)
+    gateway = get_gateway(getattr(settings, "TWO_FACTOR_WHATSAPP_GATEWAY"))
+    with instrument('whatsapp', gateway, device):
+        gateway.send_whatsapp(device=device, token=token)
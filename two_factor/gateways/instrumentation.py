@@ -0,0 +1,107 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from .. import signals
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# Channel of each gateway method
+METHOD_CHANNELS = {
+    'make_call': 'call',
+    'send_sms': 'sms',
+    'send_whatsapp': 'whatsapp',
+}
+
+
+class GatewayStats:
+    """
+    In-process counters and latency histograms of the gateway calls, per
+    channel (``'call'``, ``'sms'`` or ``'whatsapp'``) and gateway class.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def record(self, channel, gateway, duration, failed):
+        key = (channel, gateway)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {
+                    'calls': 0,
+                    'failures': 0,
+                    'duration': 0.0,
+                    'buckets': [0] * len(LATENCY_BUCKETS),
+                }
+            entry['calls'] += 1
+            entry['failures'] += failed
+            entry['duration'] += duration
+            entry['buckets'][bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def snapshot(self):
+        """
+        Returns a dictionary mapping ``(channel, gateway)`` to the number of
+        ``calls`` and ``failures``, their total ``duration`` and the
+        ``buckets`` of the histogram, mapping each upper bound of
+        :data:`LATENCY_BUCKETS` to the number of calls that took at most that
+        long (but longer than the previous bound).
+        """
+        with self.lock:
+            return {
+                key: {**entry, 'buckets': dict(zip(LATENCY_BUCKETS, entry['buckets']))}
+                for key, entry in self.entries.items()
+            }
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+
+
+gateway_stats = GatewayStats()
+
+
+def get_gateway_name(gateway):
+    gateway_class = gateway if isinstance(gateway, type) else type(gateway)
+    return '%s.%s' % (gateway_class.__module__, gateway_class.__qualname__)
+
+
+def send_gateway_called(**kwargs):
+    # Receivers raising must neither fail the gateway call (making the router
+    # fail over and send the message twice) nor hide its own exception.
+    for receiver, response in signals.gateway_called.send_robust(sender=__name__, **kwargs):
+        if isinstance(response, Exception):
+            logger.error("Error in gateway_called receiver %r", receiver, exc_info=response)
+
+
+@contextmanager
+def instrument(channel, gateway, device):
+    """
+    Times the gateway call made in the block, records it in
+    :data:`gateway_stats` and sends the
+    :data:`~two_factor.signals.gateway_called` signal. Exceptions are
+    re-raised, those of the signal receivers are logged.
+    """
+    number = getattr(device, 'number', None)
+    kwargs = {
+        'channel': channel,
+        'gateway': get_gateway_name(gateway),
+        'country_code': getattr(number, 'country_code', None),
+    }
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as exc:
+        duration = time.monotonic() - start
+        gateway_stats.record(kwargs['channel'], kwargs['gateway'], duration, failed=True)
+        send_gateway_called(duration=duration, exception=exc, **kwargs)
+        raise
+    duration = time.monotonic() - start
+    gateway_stats.record(kwargs['channel'], kwargs['gateway'], duration, failed=False)
+    send_gateway_called(duration=duration, exception=None, **kwargs)
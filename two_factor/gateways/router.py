@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import get_gateway
+from .instrumentation import METHOD_CHANNELS, instrument
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderHealth:
+    """
+    Rolling latency and error rate of a provider, and the state of its
+    circuit breaker.
+    """
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.open_until = None
+
+    def record(self, latency, failed, decay):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += decay * (latency - self.latency)
+        self.error_rate += decay * ((1.0 if failed else 0.0) - self.error_rate)
+        self.consecutive_failures = self.consecutive_failures + 1 if failed else 0
+
+    @property
+    def rank(self):
+        if self.latency is None:
+            return (1, 0.0)
+        # Expected time spent per delivered message
+        return (0, self.latency / max(1.0 - self.error_rate, 0.01))
+
+
+class Router:
+    """
+    Gateway routing each message to the healthiest of several gateways, and
+    failing over to the next one when it raises an exception.
+
+    ``TWO_FACTOR_GATEWAY_ROUTER_PROVIDERS``
+      Should be set to the list of gateways to route to, in order of
+      preference, e.g. ``['two_factor.gateways.twilio.gateway.Twilio',
+      'myproject.gateways.Backup']``. Only the gateways implementing the
+      method (``make_call``, ``send_sms`` or ``send_whatsapp``) are used for
+      that method.
+
+    ``TWO_FACTOR_GATEWAY_ROUTER_FAILURE_THRESHOLD`` (default: ``3``)
+      Number of successive failures opening the circuit breaker of a gateway,
+      which is then skipped.
+
+    ``TWO_FACTOR_GATEWAY_ROUTER_RECOVERY_TIMEOUT`` (default: ``30``)
+      Number of seconds after which a single message is sent through a gateway
+      with an open circuit breaker, closing it again when it succeeds.
+
+    ``TWO_FACTOR_GATEWAY_ROUTER_DECAY`` (default: ``0.2``)
+      Weight of the last message in the rolling latency and error rate.
+
+    Gateways are ranked by their rolling latency divided by their rolling
+    success rate. Gateways without any message yet are tried in order of
+    preference after the measured ones. When all circuit breakers are open,
+    the gateway whose breaker opened first is tried anyway. If every attempt
+    fails, the last exception is raised.
+    """
+
+    def __init__(self):
+        self.providers = list(getattr(settings, 'TWO_FACTOR_GATEWAY_ROUTER_PROVIDERS', []))
+        if not self.providers:
+            raise ImproperlyConfigured('TWO_FACTOR_GATEWAY_ROUTER_PROVIDERS must list at least one gateway.')
+        self.failure_threshold = getattr(settings, 'TWO_FACTOR_GATEWAY_ROUTER_FAILURE_THRESHOLD', 3)
+        self.recovery_timeout = getattr(settings, 'TWO_FACTOR_GATEWAY_ROUTER_RECOVERY_TIMEOUT', 30)
+        self.decay = getattr(settings, 'TWO_FACTOR_GATEWAY_ROUTER_DECAY', 0.2)
+        self.health = {path: ProviderHealth() for path in self.providers}
+        self.lock = threading.Lock()
+
+    def make_call(self, device, token):
+        self.route('make_call', device=device, token=token)
+
+    def send_sms(self, device, token):
+        self.route('send_sms', device=device, token=token)
+
+    def send_whatsapp(self, device, token):
+        self.route('send_whatsapp', device=device, token=token)
+
+    def get_gateway(self, path):
+        # Looked up on use: the router is itself created by get_gateway()
+        return get_gateway(path)
+
+    def get_candidates(self, method):
+        """
+        Returns the gateways to try for `method`, best first. Gateways whose
+        circuit breaker may be probed again are reserved for this call, so that
+        concurrent messages do not all probe them.
+        """
+        # Gateways are instantiated (and possibly imported) outside of the lock,
+        # which only guards the circuit breakers
+        paths = [path for path in self.providers if hasattr(self.get_gateway(path), method)]
+        now = time.monotonic()
+        with self.lock:
+            closed, probed, opened = [], [], []
+            for path in paths:
+                health = self.health[path]
+                if health.open_until is None:
+                    closed.append(path)
+                elif health.open_until <= now:
+                    health.open_until = now + self.recovery_timeout
+                    probed.append(path)
+                else:
+                    opened.append(path)
+
+            closed.sort(key=lambda path: self.health[path].rank)
+            # Probes go first, otherwise a recovered gateway never gets any
+            # traffic while another one is healthy
+            candidates = probed + closed
+            if not candidates and opened:
+                candidates = [min(opened, key=lambda path: self.health[path].open_until)]
+        if not paths:
+            raise NotImplementedError('No gateway configured in TWO_FACTOR_GATEWAY_ROUTER_PROVIDERS '
+                                      'implements %s.' % method)
+        return candidates
+
+    def route(self, method, **kwargs):
+        error = None
+        for path in self.get_candidates(method):
+            gateway = self.get_gateway(path)
+            start = time.monotonic()
+            try:
+                with instrument(METHOD_CHANNELS[method], gateway, kwargs['device']):
+                    getattr(gateway, method)(**kwargs)
+            except Exception as exc:
+                self.record(path, time.monotonic() - start, failed=True)
+                logger.warning('Gateway %s failed to %s, failing over.', path, method, exc_info=True)
+                error = exc
+            else:
+                self.record(path, time.monotonic() - start, failed=False)
+                return
+        raise error
+
+    def record(self, path, latency, failed):
+        with self.lock:
+            health = self.health[path]
+            health.record(latency, failed, self.decay)
+            if not failed:
+                health.open_until = None
+            elif health.consecutive_failures >= self.failure_threshold:
+                if health.open_until is None:
+                    logger.warning('Opening the circuit breaker of gateway %s.', path)
+                health.open_until = time.monotonic() + self.recovery_timeout
@@ -1,7 +1,10 @@
 import json
+from functools import lru_cache
 from urllib.parse import urlencode
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import translation
@@ -136,9 +139,26 @@ class Twilio:
         self.client.messages.create(**send_kwargs)
 
 
-def validate_voice_locale(locale):
+@lru_cache(maxsize=None)
+def get_voice_locale(locale):
+    """
+    Returns the Twilio voice locale of the Django `locale`, translated once
+    per locale and process.
+    """
     with translation.override(locale):
-        voice_locale = pgettext('twilio_locale', 'en')
-        if voice_locale not in VOICE_LANGUAGES:
-            raise NotImplementedError('The language "%s" is not '
-                                      'supported by Twilio' % voice_locale)
+        # Translators: twilio_locale should be a locale supported by
+        # Twilio, see http://bit.ly/187I5cr
+        return pgettext('twilio_locale', 'en')
+
+
+@receiver(setting_changed)
+def clear_voice_locales(setting, **kwargs):
+    if setting in ('LANGUAGES', 'LANGUAGE_CODE', 'LOCALE_PATHS', 'INSTALLED_APPS'):
+        get_voice_locale.cache_clear()
+
+
+def validate_voice_locale(locale):
+    voice_locale = get_voice_locale(locale)
+    if voice_locale not in VOICE_LANGUAGES:
+        raise NotImplementedError('The language "%s" is not '
+                                  'supported by Twilio' % voice_locale)
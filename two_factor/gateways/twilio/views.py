@@ -3,12 +3,12 @@ from django.contrib.sites.shortcuts import get_current_site
 from django.template.response import TemplateResponse
 from django.utils import translation
 from django.utils.decorators import method_decorator
-from django.utils.translation import check_for_language, pgettext
+from django.utils.translation import check_for_language
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
-from .gateway import validate_voice_locale
+from .gateway import get_voice_locale, validate_voice_locale
 
 
 @method_decorator([never_cache, csrf_exempt], name='dispatch')
@@ -44,6 +44,4 @@ class TwilioCallApp(View):
         return locale
 
     def get_twilio_locale(self):
-        # Translators: twilio_locale should be a locale supported by
-        # Twilio, see http://bit.ly/187I5cr
-        return pgettext('twilio_locale', 'en')
+        return get_voice_locale(translation.get_language())
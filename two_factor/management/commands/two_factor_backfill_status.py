@@ -0,0 +1,35 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from ...models import TwoFactorStatus
+
+
+class Command(BaseCommand):
+    """
+    Command to (re)compute the stored two-factor status of users.
+
+    The command accepts any number of usernames, and computes the status of
+    every user when none is given. Run it once after enabling the
+    ``TWO_FACTOR_TRACK_STATUS`` setting.
+
+    Example usage::
+
+        manage.py two_factor_backfill_status
+        manage.py two_factor_backfill_status bouke steve
+    """
+    help = 'Computes the stored two-factor status for the given users (all users by default)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('args', metavar='usernames', nargs='*')
+
+    def handle(self, *usernames, **options):
+        User = get_user_model()
+        users = User.objects.all()
+        if usernames:
+            users = users.filter(**{'%s__in' % User.USERNAME_FIELD: usernames})
+
+        count = 0
+        for user_id in users.values_list('pk', flat=True).iterator():
+            TwoFactorStatus.objects.refresh_for_user(user_id)
+            count += 1
+        self.stdout.write('Updated the two-factor status of %d user(s)' % count)
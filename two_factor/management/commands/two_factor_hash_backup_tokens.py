@@ -0,0 +1,48 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django_otp.plugins.otp_static.models import StaticDevice
+
+from ...models import BackupToken, backup_token_hashing_enabled
+
+
+class Command(BaseCommand):
+    """
+    Command to replace the plaintext backup tokens of users by keyed hashes.
+
+    The command accepts any number of usernames, and hashes the tokens of
+    every user when none is given. Run it once after enabling the
+    ``TWO_FACTOR_HASH_BACKUP_TOKENS`` setting. Tokens are hashed with the
+    current ``SECRET_KEY``. Hashed tokens can't be turned back into plaintext:
+    if the setting is disabled again, they are neither accepted nor counted.
+
+    Example usage::
+
+        manage.py two_factor_hash_backup_tokens
+        manage.py two_factor_hash_backup_tokens bouke steve
+    """
+    help = 'Replaces the plaintext backup tokens of the given users (all users by default) by hashes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('args', metavar='usernames', nargs='*')
+
+    def handle(self, *usernames, **options):
+        if not backup_token_hashing_enabled():
+            raise CommandError('Hashed backup tokens are only verified and counted when '
+                               'TWO_FACTOR_HASH_BACKUP_TOKENS is set')
+
+        devices = StaticDevice.objects.filter(token_set__isnull=False).distinct()
+        if usernames:
+            User = get_user_model()
+            devices = devices.filter(**{'user__%s__in' % User.USERNAME_FIELD: usernames})
+
+        count = 0
+        for device in devices.iterator():
+            # One transaction per device, so that each device has either
+            # plaintext or hashed tokens
+            with transaction.atomic():
+                tokens = list(device.token_set.select_for_update().values_list('token', flat=True))
+                BackupToken.objects.bulk_create([BackupToken.from_token(device, token) for token in tokens])
+                device.token_set.filter(token__in=tokens).delete()
+            count += len(tokens)
+        self.stdout.write('Hashed %d backup token(s)' % count)
@@ -1,7 +1,7 @@
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand, CommandError
 
-from ...utils import default_device
+from ...utils import two_factor_enabled
 
 
 class Command(BaseCommand):
@@ -32,5 +32,5 @@ class Command(BaseCommand):
 
             self.stdout.write('%s: %s' % (
                 username,
-                'enabled' if default_device(user) else self.style.ERROR('disabled')
+                'enabled' if two_factor_enabled(user) else self.style.ERROR('disabled')
             ))
@@ -0,0 +1,41 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('two_factor', '0008_delete_phonedevice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TwoFactorStatus',
+            fields=[
+                ('user', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    primary_key=True,
+                    related_name='two_factor_status',
+                    serialize=False,
+                    to=settings.AUTH_USER_MODEL,
+                )),
+                ('enabled', models.BooleanField(default=False)),
+                ('device_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('method', models.CharField(blank=True, max_length=32)),
+                ('device_content_type', models.ForeignKey(
+                    blank=True,
+                    null=True,
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='+',
+                    to='contenttypes.contenttype',
+                )),
+            ],
+            options={
+                'verbose_name': 'two-factor status',
+                'verbose_name_plural': 'two-factor statuses',
+            },
+        ),
+    ]
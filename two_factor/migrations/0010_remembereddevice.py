@@ -0,0 +1,39 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('two_factor', '0009_twofactorstatus'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RememberedDevice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token_hash', models.CharField(max_length=64, unique=True)),
+                ('device_id', models.CharField(
+                    help_text='Persistent id of the device that verified the browser.',
+                    max_length=255,
+                )),
+                ('password_fingerprint', models.CharField(max_length=64)),
+                ('user_agent', models.CharField(blank=True, max_length=200)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_seen', models.DateTimeField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('user', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='remembered_devices',
+                    to=settings.AUTH_USER_MODEL,
+                )),
+            ],
+            options={
+                'verbose_name': 'remembered browser',
+                'verbose_name_plural': 'remembered browsers',
+            },
+        ),
+    ]
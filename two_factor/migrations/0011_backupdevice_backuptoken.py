@@ -0,0 +1,38 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('otp_static', '0003_add_timestamps'),
+        ('two_factor', '0010_remembereddevice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupDevice',
+            fields=[],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('otp_static.staticdevice',),
+        ),
+        migrations.CreateModel(
+            name='BackupToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token_hash', models.CharField(max_length=64)),
+                ('device', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='hashed_token_set',
+                    to='otp_static.staticdevice',
+                )),
+            ],
+            options={
+                'indexes': [models.Index(fields=['device', 'token_hash'], name='two_factor_backup_token_idx')],
+            },
+        ),
+    ]
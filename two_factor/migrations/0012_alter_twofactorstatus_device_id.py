@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('two_factor', '0011_backupdevice_backuptoken'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='twofactorstatus',
+            name='device_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,384 @@
+import hashlib
+import secrets
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from django.utils.encoding import force_bytes
+from django_otp import device_classes
+from django_otp.models import Device, ThrottlingMixin
+from django_otp.plugins.otp_static.models import StaticDevice
+
+from .throttling import get_throttle_backend
+from .utils import (
+    get_cache, invalidate_backup_tokens_cache, invalidate_default_device_cache,
+)
+
+STATUS_DEVICE_FIELDS = {'user', 'user_id', 'name', 'confirmed'}
+
+REMEMBER_TOKEN_CACHE_KEY = 'two_factor.remember_token.%s'
+
+# Remembered browsers record when they were last seen at most this often, to
+# avoid a database write on each remembered login.
+REMEMBER_TOKEN_LAST_SEEN_INTERVAL = 5 * 60
+
+
+class ConditionalThrottlingMixin(ThrottlingMixin):
+    """
+    :class:`~django_otp.models.ThrottlingMixin` keeping the throttling state
+    in the backend configured by TWO_FACTOR_THROTTLE_BACKEND (see
+    :mod:`two_factor.throttling`). By default the state is stored on the
+    device row, which is only written when the state changes: resetting a
+    clear throttle state, as on most successful verifications, does no UPDATE.
+    """
+    class Meta:
+        abstract = True
+
+    def verify_is_allowed(self):
+        get_throttle_backend().load(self)
+        return super().verify_is_allowed()
+
+    def throttle_reset(self, commit=True):
+        get_throttle_backend().reset(self, commit=commit)
+
+    def throttle_increment(self, commit=True):
+        get_throttle_backend().increment(self, commit=commit)
+
+
+def status_tracking_enabled():
+    """
+    Returns True if the :class:`TwoFactorStatus` table is kept up to date (as
+    configured by the TWO_FACTOR_TRACK_STATUS setting). Defaults to False.
+    """
+    return getattr(settings, 'TWO_FACTOR_TRACK_STATUS', False)
+
+
+class TwoFactorStatusManager(models.Manager):
+    def get_fields_for_user(self, user_id):
+        # local import to avoid circular import
+        from two_factor.plugins.registry import registry
+
+        for model in device_classes():
+            device = model.objects.filter(user_id=user_id, confirmed=True, name='default').first()
+            if device is not None:
+                return {
+                    'enabled': True,
+                    'device_content_type': ContentType.objects.get_for_model(model),
+                    'device_id': str(device.pk),
+                    'method': registry.method_from_device(device).code,
+                }
+        return {
+            'enabled': False,
+            'device_content_type': None,
+            'device_id': None,
+            'method': '',
+        }
+
+    def compute_for_user(self, user_id):
+        """
+        Returns the two-factor status of the given user, from its confirmed
+        device named 'default' (the one returned by
+        :func:`~two_factor.utils.default_device`), without storing it.
+        """
+        return self.model(user_id=user_id, **self.get_fields_for_user(user_id))
+
+    def refresh_for_user(self, user_id):
+        """
+        Recomputes and stores the two-factor status of the given user.
+        """
+        status, _ = self.update_or_create(user_id=user_id, defaults=self.get_fields_for_user(user_id))
+        return status
+
+
+class TwoFactorStatus(models.Model):
+    """
+    Denormalized two-factor status of a user, to answer "does this user have
+    two-factor enabled?" with a primary key lookup instead of querying every
+    device model. Only maintained when ``TWO_FACTOR_TRACK_STATUS`` is set.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True,
+                                on_delete=models.CASCADE, related_name='two_factor_status')
+    enabled = models.BooleanField(default=False)
+    device_content_type = models.ForeignKey(ContentType, null=True, blank=True,
+                                            on_delete=models.CASCADE, related_name='+')
+    # Primary key of the device, as a string to support any primary key type
+    device_id = models.CharField(max_length=255, null=True, blank=True)
+    method = models.CharField(max_length=32, blank=True)
+
+    objects = TwoFactorStatusManager()
+
+    class Meta:
+        verbose_name = 'two-factor status'
+        verbose_name_plural = 'two-factor statuses'
+
+    def __repr__(self):
+        return '<TwoFactorStatus(user_id={!r}, enabled={!r}, method={!r})>'.format(
+            self.user_id,
+            self.enabled,
+            self.method,
+        )
+
+    def get_device(self):
+        """
+        Returns the default device, or None if two-factor is not enabled.
+        """
+        if not self.enabled:
+            return None
+        model = ContentType.objects.get_for_id(self.device_content_type_id).model_class()
+        return model.objects.filter(pk=self.device_id).first()
+
+    def points_to(self, device):
+        return (
+            self.enabled and self.device_id == str(device.pk) and
+            self.device_content_type_id == ContentType.objects.get_for_model(device).pk
+        )
+
+
+def get_two_factor_status(user):
+    """
+    Returns the :class:`TwoFactorStatus` of the user. When it was not stored
+    yet, it is computed without being stored: only the device signals and
+    :meth:`~TwoFactorStatusManager.refresh_for_user` write the table.
+    """
+    try:
+        return TwoFactorStatus.objects.get(pk=user.pk)
+    except TwoFactorStatus.DoesNotExist:
+        return TwoFactorStatus.objects.compute_for_user(user.pk)
+
+
+def remember_token_store_enabled():
+    """
+    Returns True if remembered browsers are stored as :class:`RememberedDevice`
+    (as configured by the TWO_FACTOR_REMEMBER_TOKEN_STORE setting) instead of
+    being signed in the remember cookie. Defaults to False.
+    """
+    return getattr(settings, 'TWO_FACTOR_REMEMBER_TOKEN_STORE', False)
+
+
+def hash_remember_token(token):
+    return hashlib.sha256(force_bytes(token)).hexdigest()
+
+
+def get_password_fingerprint(user):
+    salt = 'two_factor.models.get_password_fingerprint'
+    return salted_hmac(salt, str(user.password), algorithm='sha256').hexdigest()
+
+
+class RememberedDeviceQuerySet(models.QuerySet):
+    def revoke(self):
+        """
+        Deletes the remembered browsers and drops them from the cache, so the
+        browsers have to verify a token again on their next login.
+        """
+        token_hashes = list(self.values_list('token_hash', flat=True))
+        if not token_hashes:
+            return 0
+        get_cache().delete_many([REMEMBER_TOKEN_CACHE_KEY % token_hash for token_hash in token_hashes])
+        count, _ = self.model.objects.filter(token_hash__in=token_hashes).delete()
+        return count
+
+
+class RememberedDeviceManager(models.Manager.from_queryset(RememberedDeviceQuerySet)):
+    def issue(self, user, device, user_agent=''):
+        """
+        Remembers a browser of the user, verified with the given device, and
+        returns the random token identifying it.
+
+        Expired browsers of the user are removed, as well as the least
+        recently seen ones above TWO_FACTOR_REMEMBER_TOKEN_MAX_PER_USER.
+        """
+        now = timezone.now()
+        max_per_user = getattr(settings, 'TWO_FACTOR_REMEMBER_TOKEN_MAX_PER_USER', 10)
+        kept = self.filter(user=user, expires_at__gt=now).order_by('-last_seen', '-pk')
+        kept_pks = list(kept.values_list('pk', flat=True)[:max(max_per_user - 1, 0)])
+        self.filter(user=user).exclude(pk__in=kept_pks).revoke()
+
+        token = secrets.token_urlsafe(32)
+        self.create(
+            user=user,
+            token_hash=hash_remember_token(token),
+            device_id=device.persistent_id,
+            password_fingerprint=get_password_fingerprint(user),
+            user_agent=user_agent[:200],
+            last_seen=now,
+            expires_at=now + timedelta(seconds=settings.TWO_FACTOR_REMEMBER_COOKIE_AGE),
+        )
+        return token
+
+    def lookup(self, token):
+        """
+        Returns the cached state of the remembered browser identified by the
+        token, as a dict, or None if the token is unknown or expired.
+        """
+        token_hash = hash_remember_token(token)
+        cache_key = REMEMBER_TOKEN_CACHE_KEY % token_hash
+        entry = get_cache().get(cache_key)
+        if entry is None:
+            remembered = self.filter(token_hash=token_hash).first()
+            if remembered is None:
+                return None
+            entry = remembered.as_cache_entry()
+            self._cache_entry(cache_key, entry)
+        if entry['expires_at'] <= timezone.now().timestamp():
+            return None
+        return entry
+
+    def touch(self, token, entry):
+        """
+        Records that the remembered browser was seen, at most once every
+        REMEMBER_TOKEN_LAST_SEEN_INTERVAL seconds.
+        """
+        now = timezone.now()
+        if now.timestamp() - entry['last_seen'] < REMEMBER_TOKEN_LAST_SEEN_INTERVAL:
+            return
+        self.filter(pk=entry['pk']).update(last_seen=now)
+        entry = {**entry, 'last_seen': now.timestamp()}
+        self._cache_entry(REMEMBER_TOKEN_CACHE_KEY % hash_remember_token(token), entry)
+
+    def _cache_entry(self, cache_key, entry):
+        timeout = int(entry['expires_at'] - timezone.now().timestamp())
+        if timeout > 0:
+            get_cache().set(cache_key, entry, timeout)
+
+
+class RememberedDevice(models.Model):
+    """
+    Browser remembered by a user, identified by the random token stored in
+    its remember cookie. Only used when ``TWO_FACTOR_REMEMBER_TOKEN_STORE`` is
+    set, which allows revoking remembered browsers individually.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                             related_name='remembered_devices')
+    token_hash = models.CharField(max_length=64, unique=True)
+    device_id = models.CharField(max_length=255,
+                                 help_text="Persistent id of the device that verified the browser.")
+    password_fingerprint = models.CharField(max_length=64)
+    user_agent = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = RememberedDeviceManager()
+
+    class Meta:
+        verbose_name = 'remembered browser'
+        verbose_name_plural = 'remembered browsers'
+
+    def __repr__(self):
+        return '<RememberedDevice(user_id={!r}, device_id={!r}, last_seen={!r})>'.format(
+            self.user_id,
+            self.device_id,
+            self.last_seen,
+        )
+
+    def as_cache_entry(self):
+        return {
+            'pk': self.pk,
+            'user_id': self.user_id,
+            'device_id': self.device_id,
+            'password_fingerprint': self.password_fingerprint,
+            'last_seen': self.last_seen.timestamp(),
+            'expires_at': self.expires_at.timestamp(),
+        }
+
+
+def backup_token_hashing_enabled():
+    """
+    Returns True if new backup tokens are stored as keyed hashes in
+    :class:`BackupToken` (as configured by the TWO_FACTOR_HASH_BACKUP_TOKENS
+    setting) instead of plaintext :class:`~django_otp.plugins.otp_static.models.StaticToken`
+    rows. Defaults to False.
+    """
+    return getattr(settings, 'TWO_FACTOR_HASH_BACKUP_TOKENS', False)
+
+
+def hash_backup_token(token, secret=None):
+    salt = 'two_factor.models.hash_backup_token'
+    return salted_hmac(salt, str(token), secret=secret, algorithm='sha256').hexdigest()
+
+
+class BackupDevice(StaticDevice):
+    """
+    :class:`~django_otp.plugins.otp_static.models.StaticDevice` verifying the
+    hashed :class:`BackupToken` objects of the device, with one indexed lookup
+    and the deletion of the matched token. Tokens that were not hashed yet are
+    still accepted.
+    """
+    class Meta:
+        proxy = True
+
+    def verify_token(self, token):
+        verify_allowed, _ = self.verify_is_allowed()
+        if not verify_allowed:
+            return False
+        # Tokens hashed with a rotated secret key remain valid
+        keys = [settings.SECRET_KEY, *getattr(settings, 'SECRET_KEY_FALLBACKS', [])]
+        token_hashes = [hash_backup_token(token, key) for key in keys]
+        # Of concurrent verifications of a token, only one deletes it
+        deleted, _ = BackupToken.objects.filter(device_id=self.pk, token_hash__in=token_hashes).delete()
+        if not deleted:
+            return super().verify_token(token)
+        self.throttle_reset(commit=False)
+        self.set_last_used_timestamp(commit=False)
+        self.save()
+        return True
+
+
+class BackupToken(models.Model):
+    """
+    Backup token of a :class:`~django_otp.plugins.otp_static.models.StaticDevice`,
+    stored as a keyed hash of the token. Only used when
+    ``TWO_FACTOR_HASH_BACKUP_TOKENS`` is set.
+    """
+    device = models.ForeignKey(StaticDevice, on_delete=models.CASCADE,
+                               related_name='hashed_token_set')
+    token_hash = models.CharField(max_length=64)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['device', 'token_hash'], name='two_factor_backup_token_idx'),
+        ]
+
+    def __repr__(self):
+        return '<BackupToken(device_id={!r})>'.format(self.device_id)
+
+    @classmethod
+    def from_token(cls, device, token):
+        return cls(device=device, token_hash=hash_backup_token(token))
+
+
+def device_saved(sender, instance, update_fields=None, **kwargs):
+    if not isinstance(instance, Device):
+        return
+    if isinstance(instance, StaticDevice):
+        # Static devices are saved when one of their tokens is used
+        invalidate_backup_tokens_cache(instance.user_id)
+    if update_fields is not None and not STATUS_DEVICE_FIELDS.intersection(update_fields):
+        return
+    invalidate_default_device_cache(instance.user_id, instance)
+    if not status_tracking_enabled():
+        return
+    status = TwoFactorStatus.objects.filter(pk=instance.user_id).first()
+    is_default = instance.confirmed and instance.name == 'default'
+    if status is None or is_default != status.points_to(instance):
+        TwoFactorStatus.objects.refresh_for_user(instance.user_id)
+
+
+def device_deleted(sender, instance, **kwargs):
+    if not isinstance(instance, Device):
+        return
+    if isinstance(instance, StaticDevice):
+        invalidate_backup_tokens_cache(instance.user_id)
+    invalidate_default_device_cache(instance.user_id)
+    if remember_token_store_enabled():
+        RememberedDevice.objects.filter(user_id=instance.user_id, device_id=instance.persistent_id).revoke()
+    if not status_tracking_enabled():
+        return
+    # Users without a stored status get it computed on first use, which also
+    # avoids creating one for a user whose deletion cascades to its devices.
+    status = TwoFactorStatus.objects.filter(pk=instance.user_id).first()
+    if status is not None and status.points_to(instance):
+        TwoFactorStatus.objects.refresh_for_user(instance.user_id)
@@ -14,6 +14,12 @@ class EmailMethod(MethodBase):
     def get_devices(self, user):
         return EmailDevice.objects.devices_for_user(user).all()
 
+    def get_device_model(self):
+        return EmailDevice
+
+    def filter_devices(self, devices):
+        return [device for device in super().filter_devices(devices) if device.confirmed]
+
     def recognize_device(self, device):
         return isinstance(device, EmailDevice)
 
@@ -11,6 +11,9 @@ class PhoneMethodBase(MethodBase):
     def get_devices(self, user):
         return PhoneDevice.objects.filter(user=user, method=self.code)
 
+    def get_device_model(self):
+        return PhoneDevice
+
     def recognize_device(self, device):
         return isinstance(device, PhoneDevice) and device.method == self.code
 
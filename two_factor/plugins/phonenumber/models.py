@@ -1,14 +1,21 @@
+import logging
 from binascii import unhexlify
 
 from django.conf import settings
 from django.db import models
 from django.utils.translation import gettext_lazy as _
-from django_otp.models import Device, ThrottlingMixin
-from django_otp.oath import totp
+from django_otp.models import Device
 from django_otp.util import hex_validator, random_hex
 from phonenumber_field.modelfields import PhoneNumberField
 
 from two_factor.gateways import make_call, send_sms, send_whatsapp
+from two_factor.models import ConditionalThrottlingMixin
+from two_factor.ratelimit import take_phone_quota
+from two_factor.totp import match_totp, totp
+
+from .utils import mask_phone_number
+
+logger = logging.getLogger(__name__)
 
 WHATSAPP = 'whatsapp'
 PHONE_METHODS = (
@@ -23,7 +30,7 @@ def key_validator(*args, **kwargs):
     return hex_validator()(*args, **kwargs)
 
 
-class PhoneDevice(ThrottlingMixin, Device):
+class PhoneDevice(ConditionalThrottlingMixin, Device):
     """
     Model with phone number and token seed linked to a user.
     """
@@ -52,15 +59,8 @@ class PhoneDevice(ThrottlingMixin, Device):
         # local import to avoid circular import
         from two_factor.utils import totp_digits
 
-        try:
-            token = int(token)
-        except ValueError:
-            return False
-
-        for drift in range(-5, 1):
-            if totp(self.bin_key, drift=drift, digits=totp_digits()) == token:
-                return True
-        return False
+        # Tokens sent during the last five steps are valid, the latest first
+        return match_totp(self.bin_key, token, range(0, -6, -1), digits=totp_digits()) is not None
 
     def verify_token(self, token):
         # If the PhoneDevice doesn't have an id, we are setting up the device,
@@ -87,10 +87,17 @@ class PhoneDevice(ThrottlingMixin, Device):
 
         """
         Sends the current TOTP token to `self.number` using `self.method`.
+        Returns False when no token was sent, because the device is throttled
+        or the quota is exceeded.
         """
         verify_allowed, _ = self.verify_is_allowed()
         if not verify_allowed:
-            return None
+            return False
+
+        if not take_phone_quota(self):
+            logger.warning('Quota exceeded, not sending a %s challenge to %s.',
+                           self.method, mask_phone_number(self.number))
+            return False
 
         no_digits = totp_digits()
         token = str(totp(self.bin_key, digits=no_digits)).zfill(no_digits)
@@ -4,7 +4,7 @@ import phonenumbers
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 
-from two_factor.plugins.registry import MethodNotFoundError, registry
+from two_factor.plugins.registry import registry
 
 phone_mask = re.compile(r'(?<=.{3})[0-9](?=.{2})')
 
@@ -37,14 +37,11 @@ def backup_phones(user):
     if not user or user.is_anonymous:
         return []
 
+    all_devices = registry.get_all_devices(user)
     phones = []
     for method_name, _ in get_available_phone_methods():
-        try:
-            method = registry.get_method(method_name)  # Fetch method object
-            phones += list(method.get_devices(user))
-        except MethodNotFoundError:
-            # Handle missing method gracefully
-            continue
+        # Methods missing from the registry are ignored
+        phones += all_devices.get(method_name, [])
 
     return [phone for phone in phones if phone.name == 'backup']
 
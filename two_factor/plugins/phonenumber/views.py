@@ -6,7 +6,9 @@ from django.views.generic import DeleteView
 from django_otp.decorators import otp_required
 from django_otp.util import random_hex
 
+from two_factor.challenges import dispatch_challenge
 from two_factor.forms import DeviceValidationForm
+from two_factor.utils import invalidate_device_snapshot
 from two_factor.views.utils import IdempotentSessionWizardView
 
 from .forms import PhoneNumberMethodForm
@@ -45,6 +47,7 @@ class PhoneSetupView(IdempotentSessionWizardView):
         Store the device and redirect to profile page.
         """
         self.get_device(user=self.request.user, name='backup').save()
+        invalidate_device_snapshot(self.request.user)
         return redirect(self.success_url)
 
     def render_next_step(self, form, **kwargs):
@@ -53,7 +56,7 @@ class PhoneSetupView(IdempotentSessionWizardView):
         """
         next_step = self.steps.next
         if next_step == 'validation':
-            self.get_device().generate_challenge()
+            dispatch_challenge(self.get_device(), self.request)
         return super().render_next_step(form, **kwargs)
 
     def get_form_kwargs(self, step=None):
@@ -97,3 +100,8 @@ class PhoneDeleteView(DeleteView):
 
     def get_success_url(self):
         return resolve_url(self.success_url)
+
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        invalidate_device_snapshot(self.request.user)
+        return response
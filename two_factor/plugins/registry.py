@@ -18,10 +18,27 @@ class MethodBase:
     def get_devices(self, user):
         raise NotImplementedError()
 
+    def get_device_model(self):
+        """
+        Return the model class of the devices handled by this method, or None.
+
+        Methods sharing the same device model have their devices fetched with
+        a single query by :meth:`MethodRegistry.get_all_devices`. Subclasses
+        overriding :meth:`get_devices` without overriding this method have
+        their devices fetched with :meth:`get_devices`.
+        """
+        return None
+
+    def filter_devices(self, devices):
+        """
+        Return the devices handled by this method, out of all the user's
+        devices of the model returned by :meth:`get_device_model`.
+        """
+        return [device for device in devices if self.recognize_device(device)]
+
     def get_other_authentication_devices(self, user, main_device):
-        devices = self.get_devices(user)
         return (
-            device for device in devices
+            device for device in registry.get_method_devices(self, user)
             if (type(device) is not type(main_device)) or (device.pk != main_device.pk)
         )
 
@@ -67,6 +84,14 @@ class GeneratorMethod(MethodBase):
     def get_devices(self, user):
         return user.totpdevice_set.all()
 
+    def get_device_model(self):
+        from django_otp.plugins.otp_totp.models import TOTPDevice
+
+        return TOTPDevice
+
+    def recognize_device(self, device):
+        return isinstance(device, self.get_device_model())
+
     def get_setup_forms(self, *args):
         from two_factor.forms import TOTPDeviceForm
 
@@ -79,35 +104,109 @@ class GeneratorMethod(MethodBase):
         return _('Please enter the token generated by your token generator.')
 
 
+def _reads_model_devices(method):
+    """
+    Return True if the devices of `method` can be read from its device model,
+    that is unless a subclass overrides :meth:`MethodBase.get_devices` (e.g.
+    to filter the devices) but inherits :meth:`MethodBase.get_device_model`.
+    """
+    mro = type(method).__mro__
+    owner = next(cls for cls in mro if 'get_devices' in vars(cls))
+    model_owner = next(cls for cls in mro if 'get_device_model' in vars(cls))
+    return mro.index(model_owner) <= mro.index(owner)
+
+
 class MethodRegistry:
-    _methods = []
+    """
+    Registry of the available methods.
 
+    Methods are indexed by code and, lazily, by the class of the devices they
+    recognize, so that lookups don't depend on the number of registered
+    methods. Both indexes are rebuilt whenever the registered methods change.
+    """
     def __init__(self):
+        self._methods = []
         self.register(GeneratorMethod())
 
+    def _get_methods(self):
+        return self._method_list
+
+    def _set_methods(self, methods):
+        self._method_list = list(methods)
+        self._rebuild_index()
+
+    _methods = property(_get_methods, _set_methods)
+
+    def _rebuild_index(self):
+        self._methods_by_code = {}
+        for method in self._method_list:
+            self._methods_by_code.setdefault(method.code, method)
+        self._methods_by_device_class = {}
+
     def register(self, method):
-        for registered_method in self._methods:
-            if method.code == registered_method.code:
-                return   # Already registered, ignore.
+        if method.code in self._methods_by_code:
+            return   # Already registered, ignore.
 
-        self._methods.append(method)
+        self._method_list.append(method)
+        self._rebuild_index()
 
     def unregister(self, code):
-        self._methods = [m for m in self._methods if m.code != code]
+        if code in self._methods_by_code:
+            self._methods = [m for m in self._methods if m.code != code]
 
     def get_method(self, code):
         try:
-            return [meth for meth in self._methods if meth.code == code][0]
-        except IndexError:
+            return self._methods_by_code[code]
+        except KeyError:
             raise MethodNotFoundError(code, self._methods)
 
     def get_methods(self):
-        return self._methods
+        # A snapshot: register() and unregister() are the only ways to change
+        # the registered methods and keep the indexes in sync.
+        return tuple(self._methods)
+
+    def get_method_devices(self, method, user, snapshot=None):
+        """
+        Return the list of the user's devices for `method`, read from
+        `snapshot` or else the user's device snapshot when there is one, and
+        from :meth:`MethodBase.get_devices` otherwise.
+        """
+        from two_factor.utils import USER_DEVICE_SNAPSHOT_ATTR_NAME
+
+        if snapshot is None:
+            snapshot = getattr(user, USER_DEVICE_SNAPSHOT_ATTR_NAME, None)
+        model = method.get_device_model()
+        if snapshot is None or model is None or not _reads_model_devices(method):
+            return list(method.get_devices(user))
+        return method.filter_devices(snapshot.get_model_devices(model))
+
+    def get_all_devices(self, user):
+        """
+        Return a dict mapping the code of each registered method to the list
+        of the user's devices for that method.
+
+        Each device model is only queried once, even if it backs several
+        methods (e.g. the phone methods). Devices are read from the user's
+        device snapshot when there is one.
+        """
+        from two_factor.utils import (
+            USER_DEVICE_SNAPSHOT_ATTR_NAME, DeviceSnapshot,
+        )
+
+        snapshot = getattr(user, USER_DEVICE_SNAPSHOT_ATTR_NAME, None) or DeviceSnapshot(user)
+        return {method.code: self.get_method_devices(method, user, snapshot) for method in self._methods}
 
     def method_from_device(self, device):
-        for method in self._methods:
+        # Several methods may share a device class (e.g. the phone methods),
+        # so the cache holds the candidates already seen for each class.
+        candidates = self._methods_by_device_class.setdefault(type(device), [])
+        for method in candidates:
             if method.recognize_device(device):
                 return method
+        for method in self._methods:
+            if method not in candidates and method.recognize_device(device):
+                candidates.append(method)
+                return method
         # Default to GeneratorMethod
         return GeneratorMethod()
 
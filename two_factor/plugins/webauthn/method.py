@@ -1,6 +1,6 @@
 from django.utils.translation import gettext_lazy as _
 
-from two_factor.plugins.registry import MethodBase
+from two_factor.plugins.registry import MethodBase, registry
 
 from .forms import (
     WebauthnAuthenticationTokenForm, WebauthnDeviceValidationForm,
@@ -16,6 +16,9 @@ class WebAuthnMethod(MethodBase):
     def get_devices(self, user):
         return user.webauthn_keys.all()
 
+    def get_device_model(self):
+        return WebauthnDevice
+
     def get_other_authentication_devices(self, user, main_device):
         # authentication is attempted on all WebAuthn devices at the same time
         # if main_device is a WebAuthn device then WebAuthn is the primary method
@@ -23,7 +26,7 @@ class WebAuthnMethod(MethodBase):
         if self.recognize_device(main_device):
             return []
 
-        for device in self.get_devices(user):
+        for device in registry.get_method_devices(self, user):
             # first WebAuthn device found is enough to trigger on all of them at the same time
             return [device]
         return []
@@ -1,9 +1,11 @@
 from django.conf import settings
 from django.db import models
-from django_otp.models import Device, ThrottlingMixin
+from django_otp.models import Device
 
+from two_factor.models import ConditionalThrottlingMixin
 
-class WebauthnDevice(ThrottlingMixin, Device):
+
+class WebauthnDevice(ConditionalThrottlingMixin, Device):
     """
     Model for Webauthn authentication
     """
@@ -13,6 +13,9 @@ class YubikeyMethod(MethodBase):
     def get_devices(self, user):
         return RemoteYubikeyDevice.objects.filter(user=user)
 
+    def get_device_model(self):
+        return RemoteYubikeyDevice
+
     def recognize_device(self, device):
         return isinstance(device, RemoteYubikeyDevice)
 
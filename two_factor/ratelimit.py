@@ -0,0 +1,183 @@
+import time
+from contextlib import suppress
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .utils import get_cache
+
+
+def client_ip_key(request, view):
+    """
+    Rate limiting key of the client IP address. Override it with a key
+    function reading e.g. ``X-Forwarded-For`` when running behind a proxy.
+    """
+    return 'ip:%s' % request.META.get('REMOTE_ADDR', '')
+
+
+def user_key(request, view):
+    """
+    Rate limiting key of the user authenticated by the first login step, read
+    from the wizard storage without loading the user. Returns None (no limit)
+    before the user has been authenticated.
+    """
+    user_pk = view.storage.data.get('user_pk')
+    if not user_pk:
+        return None
+    return 'user:%s' % user_pk
+
+
+class SlidingWindowRateLimiter:
+    """
+    Allows `limit` hits per `window` seconds for each key, estimating the hits
+    of the sliding window from two fixed windows counted in the cache: the
+    hits of the previous window are weighted by its overlap with the sliding
+    window.
+    """
+    cache_key_prefix = 'two_factor.ratelimit'
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+
+    def hit(self, key):
+        """
+        Records a hit for the key and returns True if the key exceeds the
+        limit, including this hit.
+        """
+        cache = get_cache()
+        now = time.time()
+        current = int(now // self.window)
+        current_key = '%s.%s.%s.%d' % (self.cache_key_prefix, self.window, key, current)
+        previous_key = '%s.%s.%s.%d' % (self.cache_key_prefix, self.window, key, current - 1)
+
+        cache.add(current_key, 0, self.window * 2)
+        try:
+            current_hits = cache.incr(current_key)
+        except ValueError:
+            current_hits = 1
+            cache.set(current_key, current_hits, self.window * 2)
+        previous_hits = cache.get(previous_key, 0)
+
+        overlap = 1 - (now % self.window) / self.window
+        return previous_hits * overlap + current_hits > self.limit
+
+
+def get_login_rate_limits():
+    """
+    Returns (key function, limiter) pairs, as configured by the
+    TWO_FACTOR_LOGIN_RATE_LIMITS setting: a list of
+    ``(key function, limit, window)`` tuples where the key function is a
+    callable or its dotted path. Defaults to no limits.
+    """
+    rate_limits = []
+    for key_func, limit, window in getattr(settings, 'TWO_FACTOR_LOGIN_RATE_LIMITS', None) or []:
+        if isinstance(key_func, str):
+            key_func = import_string(key_func)
+        rate_limits.append((key_func, SlidingWindowRateLimiter(limit, window)))
+    return rate_limits
+
+
+def is_rate_limited(request, view):
+    """
+    Records a hit for each configured rate limit of the request and returns
+    the longest window exceeded, or None if no limit is exceeded.
+    """
+    exceeded = None
+    for key_func, limiter in get_login_rate_limits():
+        key = key_func(request, view)
+        if key is not None and limiter.hit(key):
+            exceeded = max(exceeded or 0, limiter.window)
+    return exceeded
+
+
+class TokenBucket:
+    """
+    Bucket of `capacity` tokens per key, refilled at `capacity` tokens per
+    `period` seconds. The cache counts the tokens taken against the tokens
+    refilled since the epoch, with atomic increments so that concurrent
+    requests can't take the same token.
+    """
+    cache_key_prefix = 'two_factor.token_bucket'
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+
+    def get_cache_key(self, key):
+        return '%s.%s.%s.%s' % (self.cache_key_prefix, self.capacity, self.period, key)
+
+    def take(self, key, now):
+        """
+        Takes a token for the key and returns True, or returns False when the
+        bucket is empty.
+        """
+        cache = get_cache()
+        cache_key = self.get_cache_key(key)
+        refilled = int(now * self.capacity / self.period)
+        # The bucket is full again after `period` seconds at most
+        timeout = self.period + 1
+
+        cache.add(cache_key, refilled - self.capacity, timeout)
+        try:
+            taken = cache.incr(cache_key)
+        except ValueError:
+            taken = refilled - self.capacity + 1
+            cache.set(cache_key, taken, timeout)
+        if taken > refilled:
+            self.give_back(key)
+            return False
+        if taken <= refilled - self.capacity:
+            # The bucket was refilled beyond its capacity while unused
+            with suppress(ValueError):
+                cache.incr(cache_key, refilled - self.capacity + 1 - taken)
+        cache.touch(cache_key, timeout)
+        return True
+
+    def give_back(self, key):
+        """
+        Puts back a token taken for the key.
+        """
+        with suppress(ValueError):
+            get_cache().decr(self.get_cache_key(key))
+
+
+def take_tokens(buckets):
+    """
+    Takes a token from each of the ``(bucket, key)`` pairs and returns True,
+    or returns False without taking any token when one of them is empty.
+    """
+    now = time.time()
+    taken = []
+    for bucket, key in buckets:
+        if not bucket.take(key, now):
+            for taken_bucket, taken_key in taken:
+                taken_bucket.give_back(taken_key)
+            return False
+        taken.append((bucket, key))
+    return True
+
+
+def get_phone_quotas(method):
+    """
+    Returns (bucket, key function) pairs limiting the challenges sent with the
+    phone `method` (``'call'``, ``'sms'`` or ``'whatsapp'``), as configured by
+    the TWO_FACTOR_PHONE_QUOTAS setting. Defaults to no quotas.
+    """
+    quotas = (getattr(settings, 'TWO_FACTOR_PHONE_QUOTAS', None) or {}).get(method) or {}
+    key_funcs = {
+        'number': lambda number: '%s.number.%s' % (method, number.as_e164),
+        'country': lambda number: '%s.country.%s' % (method, number.country_code),
+    }
+    return [(TokenBucket(capacity, period), key_funcs[scope])
+            for scope, (capacity, period) in quotas.items()]
+
+
+def take_phone_quota(device):
+    """
+    Takes a token from each quota of the phone device's number and method.
+    Returns False when one of them is exhausted, in which case no challenge
+    should be sent.
+    """
+    return take_tokens([(bucket, key_func(device.number))
+                        for bucket, key_func in get_phone_quotas(device.method)])
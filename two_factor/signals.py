@@ -2,3 +2,10 @@ from django.dispatch import Signal
 
 # Signal additional parameters are: request, user, and device.
 user_verified = Signal()
+
+# Signal additional parameters are: request, device, and exception.
+challenge_failed = Signal()
+
+# Signal additional parameters are: channel, gateway, duration, exception, and
+# country_code.
+gateway_called = Signal()
@@ -0,0 +1,151 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .utils import get_cache
+
+
+def get_throttle_backend():
+    """
+    Returns the backend storing the throttling state of devices, as configured
+    by the TWO_FACTOR_THROTTLE_BACKEND setting. Defaults to
+    :class:`ModelThrottleBackend`.
+    """
+    import_path = getattr(settings, 'TWO_FACTOR_THROTTLE_BACKEND',
+                          'two_factor.throttling.ModelThrottleBackend')
+    return get_throttle_backend_instance(import_path)
+
+
+@lru_cache(maxsize=None)
+def get_throttle_backend_instance(import_path):
+    # Backends are shared by the whole process, so that token verifications
+    # don't import and instantiate them each time
+    return import_string(import_path)()
+
+
+@receiver(setting_changed)
+def reset_throttle_backends(setting, **kwargs):
+    if setting.startswith('TWO_FACTOR_THROTTLE_'):
+        get_throttle_backend_instance.cache_clear()
+
+
+class ModelThrottleBackend:
+    """
+    Stores the throttling state on the device row, only writing the
+    throttling fields and only when they change.
+    """
+
+    def load(self, device):
+        pass
+
+    def reset(self, device, commit=True):
+        if device.throttling_failure_count == 0 and device.throttling_failure_timestamp is None:
+            return
+        device.throttling_failure_timestamp = None
+        device.throttling_failure_count = 0
+        if commit:
+            self._commit(device, throttling_failure_timestamp=None, throttling_failure_count=0)
+
+    def increment(self, device, commit=True):
+        device.throttling_failure_timestamp = timezone.now()
+        device.throttling_failure_count += 1
+        if commit:
+            # F() keeps concurrent failed attempts from overwriting each other
+            self._commit(device, throttling_failure_timestamp=device.throttling_failure_timestamp,
+                         throttling_failure_count=F('throttling_failure_count') + 1)
+
+    def _commit(self, device, **values):
+        if device.pk is None:
+            device.save()
+        else:
+            type(device)._default_manager.filter(pk=device.pk).update(**values)
+
+
+class CacheThrottleBackend(ModelThrottleBackend):
+    """
+    Stores the throttling state in the cache configured by
+    TWO_FACTOR_CACHE_ALIAS, counting failed attempts with atomic increments so
+    that failures do not write the device row.
+
+    The state is persisted to the device row at most once every
+    TWO_FACTOR_THROTTLE_PERSIST_INTERVAL seconds, if set. The persisted state
+    is used when the cache holds no state for the device.
+    """
+    cache_key_prefix = 'two_factor.throttle.%s'
+    # Minimum and maximum number of seconds the state is cached, see
+    # get_timeout()
+    timeout = 24 * 60 * 60
+    max_timeout = 30 * 24 * 60 * 60
+
+    def get_timeout(self, device, count):
+        """
+        Returns the number of seconds the state of the device is cached after
+        `count` failures: twice the delay they impose (at least
+        :attr:`timeout`), so that the count outlives the lockout and keeps
+        growing. Beyond :attr:`max_timeout`, the state is cached without
+        expiry.
+        """
+        delay = device.get_throttle_factor() * 2 ** (count - 1) if count else 0
+        if 2 * delay > self.max_timeout:
+            return None
+        return max(self.timeout, 2 * delay)
+
+    def get_cache_keys(self, device):
+        prefix = self.cache_key_prefix % device.persistent_id
+        return prefix + '.count', prefix + '.timestamp', prefix + '.persisted'
+
+    def load(self, device):
+        if device.pk is None:
+            return
+        count_key, timestamp_key, _ = self.get_cache_keys(device)
+        values = get_cache().get_many([count_key, timestamp_key])
+        if count_key in values:
+            device.throttling_failure_count = values[count_key]
+            device.throttling_failure_timestamp = values.get(timestamp_key)
+
+    def reset(self, device, commit=True):
+        if device.pk is None:
+            return super().reset(device, commit=commit)
+        if device.throttling_failure_count == 0 and device.throttling_failure_timestamp is None:
+            return
+        device.throttling_failure_timestamp = None
+        device.throttling_failure_count = 0
+        get_cache().delete_many(self.get_cache_keys(device))
+        if not commit:
+            # The caller saves the device
+            return
+        # Only happens after failed attempts, which may have been persisted
+        type(device)._default_manager.filter(pk=device.pk).exclude(
+            throttling_failure_count=0, throttling_failure_timestamp=None,
+        ).update(throttling_failure_timestamp=None, throttling_failure_count=0)
+
+    def increment(self, device, commit=True):
+        if device.pk is None:
+            return super().increment(device, commit=commit)
+        cache = get_cache()
+        count_key, timestamp_key, persisted_key = self.get_cache_keys(device)
+        now = timezone.now()
+        # Seeded with the loaded state, as persisted on the row
+        cache.add(count_key, device.throttling_failure_count, self.timeout)
+        try:
+            count = cache.incr(count_key)
+        except ValueError:
+            count = device.throttling_failure_count + 1
+            cache.set(count_key, count, self.timeout)
+        # The delay grows with the count, and so does the lifetime of the state
+        timeout = self.get_timeout(device, count)
+        cache.touch(count_key, timeout)
+        cache.set(timestamp_key, now, timeout)
+        device.throttling_failure_count = count
+        device.throttling_failure_timestamp = now
+
+        persist_interval = getattr(settings, 'TWO_FACTOR_THROTTLE_PERSIST_INTERVAL', None)
+        if persist_interval and cache.add(persisted_key, True, persist_interval):
+            type(device)._default_manager.filter(pk=device.pk).update(
+                throttling_failure_timestamp=now, throttling_failure_count=count,
+            )
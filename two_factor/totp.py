@@ -0,0 +1,69 @@
+import hmac
+from hashlib import sha1
+from struct import pack
+
+from django_otp.oath import TOTP
+
+
+def keyed_hmac(key):
+    """
+    Returns a HMAC-SHA1 context keyed with `key`, to be copied for each
+    message instead of setting up the key again.
+    """
+    return hmac.new(key, digestmod=sha1)
+
+
+def hotp_from_hmac(mac, counter, digits=6):
+    """
+    Returns the HOTP code at `counter` of the key of `mac`, a context returned
+    by :func:`keyed_hmac`.
+    """
+    mac = mac.copy()
+    mac.update(pack(b'>Q', counter))
+    hs = mac.digest()
+    offset = hs[19] & 0x0F
+    bin_code = int.from_bytes(hs[offset:offset + 4], 'big') & 0x7FFFFFFF
+    return bin_code % 10 ** digits
+
+
+def hotp(key, counter, digits=6):
+    """
+    Returns the HOTP code of `key` at `counter`, as
+    :func:`django_otp.oath.hotp`.
+    """
+    return hotp_from_hmac(keyed_hmac(key), counter, digits)
+
+
+def totp_counter(step=30, t0=0, drift=0, now=None):
+    # The time step of django_otp's TOTP, so that codes always agree with its
+    # devices
+    counter = TOTP(b'', step, t0, drift=drift)
+    if now is not None:
+        counter.time = now
+    return counter.t()
+
+
+def totp(key, step=30, t0=0, digits=6, drift=0, now=None):
+    """
+    Returns the current TOTP code of `key`, as :func:`django_otp.oath.totp`.
+    """
+    return hotp(key, totp_counter(step, t0, drift, now), digits)
+
+
+def match_totp(key, token, offsets, step=30, t0=0, digits=6, drift=0, now=None):
+    """
+    Returns the first of `offsets` (numbers of time steps added to `drift`)
+    at which `token` is the TOTP code of `key`, or None if it matches none of
+    them. The time step is computed and the key set up once for the whole
+    window.
+    """
+    try:
+        token = int(token)
+    except (TypeError, ValueError):
+        return None
+    counter = totp_counter(step, t0, drift, now)
+    mac = keyed_hmac(key)
+    for offset in offsets:
+        if hotp_from_hmac(mac, counter + offset, digits) == token:
+            return offset
+    return None
@@ -2,8 +2,8 @@ from django.apps.registry import apps
 from django.urls import include, path
 
 from two_factor.views import (
-    BackupTokensView, DisableView, LoginView, ProfileView, QRGeneratorView,
-    SetupCompleteView, SetupView,
+    BackupTokensView, DisableView, ForgetBrowsersView, LoginView, ProfileView,
+    QRGeneratorView, SetupCompleteView, SetupView,
 )
 
 core = [
@@ -45,6 +45,11 @@ profile = [
         DisableView.as_view(),
         name='disable',
     ),
+    path(
+        'account/two_factor/browsers/forget/',
+        ForgetBrowsersView.as_view(),
+        name='forget_browsers',
+    ),
 ]
 
 plugin_urlpatterns = []
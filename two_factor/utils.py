@@ -1,9 +1,162 @@
+import secrets
 from urllib.parse import quote, urlencode
 
+from django.apps import apps
 from django.conf import settings
-from django_otp import devices_for_user
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import (
+    BooleanField, Count, Exists, ExpressionWrapper, OuterRef, Q, Subquery,
+    Value,
+)
+from django.db.models.functions import Coalesce
+from django_otp import device_classes, devices_for_user
 
 USER_DEFAULT_DEVICE_ATTR_NAME = "_default_device"
+USER_DEVICE_SNAPSHOT_ATTR_NAME = "_device_snapshot"
+DEFAULT_DEVICE_CACHE_KEY = "two_factor.default_device.%s"
+BACKUP_TOKENS_CACHE_KEY = "two_factor.backup_tokens.%s"
+
+
+class DeviceSnapshot:
+    """
+    In-memory copy of a user's devices, where each device model is queried at
+    most once.
+
+    Use :func:`device_snapshot` to attach a snapshot to the user handled by
+    the current request, and :func:`invalidate_device_snapshot` after saving
+    or deleting one of its devices.
+    """
+    def __init__(self, user):
+        self.user = user
+        self._devices_by_model = {}
+
+    def get_model_devices(self, model):
+        """
+        Returns all the user's devices of the given model.
+        """
+        if model not in self._devices_by_model:
+            self._devices_by_model[model] = list(model.objects.devices_for_user(self.user))
+        return self._devices_by_model[model]
+
+    def get_devices(self, confirmed=True):
+        """
+        Same as :func:`django_otp.devices_for_user`, served from memory.
+        """
+        devices = []
+        for model in device_classes():
+            devices += [
+                device for device in self.get_model_devices(model)
+                if confirmed is None or device.confirmed == bool(confirmed)
+            ]
+        return devices
+
+    def invalidate(self):
+        self._devices_by_model = {}
+
+
+def device_snapshot(user):
+    """
+    Returns the :class:`DeviceSnapshot` attached to `user`, creating it if
+    needed.
+    """
+    snapshot = getattr(user, USER_DEVICE_SNAPSHOT_ATTR_NAME, None)
+    if snapshot is None:
+        snapshot = DeviceSnapshot(user)
+        setattr(user, USER_DEVICE_SNAPSHOT_ATTR_NAME, snapshot)
+    return snapshot
+
+
+def invalidate_device_snapshot(user):
+    """
+    Forgets the devices cached on `user`, to be called when one of its
+    devices was saved or deleted.
+    """
+    snapshot = getattr(user, USER_DEVICE_SNAPSHOT_ATTR_NAME, None)
+    if snapshot is not None:
+        snapshot.invalidate()
+    invalidate_default_device_cache(user.pk)
+    if hasattr(user, USER_DEFAULT_DEVICE_ATTR_NAME):
+        delattr(user, USER_DEFAULT_DEVICE_ATTR_NAME)
+
+
+def get_cache():
+    """
+    Returns the cache used by two_factor, as configured by the
+    TWO_FACTOR_CACHE_ALIAS setting. Defaults to Django's default cache.
+    """
+    return caches[getattr(settings, 'TWO_FACTOR_CACHE_ALIAS', DEFAULT_CACHE_ALIAS)]
+
+
+def default_device_cache_age():
+    """
+    Returns the number of seconds the default device of a user is cached
+    across requests (as configured by the TWO_FACTOR_DEFAULT_DEVICE_CACHE_AGE
+    setting). Defaults to None, which disables the cache.
+    """
+    return getattr(settings, 'TWO_FACTOR_DEFAULT_DEVICE_CACHE_AGE', None)
+
+
+def invalidate_default_device_cache(user_id, device=None):
+    """
+    Drops the cached default device of the user. When a saved `device` is
+    given, the entry is kept if the device doesn't change which device is the
+    default one, as when a token is verified.
+    """
+    if not default_device_cache_age():
+        return
+    cache_key = DEFAULT_DEVICE_CACHE_KEY % user_id
+    if device is not None:
+        cached = get_cache().get(cache_key)
+        is_default = device.confirmed and device.name == 'default'
+        if cached is not None and is_default == (cached == (device._meta.label, device.pk)):
+            return
+    get_cache().delete(cache_key)
+
+
+def _find_default_device(user, confirmed):
+    # local import to avoid circular import
+    from two_factor.models import (
+        get_two_factor_status, status_tracking_enabled,
+    )
+
+    snapshot = getattr(user, USER_DEVICE_SNAPSHOT_ATTR_NAME, None)
+    if snapshot is not None:
+        devices = snapshot.get_devices(confirmed=confirmed)
+    elif confirmed and status_tracking_enabled():
+        device = get_two_factor_status(user).get_device()
+        devices = [device] if device else []
+    else:
+        devices = devices_for_user(user, confirmed=confirmed)
+    for device in devices:
+        if device.name == 'default':
+            return device
+
+
+def _cached_default_device(user):
+    """
+    Looks up the default device from the (model label, pk) stored in the
+    cache, which is invalidated whenever a device of the user is saved or
+    deleted.
+    """
+    cache = get_cache()
+    cache_key = DEFAULT_DEVICE_CACHE_KEY % user.pk
+    cached = cache.get(cache_key)
+    if cached == ():
+        return None
+    if cached is not None:
+        label, pk = cached
+        device = apps.get_model(label).objects.filter(
+            pk=pk, user_id=user.pk, confirmed=True, name='default'
+        ).first()
+        if device is not None:
+            return device
+
+    device = _find_default_device(user, confirmed=True)
+    cached = (device._meta.label, device.pk) if device else ()
+    cache.set(cache_key, cached, default_device_cache_age())
+    return device
 
 
 def default_device(user, confirmed=True):
@@ -11,10 +164,197 @@ def default_device(user, confirmed=True):
         return
     if hasattr(user, USER_DEFAULT_DEVICE_ATTR_NAME):
         return getattr(user, USER_DEFAULT_DEVICE_ATTR_NAME)
-    for device in devices_for_user(user, confirmed=confirmed):
-        if device.name == 'default':
-            setattr(user, USER_DEFAULT_DEVICE_ATTR_NAME, device)
-            return device
+    use_cache = (
+        confirmed and default_device_cache_age() and
+        getattr(user, USER_DEVICE_SNAPSHOT_ATTR_NAME, None) is None
+    )
+    if use_cache:
+        device = _cached_default_device(user)
+    else:
+        device = _find_default_device(user, confirmed)
+    if device is not None:
+        setattr(user, USER_DEFAULT_DEVICE_ATTR_NAME, device)
+    return device
+
+
+def default_devices_for_users(user_ids, confirmed=True, chunk_size=1000):
+    """
+    Returns a dict mapping user ids to their default device, for the given
+    users having one.
+
+    Runs one ``name='default'`` query per device model and per chunk of
+    `chunk_size` user ids, instead of calling :func:`default_device` for each
+    user.
+    """
+    user_ids = list(user_ids)
+    default_devices = {}
+    for model in device_classes():
+        for i in range(0, len(user_ids), chunk_size):
+            devices = model.objects.filter(user_id__in=user_ids[i:i + chunk_size], name='default')
+            if confirmed is not None:
+                devices = devices.filter(confirmed=bool(confirmed))
+            for device in devices.iterator(chunk_size=chunk_size):
+                # Same precedence as default_device(): first model wins
+                default_devices.setdefault(device.user_id, device)
+    return default_devices
+
+
+def with_two_factor_status(queryset, name='two_factor_enabled'):
+    """
+    Annotates a user queryset with a boolean telling whether each user has a
+    confirmed default device, computed by the database in the same query.
+    """
+    # local import to avoid circular import
+    from two_factor.models import status_tracking_enabled
+
+    if status_tracking_enabled():
+        status = Coalesce('two_factor_status__enabled', Value(False))
+    else:
+        status = Q()
+        for model in device_classes():
+            status |= Q(Exists(model.objects.filter(user=OuterRef('pk'), name='default', confirmed=True)))
+        status = status or Value(False)
+    return queryset.annotate(**{name: ExpressionWrapper(status, output_field=BooleanField())})
+
+
+def two_factor_enabled(user):
+    """
+    Returns True if the user has a confirmed default device. When the
+    TWO_FACTOR_TRACK_STATUS setting is enabled, this is a single primary key
+    lookup on :class:`~two_factor.models.TwoFactorStatus`.
+    """
+    # local import to avoid circular import
+    from two_factor.models import (
+        get_two_factor_status, status_tracking_enabled,
+    )
+
+    if not user or user.is_anonymous:
+        return False
+    if status_tracking_enabled() and not hasattr(user, USER_DEFAULT_DEVICE_ATTR_NAME):
+        return get_two_factor_status(user).enabled
+    return default_device(user) is not None
+
+
+def backup_tokens_count():
+    """
+    Returns the number of backup tokens generated at once (as configured by the
+    TWO_FACTOR_BACKUP_TOKENS_COUNT setting). Defaults to 10.
+    """
+    return getattr(settings, 'TWO_FACTOR_BACKUP_TOKENS_COUNT', 10)
+
+
+def backup_tokens_cache_age():
+    """
+    Returns the number of seconds the number of remaining backup tokens of a
+    user is cached across requests (as configured by the
+    TWO_FACTOR_BACKUP_TOKENS_CACHE_AGE setting). Defaults to None, which
+    disables the cache.
+    """
+    return getattr(settings, 'TWO_FACTOR_BACKUP_TOKENS_CACHE_AGE', None)
+
+
+def invalidate_backup_tokens_cache(user_id):
+    if backup_tokens_cache_age():
+        get_cache().delete(BACKUP_TOKENS_CACHE_KEY % user_id)
+
+
+def _count_backup_tokens(user):
+    # local import to avoid circular import
+    from django_otp.plugins.otp_static.models import StaticDevice, StaticToken
+
+    from two_factor.models import BackupToken, backup_token_hashing_enabled
+
+    def count(model):
+        return Coalesce(Subquery(
+            model.objects.filter(device=OuterRef('pk')).order_by()
+            .values('device').annotate(count=Count('pk')).values('count')
+        ), Value(0))
+
+    # A single query, with the hashed tokens too. Each kind of token is counted
+    # in its own subquery, as joining both would count their product.
+    counts = {'plaintext': count(StaticToken)}
+    if backup_token_hashing_enabled():
+        counts['hashed'] = count(BackupToken)
+    devices = StaticDevice.objects.filter(user_id=user.pk).annotate(**counts)
+    return sum(sum(row) for row in devices.values_list(*counts))
+
+
+def backup_tokens_remaining(user):
+    """
+    Returns the number of backup tokens `user` has left, over all its static
+    devices. When the TWO_FACTOR_BACKUP_TOKENS_CACHE_AGE setting is enabled,
+    the number is cached until tokens are generated or one of the user's
+    static devices is saved (as when a token is used) or deleted.
+    """
+    if not user or user.is_anonymous:
+        return 0
+    cache_age = backup_tokens_cache_age()
+    if not cache_age:
+        return _count_backup_tokens(user)
+    cache_key = BACKUP_TOKENS_CACHE_KEY % user.pk
+    count = get_cache().get(cache_key)
+    if count is None:
+        count = _count_backup_tokens(user)
+        get_cache().set(cache_key, count, cache_age)
+    return count
+
+
+def random_backup_token():
+    """
+    Returns a new backup token of TWO_FACTOR_BACKUP_TOKENS_LENGTH characters
+    (default 8, up to the 16 characters of a static token) of the
+    TWO_FACTOR_BACKUP_TOKENS_ALPHABET setting. Without an alphabet, returns
+    :meth:`~django_otp.plugins.otp_static.models.StaticToken.random_token`.
+    """
+    # local import to avoid circular import
+    from django_otp.plugins.otp_static.models import StaticToken
+
+    alphabet = getattr(settings, 'TWO_FACTOR_BACKUP_TOKENS_ALPHABET', None)
+    if not alphabet:
+        return StaticToken.random_token()
+    length = getattr(settings, 'TWO_FACTOR_BACKUP_TOKENS_LENGTH', 8)
+    max_length = StaticToken._meta.get_field('token').max_length
+    if not 1 <= length <= max_length:
+        raise ImproperlyConfigured(
+            'TWO_FACTOR_BACKUP_TOKENS_LENGTH must be between 1 and %d.' % max_length)
+    return ''.join(secrets.choice(alphabet) for _ in range(length))
+
+
+def regenerate_backup_tokens(user, number=None):
+    """
+    Replaces the backup tokens of `user` with `number` new tokens (defaults to
+    :func:`backup_tokens_count`), creating its backup device if needed. The
+    tokens are inserted at once, in the same transaction as the deletion of
+    the previous ones. When the TWO_FACTOR_HASH_BACKUP_TOKENS setting is
+    enabled, only keyed hashes of the tokens are stored.
+
+    Returns the backup device and the list of new tokens, which cannot be
+    read back from the database once hashed.
+    """
+    # local import to avoid circular import
+    from django_otp.plugins.otp_static.models import StaticToken
+
+    from two_factor.models import BackupToken, backup_token_hashing_enabled
+
+    if number is None:
+        number = backup_tokens_count()
+    tokens = [random_backup_token() for _ in range(number)]
+    with transaction.atomic():
+        # The backup device is the user's first static device, as in the views
+        device = user.staticdevice_set.first()
+        if device is None:
+            device = user.staticdevice_set.create(name='backup')
+        # Both kinds of tokens are replaced, whatever the setting was when
+        # they were generated
+        device.token_set.all().delete()
+        device.hashed_token_set.all().delete()
+        if backup_token_hashing_enabled():
+            BackupToken.objects.bulk_create([BackupToken.from_token(device, token) for token in tokens])
+        else:
+            StaticToken.objects.bulk_create([StaticToken(device=device, token=token) for token in tokens])
+    invalidate_device_snapshot(user)
+    invalidate_backup_tokens_cache(user.pk)
+    return device, tokens
 
 
 def get_otpauth_url(accountname, secret, issuer=None, digits=None):
@@ -2,7 +2,7 @@ from .core import (
     BackupTokensView, LoginView, QRGeneratorView, SetupCompleteView, SetupView,
 )
 from .mixins import OTPRequiredMixin
-from .profile import DisableView, ProfileView
+from .profile import DisableView, ForgetBrowsersView, ProfileView
 
 __all__ = (
     "BackupTokensView",
@@ -12,5 +12,6 @@ __all__ = (
     "SetupView",
     "OTPRequiredMixin",
     "DisableView",
+    "ForgetBrowsersView",
     "ProfileView"
 )
@@ -30,9 +30,8 @@ from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.debug import sensitive_post_parameters
 from django.views.generic import FormView, TemplateView
 from django.views.generic.base import View
-from django_otp import devices_for_user
 from django_otp.decorators import otp_required
-from django_otp.plugins.otp_static.models import StaticToken
+from django_otp.plugins.otp_static.models import StaticDevice
 from django_otp.util import random_hex
 
 from two_factor import signals
@@ -41,14 +40,25 @@ from two_factor.plugins.registry import MethodNotFoundError, registry
 from two_factor.utils import totp_digits
 from two_factor.views.mixins import OTPRequiredMixin
 
+from ..challenges import dispatch_challenge
 from ..forms import (
     AuthenticationTokenForm, BackupTokenForm, DeviceValidationForm, MethodForm,
     TOTPDeviceForm,
 )
-from ..utils import default_device, get_otpauth_url
+from ..models import (
+    BackupDevice, backup_token_hashing_enabled, remember_token_store_enabled,
+)
+from ..ratelimit import is_rate_limited
+from ..utils import (
+    backup_tokens_remaining, default_device, device_snapshot, get_otpauth_url,
+    invalidate_device_snapshot, regenerate_backup_tokens, two_factor_enabled,
+)
 from .utils import (
-    IdempotentSessionWizardView, get_remember_device_cookie,
-    validate_remember_device_cookie,
+    IdempotentSessionWizardView, compile_remember_device_cookies,
+    get_remember_device_cookie, get_remember_device_cookie_key,
+    get_remember_device_token_cookie, hash_remember_device_cookie_key,
+    is_remember_device_token, parse_remember_device_cookies,
+    validate_remember_device_cookie, validate_remember_device_token,
 )
 
 try:
@@ -68,6 +78,19 @@ logger = logging.getLogger(__name__)
 REMEMBER_COOKIE_PREFIX = getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_PREFIX', 'remember-cookie_')
 
 
+def remember_cookies_consolidated():
+    """
+    Returns True if remembered devices are stored in a single consolidated
+    cookie (as configured by the TWO_FACTOR_REMEMBER_COOKIE_CONSOLIDATED
+    setting) instead of one cookie per remembered login.
+    """
+    return getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_CONSOLIDATED', False)
+
+
+def remember_cookies_name():
+    return getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_NAME', 'remember-cookies')
+
+
 @method_decorator(
     [login_not_required, sensitive_post_parameters(), csrf_protect, never_cache],
     name='dispatch'
@@ -123,19 +146,31 @@ class LoginView(RedirectURLMixin, IdempotentSessionWizardView):
         BACKUP_STEP: has_backup_step,
     }
     redirect_field_name = REDIRECT_FIELD_NAME
+    rate_limited_steps = (TOKEN_STEP, BACKUP_STEP)
+    challenges_key = 'challenges'
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.user_cache = None
         self.device_cache = None
         self.cookies_to_delete = []
+        self.remember_entries_to_delete = []
         self.show_timeout_error = False
+        self.resend_challenge = False
+        self.challenge_suppressed = False
 
     def post(self, *args, **kwargs):
         """
         The user can select a particular device to challenge, being the backup
         devices added to the account.
         """
+        # Checked before any form or device work, from the posted step
+        posted_step = self.request.POST.get('%s-current_step' % self.prefix)
+        if posted_step in self.rate_limited_steps:
+            retry_after = is_rate_limited(self.request, self)
+            if retry_after:
+                return self.rate_limited(retry_after)
+
         wizard_goto_step = self.request.POST.get('wizard_goto_step', None)
 
         if wizard_goto_step == self.FIRST_STEP:
@@ -153,9 +188,23 @@ class LoginView(RedirectURLMixin, IdempotentSessionWizardView):
             self.storage.data['challenge_device'] = self.request.POST['challenge_device']
             return self.render_goto_step(self.TOKEN_STEP)
 
+        # The user explicitly asks for a new challenge
+        if 'resend_challenge' in self.request.POST:
+            self.resend_challenge = True
+            return self.render_goto_step(self.TOKEN_STEP)
+
         response = super().post(*args, **kwargs)
         return self.delete_cookies_from_response(response)
 
+    def rate_limited(self, retry_after):
+        """
+        Returns the response to a POST exceeding one of the
+        TWO_FACTOR_LOGIN_RATE_LIMITS.
+        """
+        response = HttpResponse(_('Too many attempts, please try again later.'), status=429)
+        response['Retry-After'] = str(retry_after)
+        return response
+
     def done(self, form_list, **kwargs):
         """
         Login the user and redirect to the desired page.
@@ -179,18 +228,20 @@ class LoginView(RedirectURLMixin, IdempotentSessionWizardView):
             # Set a remember cookie if activated
 
             if getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_AGE', None) and remember:
-                # choose a unique cookie key to remember devices for multiple users in the same browser
-                cookie_key = REMEMBER_COOKIE_PREFIX + str(uuid4())
-                cookie_value = get_remember_device_cookie(user=self.get_user(),
-                                                          otp_device_id=device.persistent_id)
-                response.set_cookie(cookie_key, cookie_value,
-                                    max_age=settings.TWO_FACTOR_REMEMBER_COOKIE_AGE,
-                                    domain=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_DOMAIN', None),
-                                    path=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_PATH', '/'),
-                                    secure=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_SECURE', False),
-                                    httponly=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_HTTPONLY', True),
-                                    samesite=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_SAMESITE', 'Lax'),
-                                    )
+                if remember_token_store_enabled():
+                    cookie_value = get_remember_device_token_cookie(
+                        self.get_user(), device,
+                        user_agent=self.request.META.get('HTTP_USER_AGENT', ''),
+                    )
+                else:
+                    cookie_value = get_remember_device_cookie(user=self.get_user(),
+                                                              otp_device_id=device.persistent_id)
+                if remember_cookies_consolidated():
+                    self.set_consolidated_remember_cookie(response, cookie_value)
+                else:
+                    # choose a unique cookie key to remember devices for multiple users in the same browser
+                    cookie_key = REMEMBER_COOKIE_PREFIX + str(uuid4())
+                    self.set_remember_cookie(response, cookie_key, cookie_value)
             return response
 
         # If the user does not have a device.
@@ -306,7 +357,9 @@ class LoginView(RedirectURLMixin, IdempotentSessionWizardView):
                         break
 
             if step == self.BACKUP_STEP:
-                self.device_cache = self.get_user().staticdevice_set.all().first()
+                backup_model = BackupDevice if backup_token_hashing_enabled() else StaticDevice
+                static_devices = device_snapshot(self.get_user()).get_model_devices(backup_model)
+                self.device_cache = static_devices[0] if static_devices else None
 
             if not self.device_cache:
                 self.device_cache = default_device(self.get_user())
@@ -314,11 +367,9 @@ class LoginView(RedirectURLMixin, IdempotentSessionWizardView):
         return self.device_cache
 
     def get_devices(self):
-        user = self.get_user()
-
         devices = []
-        for method in registry.get_methods():
-            devices += list(method.get_devices(user))
+        for method_devices in registry.get_all_devices(self.get_user()).values():
+            devices += method_devices
         return devices
 
     def get_other_devices(self, main_device):
@@ -340,10 +391,40 @@ class LoginView(RedirectURLMixin, IdempotentSessionWizardView):
         """
         if self.steps.current == self.TOKEN_STEP:
             form_with_errors = form and form.is_bound and not form.is_valid()
-            if not form_with_errors:
-                self.get_device().generate_challenge()
+            device = self.get_device()
+            # Only devices delivering a challenge (e.g. not token generators)
+            # are recorded
+            if not form_with_errors and device.is_interactive():
+                if self.resend_challenge or not self.challenge_sent_recently(device):
+                    if dispatch_challenge(device, self.request) is not False:
+                        self.record_challenge(device)
+                else:
+                    self.challenge_suppressed = True
         return super().render(form, **kwargs)
 
+    def challenge_sent_recently(self, device):
+        """
+        Returns True if a challenge was sent to the device during the last
+        TWO_FACTOR_CHALLENGE_RESEND_WINDOW seconds of this login, so that
+        rendering the token step again (e.g. on refresh) does not send it again.
+        """
+        window = getattr(settings, 'TWO_FACTOR_CHALLENGE_RESEND_WINDOW', 60)
+        sent_at = self.storage.extra_data.get(self.challenges_key, {}).get(self.get_challenge_key(device))
+        return bool(window) and sent_at is not None and time.time() - sent_at < window
+
+    def record_challenge(self, device):
+        extra_data = self.storage.extra_data
+        extra_data[self.challenges_key] = {
+            **extra_data.get(self.challenges_key, {}),
+            self.get_challenge_key(device): time.time(),
+        }
+        self.storage.extra_data = extra_data
+
+    def get_challenge_key(self, device):
+        # Sending the token through another channel (e.g. calling instead of
+        # texting a phone) is a new challenge.
+        return '%s:%s' % (device.persistent_id, getattr(device, 'method', ''))
+
     def get_user(self):
         """
         Returns the user authenticated by the AuthenticationForm. Returns False
@@ -351,6 +432,9 @@ class LoginView(RedirectURLMixin, IdempotentSessionWizardView):
         """
         if not self.user_cache:
             self.user_cache = self.storage.authenticated_user
+            if self.user_cache:
+                # Share the user's devices between all the lookups of this request
+                device_snapshot(self.user_cache)
         return self.user_cache
 
     def get_context_data(self, form, **kwargs):
@@ -361,9 +445,9 @@ class LoginView(RedirectURLMixin, IdempotentSessionWizardView):
         if self.steps.current == self.TOKEN_STEP:
             device = self.get_device()
             context['device'] = device
+            context['challenge_suppressed'] = self.challenge_suppressed
             context['other_devices'] = self.get_other_devices(device)
-            context['backup_tokens'] = self.get_user().staticdevice_set\
-                .all().values('token_set__token').count()
+            context['backup_tokens'] = backup_tokens_remaining(self.get_user())
 
         if getattr(settings, 'LOGOUT_REDIRECT_URL', None):
             context['cancel_url'] = resolve_url(settings.LOGOUT_REDIRECT_URL)
@@ -384,32 +468,108 @@ class LoginView(RedirectURLMixin, IdempotentSessionWizardView):
             return False
 
         user = self.get_user()
-        devices = list(devices_for_user(user))
+        # The cookie carries the hashed device id, so each cookie is matched
+        # to its device directly and only has its signature checked once.
+        devices_by_key = {
+            hash_remember_device_cookie_key(device.persistent_id): device
+            for device in device_snapshot(user).get_devices()
+        }
+        for key, value in self.get_remember_cookies():
+            device = devices_by_key.get(get_remember_device_cookie_key(value))
+            if device is None:
+                continue
+            verify_is_allowed, extra = device.verify_is_allowed()
+            if not verify_is_allowed:
+                continue
+            try:
+                if self.validate_remember_cookie(value, user, device):
+                    user.otp_device = device
+                    # Only write the device when there is a throttle state to clear
+                    if getattr(device, 'throttling_failure_count', 0):
+                        getattr(device, "throttle_reset", lambda: None)()
+                    return True
+            except BadSignature:
+                getattr(device, "throttle_increment", lambda: None)()
+                # Remove remember cookies with invalid signature to omit unnecessary throttling
+                if key == remember_cookies_name():
+                    self.remember_entries_to_delete.append(value)
+                else:
+                    self.cookies_to_delete.append(key)
+        return False
+
+    def validate_remember_cookie(self, value, user, device):
+        # Signed cookies can't be revoked, so only stored tokens are accepted
+        # once the store is enabled. Unknown or revoked tokens are rejected
+        # without throttling the device.
+        if remember_token_store_enabled():
+            return validate_remember_device_token(value, user=user, otp_device_id=device.persistent_id)
+        if is_remember_device_token(value):
+            return False
+        return validate_remember_device_cookie(
+            value,
+            user=user,
+            otp_device_id=device.persistent_id
+        )
+
+    def get_remember_cookies(self):
+        """
+        Returns (cookie name, remember cookie) pairs for the legacy per-login
+        remember cookies and for each entry of the consolidated cookie.
+        """
         for key, value in self.request.COOKIES.items():
             if key.startswith(REMEMBER_COOKIE_PREFIX) and value:
-                for device in devices:
-                    verify_is_allowed, extra = device.verify_is_allowed()
-                    try:
-                        if verify_is_allowed and validate_remember_device_cookie(
-                                value,
-                                user=user,
-                                otp_device_id=device.persistent_id
-                        ):
-                            user.otp_device = device
-                            getattr(device, "throttle_reset", lambda: None)()
-                            return True
-                    except BadSignature:
-                        getattr(device, "throttle_increment", lambda: None)()
-                        # Remove remember cookies with invalid signature to omit unnecessary throttling
-                        self.cookies_to_delete.append(key)
-        return False
+                yield key, value
+        name = remember_cookies_name()
+        for value in parse_remember_device_cookies(self.request.COOKIES.get(name, '')):
+            yield name, value
+
+    def set_remember_cookie(self, response, key, value):
+        response.set_cookie(key, value,
+                            max_age=settings.TWO_FACTOR_REMEMBER_COOKIE_AGE,
+                            domain=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_DOMAIN', None),
+                            path=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_PATH', '/'),
+                            secure=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_SECURE', False),
+                            httponly=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_HTTPONLY', True),
+                            samesite=getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_SAMESITE', 'Lax'),
+                            )
+
+    def set_consolidated_remember_cookie(self, response, cookie_value):
+        """
+        Adds the remember cookie to the consolidated cookie, migrating any
+        legacy per-login remember cookies into it.
+        """
+        entries = []
+        for key, value in self.get_remember_cookies():
+            if value in self.remember_entries_to_delete:
+                continue
+            entries.append(value)
+            if key != remember_cookies_name():
+                self.cookies_to_delete.append(key)
+        entries.append(cookie_value)
+        max_entries = getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_MAX_ENTRIES', 10)
+        self.set_remember_cookie(response, remember_cookies_name(),
+                                 compile_remember_device_cookies(entries, max_entries))
+        self.remember_entries_to_delete = []
 
     def delete_cookies_from_response(self, response):
         """
-        Deletes the cookies_to_delete in the response
+        Deletes the cookies_to_delete in the response, and drops the
+        remember_entries_to_delete from the consolidated cookie.
         """
         for cookie in self.cookies_to_delete:
             response.delete_cookie(cookie)
+        if self.remember_entries_to_delete:
+            name = remember_cookies_name()
+            entries = [
+                value for value in parse_remember_device_cookies(self.request.COOKIES.get(name, ''))
+                if value not in self.remember_entries_to_delete
+            ]
+            max_entries = getattr(settings, 'TWO_FACTOR_REMEMBER_COOKIE_MAX_ENTRIES', 10)
+            compiled = compile_remember_device_cookies(entries, max_entries)
+            if compiled:
+                self.set_remember_cookie(response, name, compiled)
+            else:
+                response.delete_cookie(name)
         return response
 
     # Copied from django.contrib.auth.views.LoginView  (Branch: stable/1.11.x)
@@ -480,7 +640,7 @@ class SetupView(RedirectURLMixin, IdempotentSessionWizardView):
         """
         Start the setup wizard. Redirect if already enabled.
         """
-        if default_device(self.request.user):
+        if two_factor_enabled(self.request.user):
             return redirect(self.get_success_url())
         return super().get(request, *args, **kwargs)
 
@@ -519,12 +679,9 @@ class SetupView(RedirectURLMixin, IdempotentSessionWizardView):
         """
         next_step = self.steps.next
         if next_step == 'validation':
-            try:
-                self.get_device().generate_challenge()
-                kwargs["challenge_succeeded"] = True
-            except Exception:
-                logger.exception("Could not generate challenge")
-                kwargs["challenge_succeeded"] = False
+            # The device isn't saved yet, so its challenge is generated during
+            # the request and the outcome is known.
+            kwargs["challenge_succeeded"] = dispatch_challenge(self.get_device(), self.request) is not False
         return super().render_next_step(form, **kwargs)
 
     def done(self, form_list, **kwargs):
@@ -549,6 +706,7 @@ class SetupView(RedirectURLMixin, IdempotentSessionWizardView):
             device.confirmed = True
             device.save()
 
+        invalidate_device_snapshot(self.request.user)
         django_otp.login(self.request, device)
         return redirect(self.get_success_url())
 
@@ -645,26 +803,38 @@ class BackupTokensView(FormView):
     form_class = Form
     success_url = 'two_factor:backup_tokens'
     template_name = 'two_factor/core/backup_tokens.html'
-    number_of_tokens = 10
+    # Defaults to the TWO_FACTOR_BACKUP_TOKENS_COUNT setting
+    number_of_tokens = None
 
     def get_device(self):
-        device, _ = self.request.user.staticdevice_set.get_or_create(defaults={'name':'backup'})
-        return device
+        """
+        Returns the user's backup device, or None if it has none yet.
+        """
+        return self.request.user.staticdevice_set.first()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['device'] = self.get_device()
+        device = context['device'] = self.get_device()
+        context['remaining_tokens'] = 0
+        if device is None:
+            context['tokens'] = []
+        elif backup_token_hashing_enabled():
+            # Hashed tokens are only shown in the response generating them
+            context.setdefault('tokens', [])
+            if not context['tokens']:
+                context['remaining_tokens'] = device.hashed_token_set.count() + device.token_set.count()
+        else:
+            context['tokens'] = [token.token for token in device.token_set.all()]
         return context
 
     def form_valid(self, form):
         """
         Delete existing backup codes and generate new ones.
         """
-        device = self.get_device()
-        device.token_set.all().delete()
-        for n in range(self.number_of_tokens):
-            device.token_set.create(token=StaticToken.random_token())
-
+        _, tokens = regenerate_backup_tokens(self.request.user, self.number_of_tokens)
+        if backup_token_hashing_enabled():
+            # The tokens can't be read back, nor stored anywhere else
+            return self.render_to_response(self.get_context_data(tokens=tokens))
         return redirect(self.success_url)
 
 
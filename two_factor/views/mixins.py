@@ -5,7 +5,7 @@ from django.template.response import TemplateResponse
 from django.urls import Resolver404, resolve, reverse
 
 from ..admin import AdminSiteOTPRequiredMixin
-from ..utils import default_device
+from ..utils import two_factor_enabled
 
 
 class OTPRequiredMixin:
@@ -57,7 +57,7 @@ class OTPRequiredMixin:
 
     def dispatch(self, request, *args, **kwargs):
         if not request.user or not request.user.is_authenticated or \
-                (not request.user.is_verified() and default_device(request.user)):
+                (not request.user.is_verified() and two_factor_enabled(request.user)):
             # If the user has not authenticated raise or redirect to the login
             # page. Also if the user just enabled two-factor authentication and
             # has not yet logged in since should also have the same result. If
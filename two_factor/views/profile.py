@@ -4,7 +4,7 @@ from django.shortcuts import redirect, resolve_url
 from django.utils.decorators import method_decorator
 from django.utils.functional import lazy
 from django.views.decorators.cache import never_cache
-from django.views.generic import FormView, TemplateView
+from django.views.generic import FormView, TemplateView, View
 from django_otp import devices_for_user
 from django_otp.decorators import otp_required
 
@@ -13,7 +13,11 @@ from two_factor.plugins.phonenumber.utils import (
 )
 
 from ..forms import DisableForm
-from ..utils import default_device
+from ..models import remember_token_store_enabled
+from ..utils import (
+    backup_tokens_remaining, default_device, device_snapshot,
+    invalidate_device_snapshot,
+)
 
 
 @method_decorator([never_cache, login_required], name='dispatch')
@@ -29,19 +33,18 @@ class ProfileView(TemplateView):
 
     def get_context_data(self, **kwargs):
         user = self.request.user
-
-        try:
-            backup_tokens = user.staticdevice_set.all()[0].token_set.count()
-
-        except Exception:
-            backup_tokens = 0
+        device_snapshot(user)
 
         context = {
             'default_device': default_device(user),
             'default_device_type': default_device(user).__class__.__name__,
-            'backup_tokens': backup_tokens,
+            'backup_tokens': backup_tokens_remaining(user),
             'backup_phones': backup_phones(user),
             'available_phone_methods': get_available_phone_methods(),
+            'remembered_browsers': (
+                user.remembered_devices.order_by('-last_seen')
+                if remember_token_store_enabled() else []
+            ),
         }
 
         return context
@@ -66,4 +69,25 @@ class DisableView(FormView):
     def form_valid(self, form):
         for device in devices_for_user(self.request.user):
             device.delete()
+        if remember_token_store_enabled():
+            self.request.user.remembered_devices.all().revoke()
+        # Also drops the cached default device
+        invalidate_device_snapshot(self.request.user)
+        return redirect(self.success_url)
+
+
+@method_decorator([never_cache, otp_required], name='dispatch')
+class ForgetBrowsersView(View):
+    """
+    View for revoking the browsers remembered by the user, either the ones
+    selected in the ``browser`` POST parameter or all of them.
+    """
+    success_url = 'two_factor:profile'
+
+    def post(self, request, *args, **kwargs):
+        remembered = request.user.remembered_devices.all()
+        selected = request.POST.getlist('browser')
+        if selected:
+            remembered = remembered.filter(pk__in=[pk for pk in selected if pk.isdigit()])
+        remembered.revoke()
         return redirect(self.success_url)
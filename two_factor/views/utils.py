@@ -1,5 +1,6 @@
 import hashlib
 import logging
+import re
 import time
 
 from django.conf import settings
@@ -15,6 +16,8 @@ from formtools.wizard.forms import ManagementForm
 from formtools.wizard.storage.session import SessionStorage
 from formtools.wizard.views import SessionWizardView
 
+from ..models import RememberedDevice, get_password_fingerprint
+
 logger = logging.getLogger(__name__)
 
 
@@ -265,6 +268,98 @@ def validate_remember_device_cookie(cookie, user, otp_device_id):
     return True
 
 
+def get_remember_device_token_cookie(user, device, user_agent=''):
+    """
+    Remember the browser in the server-side store and compile a cookie
+    carrying its random token, in the format of get_remember_device_cookie
+    with the token in place of the hashed signature.
+    """
+    timestamp = b62_encode(int(time.time()))
+    cookie_key = hash_remember_device_cookie_key(device.persistent_id)
+    token = RememberedDevice.objects.issue(user, device, user_agent=user_agent)
+
+    return remember_device_cookie_separator.join([timestamp, cookie_key, token])
+
+
+def validate_remember_device_token(cookie, user, otp_device_id):
+    """
+    Returns True if the token carried by the cookie is stored for the same
+    user, otp_device_id and user.password, and is not expired.
+    Returns False if the token is not stored.
+    Otherwise raises an exception.
+    """
+    token = cookie.split(remember_device_cookie_separator, 3)[-1]
+    entry = RememberedDevice.objects.lookup(token)
+    if entry is None:
+        return False
+
+    if (entry['user_id'] != user.pk or entry['device_id'] != otp_device_id
+            or entry['password_fingerprint'] != get_password_fingerprint(user)):
+        raise BadSignature('Remember token does not match')
+
+    RememberedDevice.objects.touch(token, entry)
+    return True
+
+
+def is_remember_device_token(cookie):
+    """
+    Returns True if the cookie carries a token of the server-side store rather
+    than the signature of get_remember_device_cookie.
+    """
+    value = cookie.split(remember_device_cookie_separator, 3)[-1]
+    return not re.fullmatch('[0-9a-f]{64}', value)
+
+
+def get_remember_device_cookie_key(cookie):
+    """
+    Returns the hashed otp_device_id carried by a cookie returned by
+    get_remember_device_cookie, or None if the cookie is malformed.
+    """
+    parts = cookie.split(remember_device_cookie_separator)
+    if len(parts) != 3:
+        return None
+    return parts[1]
+
+
+remember_device_cookies_separator = '.'
+
+
+def parse_remember_device_cookies(cookies):
+    """
+    Returns the list of remember cookies (as returned by
+    get_remember_device_cookie) held by a consolidated remember cookie, from
+    least to most recently used.
+    """
+    return [cookie for cookie in cookies.split(remember_device_cookies_separator) if cookie]
+
+
+def compile_remember_device_cookies(cookies, max_entries):
+    """
+    Compile a consolidated remember cookie from a list of remember cookies
+    ordered from least to most recently used.
+
+    Only the most recent cookie of each device is kept, expired cookies are
+    pruned and the least recently used ones are evicted to keep at most
+    `max_entries` of them.
+    """
+    now = time.time()
+    kept = {}
+    for cookie in cookies:
+        cookie_key = get_remember_device_cookie_key(cookie)
+        if cookie_key is None:
+            continue
+        try:
+            age = now - b62_decode(cookie.split(remember_device_cookie_separator, 1)[0])
+        except ValueError:
+            continue
+        if age > settings.TWO_FACTOR_REMEMBER_COOKIE_AGE:
+            continue
+        # Re-inserting moves the device's cookie to the most recent position
+        kept.pop(cookie_key, None)
+        kept[cookie_key] = cookie
+    return remember_device_cookies_separator.join(list(kept.values())[-max_entries:])
+
+
 def hash_remember_device_cookie_key(otp_device_id):
     return hashlib.md5(force_bytes(otp_device_id)).hexdigest()
 